@@ -18,6 +18,24 @@ NUMBER_OF_INFERENCE_STATIONS = 8
 
 MAX_DATE = '2100-01-01' # максимальная дата, после которой данные считаем невалидными
 
+# кэш распарсенных файлов с гидропостов
+HYDRO_CACHE_DIR = 'cache/hydro' # путь относительно DATASETS_PATH, None - не использовать кэш
+HYDRO_CACHE_MAX_SIZE_MB = 512 # максимальный размер кэша на диске
+
+# хранилище обработанных суточных метео данных (по станциям и годам), заполняется командой
+# python -m amurlevel_model.dataloaders.meteo_store --ingest
+METEO_STORE_DIR = 'store/meteo' # путь относительно DATASETS_PATH, None - всегда читать исходные .csv
+
+# кэш результатов этапов train.py/predict.py (чтение данных, мерджи, кригинг, make_dataset)
+STAGE_CACHE_DIR = 'cache/stages' # путь относительно DATASETS_PATH, None - не использовать кэш
+STAGE_CACHE_MAX_SIZE_MB = 8192 # максимальный размер кэша на диске
+
+# хранилище готовых строк датасета для ежедневного прогноза (predict.py --feature-store)
+FEATURE_STORE_DIR = 'store/features' # путь относительно DATASETS_PATH, None - хранилище отключено
+FEATURE_STORE_HISTORY_DAYS = 400 # сколько последних дней гидро-метео данных хранится для пересчета признаков
+
+N_JOBS = None # количество процессов для параллельной обработки данных, None - по количеству ядер
+
 # яндекс.погода API
 YANDEX_KEY = '' # ключ для доступа к сервису
 YANDEX_URL = 'https://api.weather.yandex.ru/v2/forecast' # урл для API
@@ -33,4 +51,15 @@ ASUNP_API_URL = 'http://asunp.meteo.ru/geoits-rest/services/asunp/geo.json' # у
 # модель
 BATCH_SIZE = 8 # размер батча
 EPOCHS = 100 # количество эпох
+TRAIN_STRIDE = 1 # шаг (в днях) между окнами обучающей выборки
+TEST_STRIDE = DAYS_FORECAST # шаг (в днях) между окнами тестовой выборки и при инференсе
+WINDOWS_DIR = 'windows' # путь относительно DATASETS_PATH для выгрузки окон в .npy (train.py --stream)
+SHUFFLE_BUFFER = 10000 # размер буфера перемешивания окон в tf.data
+EXPORT_DIR = 'export' # путь относительно DATASETS_PATH для моделей, экспортированных для инференса (SavedModel, TFLite)
+
+# сервис предсказаний (serve.py)
+SERVE_HOST = '127.0.0.1' # адрес, на котором слушает сервис
+SERVE_PORT = 8080 # порт сервиса
+SERVE_MAX_BATCH = 32 # максимальное количество окон в одном вызове model.predict
+SERVE_BATCH_WAIT_MS = 20 # сколько ждать другие запросы для объединения в батч, мс
 
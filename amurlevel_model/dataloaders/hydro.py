@@ -1,57 +1,110 @@
 # -*- coding: utf-8 -*-
 
 import pandas as pd
+import io
 import os
 import logging
-from ..config import ALL_STATIONS,DATASETS_PATH,MAX_DATE
-from ..utils.common import dateparse
-from typing import Union
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from ..config import ALL_STATIONS,DATASETS_PATH,MAX_DATE,N_JOBS
+from ..utils.common import parse_dates,detect_encoding,get_n_jobs
+from .hydro_cache import read_cached
+from .hydro_index import read_hydro_window
+from typing import Union,List,Optional,Callable,Tuple
 from datetime import date,datetime
 from dateutil.relativedelta import relativedelta
 
 MAX_LEVEL_DIFF = 1000 # максимальное значение разности между уровнями, при котором считаем данные невалидными
 
+def read_hydro_csv(fname: str, names: List[str], usecols: List[str],
+                   dtype: Optional[dict]=None, byte_range: Optional[Tuple[int,int]]=None, **kwargs) -> pd.DataFrame:
+    '''
+    Однопроходное чтение .csv файла с гидропоста: кодировка определяется один раз по началу файла,
+    даты в первой колонке разбираются векторизованно (parse_dates) вместо dateparse на каждую строку
+    :param fname: str, путь до файла с данными
+    :param names: List[str], названия всех колонок файла, первая - дата
+    :param usecols: List[str], колонки, которые нужно прочитать
+    :param dtype: dict, типы колонок для pd.read_csv
+    :param byte_range: tuple, (начало, конец) в байтах - читать только этот диапазон строк файла (без заголовка)
+    :param kwargs: остальные параметры для pd.read_csv
+    :return: pd.DataFrame с DatetimeIndex
+    '''
+    dtype = dict(dtype or {}, **{names[0]: str})
+    encoding = detect_encoding(fname)
+    source = fname
+    if byte_range is not None:
+        with open(fname, 'rb') as f:
+            f.seek(byte_range[0])
+            source = io.BytesIO(f.read(byte_range[1] - byte_range[0]))
+        kwargs['skiprows'] = 0
+    try:
+        df = pd.read_csv(source, encoding=encoding, names=names, usecols=usecols, dtype=dtype,
+                         index_col=0, **kwargs)
+    except UnicodeDecodeError:
+        # некорректные utf-8 символы встретились дальше проверенного начала файла
+        if byte_range is not None:
+            source.seek(0)
+        df = pd.read_csv(source, encoding='cp1251', names=names, usecols=usecols, dtype=dtype,
+                         index_col=0, **kwargs)
+    df.index = parse_dates(df.index.values).rename(df.index.name)
+    return df
+
+def map_unique(values: pd.Series, func: Callable[[pd.Series], pd.Series]) -> pd.Series:
+    '''
+    Поэлементное преобразование колонки, которое вычисляется только по ее уникальным значениям
+    :param values: pd.Series
+    :param func: Callable, поэлементное преобразование pd.Series -> pd.Series
+    :return: pd.Series
+    '''
+    uniques = values.unique()
+    mapped = func(pd.Series(uniques, dtype=values.dtype))
+    codes = pd.Index(uniques).get_indexer(values)
+    return pd.Series(mapped.values.take(codes), index=values.index, name=values.name)
+
+def parse_hydro_level_file(fname: str, byte_range: Optional[Tuple[int,int]]=None) -> pd.DataFrame:
+    '''
+    Парсинг .csv файла с информацией по уровню воды без фильтрации по датам
+    Результат кэшируется в hydro_cache
+    :param fname: str, путь до файла с данными
+    :param byte_range: tuple, (начало, конец) в байтах - парсить только этот диапазон строк файла
+    :return: pd.DataFrame
+    '''
+    df = read_hydro_csv(fname,
+                        byte_range=byte_range,
+                        sep=';',
+                        dtype={'water_code': str},
+                        skiprows=2,
+                        names=['date', 'sealevel_avg', 'sealevel_min', 'sealevel_max', 'water_temp',
+                               'water_code', '_'],
+                        usecols=['date', 'sealevel_avg', 'sealevel_min', 'sealevel_max',
+                                 'water_temp', 'water_code'],
+                        skipinitialspace=True
+                        )
+
+    df['sealevel_max'] = pd.to_numeric(df['sealevel_max'], errors='coerce')
+    df['water_temp'] = pd.to_numeric(map_unique(df['water_temp'],
+                                                lambda x: x.fillna('').astype(str).str.extract(r'(\d+\.{0,1}\d{0,2})')[0]))
+    df['water_code'] = map_unique(df['water_code'], lambda x: x.str.strip().str.split(', ').astype(str))
+    return df[['sealevel_min', 'sealevel_max', 'water_temp', 'water_code']]
+
 def read_hydro_level_data(fname: str, start_date: Union[str,date,datetime] = '1980-01-01',
-                          end_date: Union[str,date,datetime]=MAX_DATE) -> pd.DataFrame:
+                          end_date: Union[str,date,datetime]=MAX_DATE, seek: bool=False) -> pd.DataFrame:
     '''
     Чтение исходных данных из .csv файла с информацией по уровню воды
     Ресемплирование данных до суточных
     :param fname: str, путь до файла с данными
     :param start_date: str,datetime,date - начальная дата, меньше которой данные выкидываем
     :param end_date: str,datetime,date - конечная дата, больше которой данные выкидываем
+    :param seek: bool, если True - читать только нужный диапазон файла по индексу дата -> смещение (hydro_index)
     :return: pd.DataFrame
     '''
-    try:
-        df = pd.read_csv(fname,
-                         sep=';',
-                         dtype={'water_code': str},
-                         skiprows=2, index_col=0,
-                         names=['date', 'sealevel_avg', 'sealevel_min', 'sealevel_max', 'water_temp',
-                                'water_code', '_'],
-                         usecols=['date', 'sealevel_avg', 'sealevel_min', 'sealevel_max',
-                                  'water_temp', 'water_code'],
-                         date_parser=dateparse,
-                         skipinitialspace=True
-                         )
-    except UnicodeDecodeError:
-        df = pd.read_csv(fname,
-                         encoding='cp1251',
-                         sep=';',
-                         dtype={'water_code': str},
-                         skiprows=2, index_col=0,
-                         names=['date', 'sealevel_avg', 'sealevel_min', 'sealevel_max', 'water_temp',
-                                'water_code', '_'],
-                         usecols=['date', 'sealevel_avg', 'sealevel_min', 'sealevel_max',
-                                  'water_temp', 'water_code'],
-                         date_parser=dateparse,
-                         skipinitialspace=True
-                         )
+    if seek:
+        df = read_hydro_window(fname, parse_hydro_level_file, start_date, end_date)
+    else:
+        df = read_cached(fname, parse_hydro_level_file)
 
     df = df[(df.index <= end_date) & (df.index >= start_date)]
-    df['sealevel_max'] = pd.to_numeric(df['sealevel_max'], errors='coerce')
     df['sealevel_min'] = pd.to_numeric(df['sealevel_min'])
-    df['water_temp'] = pd.to_numeric(df['water_temp'].fillna('').astype(str).str.extract(r'(\d+\.{0,1}\d{0,2})')[0])
-    df['water_code'] = df.water_code.str.strip().str.split(', ').astype(str)
     unique_vals = {val: n for n, val in enumerate(df['water_code'].unique())}
     df['water_code'] = df['water_code'].map(unique_vals)
     df = df[~df.index.duplicated(keep='last')]
@@ -67,51 +120,73 @@ def read_hydro_level_data(fname: str, start_date: Union[str,date,datetime] = '19
     df = df[df['sealevel_max'].diff().fillna(0) <= MAX_LEVEL_DIFF]
     return df
 
+def parse_hydro_disch_file(fname: str, byte_range: Optional[Tuple[int,int]]=None) -> pd.DataFrame:
+    '''
+    Парсинг .csv файла с информацией по суточному расходу воды без фильтрации по датам
+    Результат кэшируется в hydro_cache
+    :param fname: str, путь до файла с данными
+    :param byte_range: tuple, (начало, конец) в байтах - парсить только этот диапазон строк файла
+    :return: pd.DataFrame
+    '''
+    df = read_hydro_csv(fname,
+                        byte_range=byte_range,
+                        sep=';', names=['date', 'water_flow', '_'], usecols=['date', 'water_flow'],
+                        skiprows=2)
+
+    df['water_flow'] = pd.to_numeric(df['water_flow'], errors='coerce')
+    return df
+
 def read_hydro_disch_data(fname: str, start_date: Union[str,date,datetime] = '1980-01-01',
-                          end_date: Union[str,date,datetime]=MAX_DATE) -> pd.DataFrame:
+                          end_date: Union[str,date,datetime]=MAX_DATE, seek: bool=False) -> pd.DataFrame:
     '''
     Чтение исходных данных из .csv файла с информацией по суточному расходу воды
     :param fname: str, путь до файла с данными
     :param start_date: str,datetime,date - начальная дата, меньше которой данные выкидываем
     :param end_date: str,datetime,date - конечная дата, больше которой данные выкидываем
+    :param seek: bool, если True - читать только нужный диапазон файла по индексу дата -> смещение (hydro_index)
     :return: pd.DataFrame
     '''
-    try:
-        df = pd.read_csv(fname,
-                             sep=';', names=['date', 'water_flow', '_'], usecols=['date', 'water_flow'],
-                             skiprows=2, index_col=0, date_parser=dateparse)
-    except UnicodeDecodeError:
-        df = pd.read_csv(fname, encoding='cp1251',
-                             sep=';', names=['date', 'water_flow', '_'], usecols=['date', 'water_flow'],
-                             skiprows=2, index_col=0, date_parser=dateparse)
-
+    if seek:
+        df = read_hydro_window(fname, parse_hydro_disch_file, start_date, end_date)
+    else:
+        df = read_cached(fname, parse_hydro_disch_file)
     df = df[(df.index <= end_date) & (df.index >= start_date)]
-    df['water_flow'] = pd.to_numeric(df['water_flow'], errors='coerce')
     return df
 
-def read_hydro_snow_ice_data(fname: str, start_date: str = '1980-01-01', end_date: str=MAX_DATE) -> pd.DataFrame:
+def parse_hydro_snow_ice_file(fname: str, byte_range: Optional[Tuple[int,int]]=None) -> pd.DataFrame:
+    '''
+    Парсинг .csv файла с информацией по снежнову и ледовому покровам без фильтрации по датам
+    Результат кэшируется в hydro_cache
+    :param fname: str, путь до файла с данными
+    :param byte_range: tuple, (начало, конец) в байтах - парсить только этот диапазон строк файла
+    :return: pd.DataFrame
+    '''
+    df = read_hydro_csv(fname,
+                        byte_range=byte_range,
+                        sep=';', names=['date', 'ice_thickness', 'snow_height', 'ice_place', '_'],
+                        usecols=['date', 'ice_thickness', 'snow_height', 'ice_place'],
+                        skiprows=2)
+
+    df['ice_thickness'] = pd.to_numeric(df['ice_thickness'], errors='coerce')
+    df['snow_height'] = pd.to_numeric(df['snow_height'], errors='coerce')
+    return df[['ice_thickness', 'snow_height']]
+
+def read_hydro_snow_ice_data(fname: str, start_date: str = '1980-01-01', end_date: str=MAX_DATE,
+                             seek: bool=False) -> pd.DataFrame:
     '''
     Чтение исходных данных из .csv файла с информацией по снежнову и ледовому покровам
     Ресемплирование данных до суточных
     :param fname: str, путь до файла с данными
     :param start_date: str,datetime,date - начальная дата, меньше которой данные выкидываем
     :param end_date: str,datetime,date - конечная дата, больше которой данные выкидываем
+    :param seek: bool, если True - читать только нужный диапазон файла по индексу дата -> смещение (hydro_index)
     :return: pd.DataFrame
     '''
-    try:
-        df = pd.read_csv(fname,
-                         sep=';', names=['date', 'ice_thickness', 'snow_height', 'ice_place', '_'],
-                         usecols=['date', 'ice_thickness', 'snow_height', 'ice_place'],
-                         skiprows=2, index_col=0, date_parser=dateparse)
-    except UnicodeDecodeError:
-        df = pd.read_csv(fname, encoding='cp1251',
-                         sep=';', names=['date', 'ice_thickness', 'snow_height', 'ice_place', '_'],
-                         usecols=['date', 'ice_thickness', 'snow_height', 'ice_place'],
-                         skiprows=2, index_col=0, date_parser=dateparse)
-
+    if seek:
+        df = read_hydro_window(fname, parse_hydro_snow_ice_file, start_date, end_date)
+    else:
+        df = read_cached(fname, parse_hydro_snow_ice_file)
     df = df[(df.index <= end_date) & (df.index >= start_date)]
-    df['ice_thickness'] = pd.to_numeric(df['ice_thickness'], errors='coerce')
-    df['snow_height'] = pd.to_numeric(df['snow_height'], errors='coerce')
     df = df.resample('D').agg({
         'ice_thickness': 'max',
         'snow_height': 'max'
@@ -119,7 +194,7 @@ def read_hydro_snow_ice_data(fname: str, start_date: str = '1980-01-01', end_dat
     return df
 
 def read_hydro_archive(identifier: str, start_date: Union[str,date,datetime] = '1980-01-01',
-                       end_date: Union[str,date,datetime]=MAX_DATE) -> pd.DataFrame:
+                       end_date: Union[str,date,datetime]=MAX_DATE, seek: bool=False) -> pd.DataFrame:
     '''
     Мердж всех данных (уровень, суточный расход воды и снежный покров) с определенного гидропоста.
     Если данных по суточному расходу воды и/или снежному покрову нет, они игнорируются
@@ -127,22 +202,23 @@ def read_hydro_archive(identifier: str, start_date: Union[str,date,datetime] = '
     :param identifier: str, идентификатор гидропоста
     :param start_date: str,datetime,date - начальная дата, меньше которой данные выкидываем
     :param end_date: str,datetime,date - конечная дата, больше которой данные выкидываем
+    :param seek: bool, если True - читать только нужный диапазон файлов по индексу дата -> смещение
     :return: pd.DataFrame
     '''
     logger = logging.getLogger()
     hydro_level_fname = os.path.join(DATASETS_PATH,'hydro',f'{identifier}_daily.csv')
-    df = read_hydro_level_data(hydro_level_fname,start_date,end_date)
+    df = read_hydro_level_data(hydro_level_fname,start_date,end_date,seek)
 
     hydro_snow_ice_fname = os.path.join(DATASETS_PATH,'hydro',f'{identifier}_ice.csv')
     try:
-        snow_ice_df = read_hydro_snow_ice_data(hydro_snow_ice_fname,start_date,end_date)
+        snow_ice_df = read_hydro_snow_ice_data(hydro_snow_ice_fname,start_date,end_date,seek)
         df = df.merge(snow_ice_df, how='left', left_index=True, right_index=True)
     except FileNotFoundError:
         logger.warning(f"File not found {hydro_snow_ice_fname}")
 
     hydro_water_fname = os.path.join(DATASETS_PATH,'hydro',f'{identifier}_disch_d.csv')
     try:
-        wat_df = read_hydro_disch_data(hydro_water_fname,start_date,end_date)
+        wat_df = read_hydro_disch_data(hydro_water_fname,start_date,end_date,seek)
         df = df.merge(wat_df, how='left', left_index=True, right_index=True)
     except FileNotFoundError:
         logger.warning(f"File not found {hydro_water_fname}")
@@ -152,17 +228,27 @@ def read_hydro_archive(identifier: str, start_date: Union[str,date,datetime] = '
 
 
 def read_hydro_all(start_date: Union[str,date,datetime] = '1980-01-01',
-                   end_date: Union[str,date,datetime]=MAX_DATE) -> pd.DataFrame:
+                   end_date: Union[str,date,datetime]=MAX_DATE, seek: bool=False,
+                   n_jobs: Optional[int]=N_JOBS) -> pd.DataFrame:
     '''
     Чтение всех входных данных по гидро по всем станциям из ALL_STATIONS
+    Станции читаются параллельно в n_jobs процессах и объединяются одним pd.concat в порядке ALL_STATIONS
     :param start_date: str,datetime,date - начальная дата, меньше которой данные выкидываем
     :param end_date: str,datetime,date - конечная дата, больше которой данные выкидываем
+    :param seek: bool, если True - читать только нужный диапазон файлов по индексу дата -> смещение
+                 (удобно для инференса, когда нужны последние несколько лет)
+    :param n_jobs: int, количество процессов, None - по количеству ядер, 1 - без распараллеливания
     :return: pd.DataFrame, данные с информацией с гидропостов
     '''
-    full_df = pd.DataFrame()
-    for _id in ALL_STATIONS:
-        df = read_hydro_archive(_id,start_date,end_date)
-        full_df = pd.concat([full_df, df], ignore_index=True)
+    read_station = partial(read_hydro_archive, start_date=start_date, end_date=end_date, seek=seek)
+    n_jobs = min(get_n_jobs(n_jobs), len(ALL_STATIONS))
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            dfs = list(executor.map(read_station, ALL_STATIONS))
+    else:
+        dfs = [read_station(_id) for _id in ALL_STATIONS]
+
+    full_df = pd.concat(dfs, ignore_index=True)
     full_df.drop_duplicates(['date','identifier'],keep='last',inplace=True)
     full_df.sort_values('date',inplace=True)
-    return full_df
\ No newline at end of file
+    return full_df
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+import pandas as pd
+import numpy as np
+import os
+import json
+import tempfile
+import hashlib
+import logging
+from argparse import ArgumentParser
+from typing import Callable, Optional
+
+from ..config import DATASETS_PATH, HYDRO_CACHE_DIR, HYDRO_CACHE_MAX_SIZE_MB
+from ..utils.common import evict_lru_files
+
+CACHE_VERSION = 1 # версия формата кэша, при изменении парсеров все старые записи становятся невалидными
+
+
+def get_cache_dir() -> Optional[str]:
+    '''
+    Директория с кэшем распарсенных файлов гидропостов
+    :return: str, путь до директории или None, если кэш отключен
+    '''
+    if HYDRO_CACHE_DIR is None:
+        return None
+    return os.path.join(DATASETS_PATH, HYDRO_CACHE_DIR)
+
+
+def _source_stamp(fname: str, parser_name: str) -> dict:
+    '''
+    Ключ записи в кэше: путь до исходного файла, его размер, время изменения и имя парсера
+    Если файла нет - выбрасывается FileNotFoundError, как и при чтении .csv
+    '''
+    stat = os.stat(fname)
+    return {'path': os.path.abspath(fname), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+            'parser': parser_name, 'version': CACHE_VERSION}
+
+
+def _entry_path(cache_dir: str, stamp: dict) -> str:
+    '''
+    Одна запись на пару (исходный файл, парсер) - при изменении файла запись перезаписывается
+    '''
+    key = hashlib.sha1(f"{stamp['path']}|{stamp['parser']}".encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, key + '.npz')
+
+
+def _save_frame(df: pd.DataFrame, fname: str, stamp: dict) -> None:
+    '''
+    Сохранение датафрейма в .npz по колонкам (индекс - даты в int64)
+    Строковые колонки сохраняются как unicode-массивы вместе с маской пропусков
+    '''
+    arrays = {'__index__': df.index.values.astype('datetime64[ns]').astype(np.int64)}
+    columns = []
+    for col in df.columns:
+        values = df[col].values
+        if values.dtype == object:
+            null = pd.isnull(values)
+            arrays['__null__' + col] = null
+            values = np.where(null, '', values).astype(str)
+        arrays['__col__' + col] = values
+        columns.append(col)
+    meta = dict(stamp, index_name=df.index.name, columns=columns)
+    arrays['__meta__'] = np.array(json.dumps(meta))
+
+    fd, tmp_fname = tempfile.mkstemp(dir=os.path.dirname(fname), prefix=os.path.basename(fname) + '.', suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_fname, fname)
+
+
+def _load_frame(fname: str, stamp: dict) -> Optional[pd.DataFrame]:
+    '''
+    Чтение датафрейма из .npz. Если запись устарела (изменился исходный файл) или повреждена - None
+    '''
+    try:
+        with np.load(fname, allow_pickle=False) as data:
+            meta = json.loads(str(data['__meta__']))
+            if any(meta.get(key) != value for key, value in stamp.items()):
+                return None
+            index = pd.DatetimeIndex(data['__index__'].astype('datetime64[ns]'), name=meta['index_name'])
+            frame = {}
+            for col in meta['columns']:
+                values = data['__col__' + col]
+                if '__null__' + col in data.files:
+                    values = values.astype(object)
+                    values[data['__null__' + col]] = np.nan
+                frame[col] = values
+    except (OSError, ValueError, KeyError):
+        return None
+    return pd.DataFrame(frame, index=index, columns=meta['columns'])
+
+
+def read_cached(fname: str, parser: Callable[[str], pd.DataFrame]) -> pd.DataFrame:
+    '''
+    Чтение файла гидропоста через кэш.
+    При попадании в кэш .csv не парсится, иначе вызывается parser(fname) и результат сохраняется в кэш.
+    Запись автоматически становится невалидной при изменении размера или времени изменения исходного файла
+    :param fname: str, путь до исходного .csv файла
+    :param parser: Callable, функция парсинга файла в датафрейм с DatetimeIndex
+    :return: pd.DataFrame
+    '''
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return parser(fname)
+    stamp = _source_stamp(fname, parser.__name__)
+
+    logger = logging.getLogger()
+    entry = _entry_path(cache_dir, stamp)
+    if os.path.exists(entry):
+        df = _load_frame(entry, stamp)
+        if df is not None:
+            os.utime(entry) # для вытеснения самых давно использованных записей
+            return df
+
+    df = parser(fname)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        _save_frame(df, entry, stamp)
+        evict_lru_files(cache_dir, HYDRO_CACHE_MAX_SIZE_MB, '.npz')
+    except OSError as e:
+        logger.warning(f'Could not write hydro cache {entry}: {e}')
+    return df
+
+
+def purge_cache() -> int:
+    '''
+    Полная очистка кэша распарсенных файлов гидропостов
+    :return: int, количество удаленных записей
+    '''
+    cache_dir = get_cache_dir()
+    if cache_dir is None or not os.path.isdir(cache_dir):
+        return 0
+    removed = 0
+    for _f in os.listdir(cache_dir):
+        if _f.endswith('.npz') or _f.endswith('.tmp'):
+            os.remove(os.path.join(cache_dir, _f))
+            removed += 1
+    return removed
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Управление кэшем распарсенных файлов гидропостов')
+    parser.add_argument('--purge', action='store_true', help='Удалить все записи из кэша')
+    args = parser.parse_args()
+
+    cache_dir = get_cache_dir()
+    if args.purge:
+        print(f'Removed {purge_cache()} entries from {cache_dir}')
+    elif cache_dir is not None and os.path.isdir(cache_dir):
+        sizes = [os.path.getsize(os.path.join(cache_dir, _f)) for _f in os.listdir(cache_dir) if _f.endswith('.npz')]
+        print(f'{cache_dir}: {len(sizes)} entries, {sum(sizes) / 1024 / 1024:.1f} MB')
+    else:
+        print('Hydro cache is empty or disabled')
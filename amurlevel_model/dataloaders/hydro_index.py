@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+import pandas as pd
+import numpy as np
+import os
+import json
+import tempfile
+import logging
+from typing import Callable, Union
+from datetime import date, datetime
+
+from ..utils.common import parse_dates, INVALID_DATE
+from .hydro_cache import read_cached
+
+INDEX_VERSION = 1 # версия формата индекса
+INDEX_STEP = 32 # в индекс попадает каждая INDEX_STEP-ая строка с валидной датой
+HEADER_LINES = 2 # количество строк заголовка в файлах с гидропостов
+
+
+def get_index_fname(fname: str) -> str:
+    '''
+    Путь до индекса (лежит рядом с исходным файлом)
+    :param fname: str, путь до исходного .csv файла
+    :return: str
+    '''
+    return fname + '.idx.npz'
+
+
+def _source_stamp(fname: str) -> dict:
+    '''
+    Размер и время изменения исходного файла - при их изменении индекс строится заново
+    '''
+    stat = os.stat(fname)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'version': INDEX_VERSION}
+
+
+def build_offset_index(fname: str, parser: Callable[[str], pd.DataFrame]) -> dict:
+    '''
+    Построение индекса дата -> смещение в байтах для .csv файла с гидропоста и сохранение его рядом с файлом
+    Даты берутся из первого поля каждой строки. Индекс применим, только если даты в файле не убывают
+    (строки с нераспарсенными датами при проверке игнорируются)
+    Также сохраняются типы колонок после полного парсинга, чтобы чтение окна давало те же типы
+    :param fname: str, путь до исходного .csv файла
+    :param parser: Callable, функция парсинга файла (parse_hydro_*_file)
+    :return: dict с индексом
+    '''
+    stamp = _source_stamp(fname)
+    with open(fname, 'rb') as f:
+        data = f.read()
+
+    line_starts = [0]
+    pos = data.find(b'\n')
+    while pos != -1:
+        line_starts.append(pos + 1)
+        pos = data.find(b'\n', pos + 1)
+    line_starts = np.array([start for start in line_starts if start < len(data)], dtype=np.int64)
+    line_starts = line_starts[HEADER_LINES:]
+
+    first_fields = [data[start:start + 32].split(b';', 1)[0].strip().strip(b'"').decode('ascii', errors='replace')
+                    for start in line_starts]
+    dates = parse_dates(first_fields).values.astype('datetime64[D]')
+    valid = dates != np.datetime64(INVALID_DATE, 'D')
+    monotonic = bool(np.all(np.diff(dates[valid].astype(np.int64)) >= 0))
+
+    sample = np.where(valid)[0][::INDEX_STEP]
+    dtypes = {col: str(dtype) for col, dtype in read_cached(fname, parser).dtypes.items()}
+    index = dict(stamp,
+                 monotonic=monotonic,
+                 data_start=int(line_starts[0]) if len(line_starts) > 0 else len(data),
+                 data_end=len(data),
+                 dates=dates[sample].astype(np.int64),
+                 offsets=line_starts[sample],
+                 dtypes=dtypes,
+                 parser=parser.__name__)
+
+    try:
+        meta = {key: value for key, value in index.items() if key not in ('dates', 'offsets')}
+        index_fname = get_index_fname(fname)
+        fd, tmp_fname = tempfile.mkstemp(dir=os.path.dirname(index_fname) or '.',
+                                         prefix=os.path.basename(index_fname) + '.', suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, dates=index['dates'], offsets=index['offsets'], meta=np.array(json.dumps(meta)))
+        os.replace(tmp_fname, index_fname)
+    except OSError as e:
+        logging.getLogger().warning(f'Could not save offset index for {fname}: {e}')
+    return index
+
+
+def load_offset_index(fname: str, parser: Callable[[str], pd.DataFrame]) -> dict:
+    '''
+    Чтение индекса для файла. Если индекса нет или исходный файл изменился - индекс строится заново
+    :param fname: str, путь до исходного .csv файла
+    :param parser: Callable, функция парсинга файла (parse_hydro_*_file)
+    :return: dict с индексом
+    '''
+    stamp = _source_stamp(fname)
+    try:
+        with np.load(get_index_fname(fname), allow_pickle=False) as data:
+            index = json.loads(str(data['meta']))
+            index['dates'] = data['dates']
+            index['offsets'] = data['offsets']
+        if all(index.get(key) == value for key, value in stamp.items()) and index['parser'] == parser.__name__:
+            return index
+    except (OSError, ValueError, KeyError):
+        pass
+    return build_offset_index(fname, parser)
+
+
+def read_hydro_window(fname: str, parser: Callable[..., pd.DataFrame],
+                      start_date: Union[str,date,datetime], end_date: Union[str,date,datetime]) -> pd.DataFrame:
+    '''
+    Чтение из файла только тех строк, которые могут попасть в интервал [start_date, end_date]
+    По индексу выбирается диапазон байт, который парсится тем же parser, что и весь файл.
+    Результат еще нужно отфильтровать по датам - в него могут попасть соседние строки.
+    Если даты в файле не упорядочены, читается весь файл (через кэш)
+    :param fname: str, путь до исходного .csv файла
+    :param parser: Callable, функция парсинга (parse_hydro_*_file), принимающая byte_range
+    :param start_date: str,datetime,date - начальная дата
+    :param end_date: str,datetime,date - конечная дата
+    :return: pd.DataFrame
+    '''
+    index = load_offset_index(fname, parser)
+    if not index['monotonic'] or pd.Timestamp(end_date) >= pd.Timestamp(INVALID_DATE):
+        return read_cached(fname, parser)
+
+    dates = index['dates'].astype('datetime64[D]')
+    start = np.datetime64(pd.Timestamp(start_date).date(), 'D')
+    end = np.datetime64(pd.Timestamp(end_date).date(), 'D')
+
+    # начинаем с последней точки индекса строго раньше start_date, заканчиваем на первой точке позже end_date
+    first = np.searchsorted(dates, start, side='left') - 1
+    last = np.searchsorted(dates, end, side='right')
+    start_offset = int(index['offsets'][first]) if first >= 0 else index['data_start']
+    end_offset = int(index['offsets'][last]) if last < len(dates) else index['data_end']
+
+    df = parser(fname, byte_range=(start_offset, max(start_offset, end_offset)))
+    return df.astype(index['dtypes'])
@@ -3,113 +3,271 @@
 import pandas as pd
 import numpy as np
 import os
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime,date
-from typing import Union
+from typing import Union, Optional, Iterator, Tuple, List
+from tqdm import tqdm
 
-from ..config import DATASETS_PATH,MAX_DATE
+from ..config import DATASETS_PATH,MAX_DATE,N_JOBS
+from ..utils.common import detect_encoding,interpolate_linear,get_n_jobs
+from .meteo_store import get_store_dir,source_stamp,write_station,read_station_meta,is_fresh,read_station
 
 
 # идентификаторы метеостанций и список полей, где плохая заполненность
 BAD_IDENTIFIER_COLS = {'4923811':['soilTemperature']}
 
 
-def read_history_meteo(start_date: Union[str,date,datetime] = '1980-01-01',
-                       end_date: Union[str,date,datetime]=MAX_DATE) -> pd.DataFrame:
+TIME_COLS = ['localYear', 'localMonth', 'localDay', 'localTimePeriod'] # поля с датой и сроком наблюдения
+
+METEO_COLS = ['cloudCoverTotal', 'pastWeather', 'presentWeather',
+              'windDirection', 'windSpeed', 'maximumWindGustSpeed',
+              'totalAccumulatedPrecipitation', 'soilTemperature', 'airTemperature',
+              'relativeHumidity', 'pressureReducedToMeanSeaLevel',
+              'pressure'] # метеорологические параметры из исходных данных
+
+CATEGORICAL_METEO_COLS = ['pastWeather', 'presentWeather', 'cloudCoverTotal'] # категориальные метео параметры
+
+BAD_QUALITY_CODES = [3, 4, 6, 7] # коды качества, при которых значение считаем недостоверным
+
+RESAMPLE_DICT = {
+    'cloudCoverTotal': 'max',
+    'pastWeather': 'max',
+    'presentWeather': 'max',
+    'windDirection': 'median',
+    'windSpeed': 'max',
+    'maximumWindGustSpeed': 'max',
+    'totalAccumulatedPrecipitation': 'sum',
+    'airTemperature_max': 'max',
+    'airTemperature_min': 'min',
+    'soilTemperature': 'mean',
+    'relativeHumidity': 'max',
+    'pressureReducedToMeanSeaLevel': 'mean',
+    'pressure': 'mean'
+} # агрегации при ресемплировании до суточных данных
+
+
+def parse_meteo_station(fname: str, identifier: str) -> pd.DataFrame:
     '''
-    Чтение всех исторических метео данных из meteo_new
+    Разбор файла одной метеостанции (один файл из meteo_new) в срочные данные без агрегации
     Все данные с недостоверным качеством заменяются на np.nan
+    :param fname: str, путь до файла
+    :param identifier: str, идентификатор метеостанции
+    :return: pd.DataFrame со сроками наблюдений (datetime и метео параметры), отсортированный по datetime
+    '''
+    meteo_cols = [col for col in METEO_COLS if col not in BAD_IDENTIFIER_COLS.get(identifier, [])]
+    quality_cols = [col + 'Quality' for col in meteo_cols]
+    encoding = detect_encoding(fname)
+    try:
+        part_meteo_df = pd.read_csv(fname, encoding=encoding, sep=',',
+                                    usecols=TIME_COLS + meteo_cols + quality_cols)
+    except UnicodeDecodeError:
+        part_meteo_df = pd.read_csv(fname, encoding='cp1251', sep=',',
+                                    usecols=TIME_COLS + meteo_cols + quality_cols)
+
+    # по температуре - берем и мин и макс
+    col = 'airTemperature'
+    part_meteo_df[col + '_min'] = part_meteo_df[col].copy()
+    part_meteo_df[col + '_minQuality'] = part_meteo_df[col + 'Quality'].copy()
+    part_meteo_df.rename(columns={col: col + '_max', col + 'Quality': col + '_maxQuality'}, inplace=True)
+    meteo_cols.remove(col)
+    meteo_cols.extend([col + '_min', col + '_max'])
+
+    part_meteo_df['datetime'] = pd.to_datetime(pd.DataFrame({
+        'year': part_meteo_df['localYear'].astype(np.int64),
+        'month': part_meteo_df['localMonth'].astype(np.int64),
+        'day': part_meteo_df['localDay'].astype(np.int64),
+        'hour': part_meteo_df['localTimePeriod'].astype(np.int64)}))
+
+    # для всех значений с сомнительным качеством - зануляем (сразу по всем полям)
+    part_meteo_df = part_meteo_df.sort_values('datetime', kind='mergesort')
+    bad_quality = np.isin(part_meteo_df[[col + 'Quality' for col in meteo_cols]].values.astype(np.int64),
+                          BAD_QUALITY_CODES)
+    part_meteo_df[meteo_cols] = part_meteo_df[meteo_cols].mask(bad_quality)
+    return part_meteo_df[['datetime'] + meteo_cols].reset_index(drop=True)
+
+
+def resample_meteo_station(part_meteo_df: pd.DataFrame, identifier: str,
+                           start_date: Union[str,date,datetime] = '1980-01-01',
+                           end_date: Union[str,date,datetime]=MAX_DATE) -> pd.DataFrame:
+    '''
+    Суточные данные метеостанции за интервал из срочных (см. parse_meteo_station)
+    Срочные данные обрезаются по интервалу до заполнения пропусков,
+    поэтому результат зависит только от наблюдений внутри [start_date, end_date]
     Пропуски для численных значений заменяются линейной интерполяцией
     Пропуски для категориальных значений заменяются по предыдущему и следующему значению
     Ресемплирование данных до суточных
+    :param part_meteo_df: pd.DataFrame, срочные данные (результат parse_meteo_station)
+    :param identifier: str, идентификатор метеостанции
     :param start_date: str,datetime,date - начальная дата, меньше которой данные выкидываем
     :param end_date: str,datetime,date - конечная дата, больше которой данные выкидываем
-    :return: pd.DataFrame с историческими данными метео
+    :return: pd.DataFrame с суточными данными метео
+    '''
+    meteo_cols = [col for col in part_meteo_df.columns if col != 'datetime']
+    part_meteo_df = part_meteo_df[(part_meteo_df['datetime'] >= start_date) &
+                                  (part_meteo_df['datetime'] <= end_date)].copy()
+
+    # делаем линейную интерполяцию для численных, для категориальных - ffill,bfill
+    categorical_cols = [col for col in meteo_cols if col in CATEGORICAL_METEO_COLS]
+    numerical_cols = [col for col in meteo_cols if col not in CATEGORICAL_METEO_COLS]
+    part_meteo_df[categorical_cols] = part_meteo_df[categorical_cols].fillna(method='ffill').fillna(method='bfill')
+    part_meteo_df[numerical_cols] = interpolate_linear(part_meteo_df[numerical_cols])
+
+    # ресемплирование
+    part_meteo_df.set_index('datetime', inplace=True)
+    for col in CATEGORICAL_METEO_COLS:
+        part_meteo_df[col] = part_meteo_df[col].round().astype(np.int64)
+
+    resample_dict = {col: agg for col, agg in RESAMPLE_DICT.items() if col in meteo_cols}
+    part_meteo_df = part_meteo_df.resample('1D').agg(resample_dict)
+    part_meteo_df.reset_index(inplace=True)
+    part_meteo_df['identifier'] = identifier
+    part_meteo_df.sort_values('datetime', inplace=True)
+    categorical_cols = [col for col in resample_dict if col in CATEGORICAL_METEO_COLS]
+    numerical_cols = [col for col in resample_dict if col not in CATEGORICAL_METEO_COLS]
+    part_meteo_df[categorical_cols] = part_meteo_df[categorical_cols].fillna(method='ffill').fillna(method='bfill')
+    part_meteo_df[numerical_cols] = interpolate_linear(part_meteo_df[numerical_cols])\
+                                                       .fillna(method='bfill').fillna(method='ffill')
+    return part_meteo_df
+
+
+def read_meteo_station(fname: str, identifier: str,
+                       start_date: Union[str,date,datetime] = '1980-01-01',
+                       end_date: Union[str,date,datetime]=MAX_DATE) -> pd.DataFrame:
+    '''
+    Чтение и обработка данных с одной метеостанции (один файл из meteo_new):
+    разбор срочных данных (parse_meteo_station) и ресемплирование до суточных за интервал (resample_meteo_station)
+    :param fname: str, путь до файла
+    :param identifier: str, идентификатор метеостанции
+    :param start_date: str,datetime,date - начальная дата, меньше которой данные выкидываем
+    :param end_date: str,datetime,date - конечная дата, больше которой данные выкидываем
+    :return: pd.DataFrame с суточными данными метео
     '''
+    return resample_meteo_station(parse_meteo_station(fname, identifier), identifier, start_date, end_date)
 
-    meteo_df = pd.DataFrame()
+
+def list_meteo_stations(stations: Optional[List[str]]=None) -> List[str]:
+    '''
+    Идентификаторы метеостанций, для которых есть файлы в meteo_new
+    :param stations: list, если задан - оставляем только эти станции
+    :return: list
+    '''
     meteo_dir = os.path.join(DATASETS_PATH,'meteo_new')
-    for _f in os.listdir(meteo_dir):
-        identifier = _f[0:-4]
-        if _f.endswith('.csv'):
-            time_cols = ['localYear' ,'localMonth' ,'localDay' ,'localTimePeriod']
-            meteo_cols = ['cloudCoverTotal' ,'pastWeather' ,'presentWeather',
-                          'windDirection' ,'windSpeed' ,'maximumWindGustSpeed',
-                          'totalAccumulatedPrecipitation' ,'soilTemperature' ,'airTemperature',
-                          'relativeHumidity' ,'pressureReducedToMeanSeaLevel',
-                          'pressure']
-            quality_cols = [col + 'Quality' for col in meteo_cols]
-            try:
-                part_meteo_df = pd.read_csv(os.path.join(meteo_dir,_f), sep=',',
-                            usecols=time_cols +meteo_cols +quality_cols)
-            except UnicodeDecodeError:
-                part_meteo_df = pd.read_csv(os.path.join(meteo_dir,_f), encoding='cp1251',sep=',',
-                            usecols=time_cols +meteo_cols +quality_cols)
-
-            for col in BAD_IDENTIFIER_COLS.get(identifier,[]):
-                meteo_cols.remove(col)
-                quality_cols.remove(col+'Quality')
-                part_meteo_df.drop([col,col+'Quality'],axis=1,inplace=True)
-
-            # по температуре - берем и мин и макс
-            # for col in ['airTemperature']:
-            col = 'airTemperature'
-            part_meteo_df[col + '_min'] = part_meteo_df[col].copy()
-            part_meteo_df[col + '_minQuality'] = part_meteo_df[col + 'Quality'].copy()
-            part_meteo_df.rename(columns={col :col + '_max' ,col + 'Quality' :col + '_maxQuality'} ,inplace=True)
-            meteo_cols.remove(col)
-            meteo_cols.extend([col + '_min' ,col + '_max'])
-
-            # для всех значений с сомнительным качеством - зануляем
-            part_meteo_df['datetime'] = pd.to_datetime(part_meteo_df.apply(lambda x: datetime(int(x['localYear']) ,int(x['localMonth']),
-                                                                      int(x['localDay']) ,int(x['localTimePeriod']))
-                                                   ,axis=1))
-            part_meteo_df = part_meteo_df[(part_meteo_df['datetime'] >= start_date) &
-                                          (part_meteo_df['datetime'] <= end_date)]
-            
-            # делаем линейную интерполяцию для численных, для категориальных - ffill,bfill
-            part_meteo_df.sort_values('datetime' ,inplace=True)
-            for col in meteo_cols:
-                bad_ind = part_meteo_df[part_meteo_df[col +'Quality'].astype(np.int).isin([3 ,4 ,6 ,7])].index
-                part_meteo_df.loc[bad_ind ,col] = np.nan
-                if col in ['pastWeather' ,'presentWeather' ,'cloudCoverTotal']:
-                    part_meteo_df[col] = part_meteo_df[col].fillna(method='ffill').fillna(method='bfill')
-                else:
-                    part_meteo_df[col] = part_meteo_df[col].interpolate(method='linear')
-            
-            # ресемплирование
-            part_meteo_df.set_index('datetime' ,inplace=True)
-
-            resample_dict = {
-                'cloudCoverTotal': 'max',
-                'pastWeather': 'max',
-                'presentWeather': 'max',
-                'windDirection': 'median',
-                'windSpeed': 'max',
-                'maximumWindGustSpeed': 'max',
-                'totalAccumulatedPrecipitation': 'sum',
-                'airTemperature_max': 'max',
-                'airTemperature_min': 'min',
-                'soilTemperature': 'mean',
-                'relativeHumidity': 'max',
-                'pressureReducedToMeanSeaLevel': 'mean',
-                'pressure': 'mean'
-            }
-            for col in ['cloudCoverTotal','pastWeather','presentWeather']:
-                part_meteo_df[col] = part_meteo_df[col].round().astype(np.int)
-
-            dict_keys = list(resample_dict.keys())
-            for col in dict_keys:
-                if col not in meteo_cols:
-                    del resample_dict[col]
-            part_meteo_df = part_meteo_df.resample('1D').agg(resample_dict)
-            part_meteo_df.reset_index(inplace=True)
-            part_meteo_df['identifier'] = identifier
-            part_meteo_df.sort_values('datetime' ,inplace=True)
-            for col in meteo_cols:
-                if col in ['pastWeather' ,'presentWeather' ,'cloudCoverTotal']:
-                    part_meteo_df[col] = part_meteo_df[col].fillna(method='ffill').fillna(method='bfill')
-                else:
-                    part_meteo_df[col] = part_meteo_df[col].interpolate(method='linear').fillna(method='bfill').fillna(method='ffill')
-            meteo_df = meteo_df.append(part_meteo_df)
+    identifiers = [_f[0:-4] for _f in os.listdir(meteo_dir) if _f.endswith('.csv')]
+    if stations is not None:
+        stations = set(stations)
+        identifiers = [identifier for identifier in identifiers if identifier in stations]
+    return identifiers
+
+
+def meteo_sources() -> List[str]:
+    '''
+    Директории, от содержимого которых зависит результат read_history_meteo (sources для StageCache):
+    исходные файлы meteo_new и хранилище метео
+    '''
+    sources = [os.path.join(DATASETS_PATH,'meteo_new')]
+    if get_store_dir() is not None:
+        sources.append(get_store_dir())
+    return sources
+
+
+def iter_meteo_stations(start_date: Union[str,date,datetime] = '1980-01-01',
+                        end_date: Union[str,date,datetime]=MAX_DATE,
+                        n_jobs: Optional[int]=N_JOBS,
+                        stations: Optional[List[str]]=None,
+                        hourly: bool=False) -> Iterator[Tuple[str, pd.DataFrame]]:
+    '''
+    Обработка всех файлов из meteo_new в n_jobs процессах (см. read_meteo_station)
+    Данные по станциям отдаются по мере готовности, а не в порядке файлов
+    :param start_date: str,datetime,date - начальная дата, меньше которой данные выкидываем
+    :param end_date: str,datetime,date - конечная дата, больше которой данные выкидываем
+    :param n_jobs: int, количество процессов, None - по количеству ядер, 1 - без распараллеливания
+    :param stations: list, если задан - обрабатываем только эти станции
+    :param hourly: bool, отдавать срочные данные за всю историю (parse_meteo_station), даты не используются
+    :return: генератор пар (идентификатор метеостанции, pd.DataFrame с суточными или срочными данными)
+    '''
+    meteo_dir = os.path.join(DATASETS_PATH,'meteo_new')
+    identifiers = list_meteo_stations(stations)
+    func, args = (parse_meteo_station, ()) if hourly else (read_meteo_station, (start_date, end_date))
+    n_jobs = min(get_n_jobs(n_jobs), len(identifiers))
+    if n_jobs <= 1:
+        for identifier in identifiers:
+            yield identifier, func(os.path.join(meteo_dir, identifier + '.csv'), identifier, *args)
+        return
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        futures = {executor.submit(func, os.path.join(meteo_dir, identifier + '.csv'), identifier, *args): identifier
+                   for identifier in identifiers}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+def ingest_meteo_store(stations: Optional[List[str]]=None, force: bool=False,
+                       n_jobs: Optional[int]=N_JOBS) -> List[str]:
+    '''
+    Загрузка разобранных срочных данных из meteo_new в хранилище (см. meteo_store, parse_meteo_station)
+    Станции разбираются за всю историю, загружаются только новые и изменившиеся файлы
+    :param stations: list, если задан - загружаем только эти станции
+    :param force: bool, перезаписать все станции, даже если они актуальны
+    :param n_jobs: int, количество процессов, None - по количеству ядер, 1 - без распараллеливания
+    :return: list, идентификаторы загруженных станций
+    '''
+    store_dir = get_store_dir()
+    if store_dir is None:
+        raise ValueError('METEO_STORE_DIR is not set')
+    meteo_dir = os.path.join(DATASETS_PATH,'meteo_new')
+    stamps = {identifier: source_stamp(os.path.join(meteo_dir, identifier + '.csv'))
+              for identifier in list_meteo_stations(stations)}
+    stale = [identifier for identifier, stamp in stamps.items()
+             if force or not is_fresh(read_station_meta(store_dir, identifier), stamp)]
+    for identifier, part_meteo_df in tqdm(iter_meteo_stations(n_jobs=n_jobs, stations=stale, hourly=True),
+                                          total=len(stale), desc='ingest meteo'):
+        write_station(store_dir, identifier, part_meteo_df, stamps[identifier])
+    return stale
+
+
+def read_history_meteo(start_date: Union[str,date,datetime] = '1980-01-01',
+                       end_date: Union[str,date,datetime]=MAX_DATE,
+                       stations: Optional[List[str]]=None,
+                       n_jobs: Optional[int]=N_JOBS, verbose: bool=True) -> pd.DataFrame:
+    '''
+    Чтение всех исторических метео данных из meteo_new (см. read_meteo_station)
+    Если станция загружена в хранилище (ingest_meteo_store) и исходный файл с тех пор не менялся,
+    читаются только файлы хранилища за нужные годы. Остальные станции обрабатываются из .csv параллельно,
+    результат не зависит от n_jobs.
+    В хранилище лежат срочные данные, они ресемплируются так же, как при чтении .csv (resample_meteo_station),
+    поэтому результат не зависит от того, загружена ли станция в хранилище
+    :param start_date: str,datetime,date - начальная дата, меньше которой данные выкидываем
+    :param end_date: str,datetime,date - конечная дата, больше которой данные выкидываем
+    :param stations: list, если задан - читаем только эти метеостанции
+    :param n_jobs: int, количество процессов, None - по количеству ядер, 1 - без распараллеливания
+    :param verbose: bool, показывать прогресс по станциям
+    :return: pd.DataFrame с историческими данными метео
+    '''
+    meteo_dir = os.path.join(DATASETS_PATH,'meteo_new')
+    identifiers = list_meteo_stations(stations)
+    if len(identifiers) == 0:
+        return pd.DataFrame()
+
+    parts = {}
+    store_dir = get_store_dir()
+    if store_dir is not None and os.path.isdir(store_dir):
+        for identifier in identifiers:
+            meta = read_station_meta(store_dir, identifier)
+            if is_fresh(meta, source_stamp(os.path.join(meteo_dir, identifier + '.csv'))):
+                parts[identifier] = resample_meteo_station(read_station(store_dir, identifier, meta,
+                                                                        start_date, end_date),
+                                                           identifier, start_date, end_date)
+        if len(parts) < len(identifiers):
+            logging.getLogger().warning(f'{len(identifiers) - len(parts)} meteo stations are missing or stale in '
+                                        f'{store_dir}, run python -m amurlevel_model.dataloaders.meteo_store --ingest')
+
+    stale = [identifier for identifier in identifiers if identifier not in parts]
+    for identifier, part_meteo_df in tqdm(iter_meteo_stations(start_date, end_date, n_jobs, stations=stale),
+                                          total=len(stale), disable=not verbose or len(stale) == 0,
+                                          desc='meteo stations'):
+        parts[identifier] = part_meteo_df
+    # объединяем в порядке файлов, чтобы порядок строк не зависел от порядка завершения процессов
+    meteo_df = pd.concat([parts[identifier] for identifier in identifiers])
     meteo_df.sort_values('datetime' ,inplace=True)
-    return meteo_df
\ No newline at end of file
+    return meteo_df
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+import pandas as pd
+import numpy as np
+import os
+import json
+import shutil
+from typing import Optional, Union
+from datetime import date, datetime
+
+from ..config import DATASETS_PATH, METEO_STORE_DIR
+
+STORE_VERSION = 2 # версия формата хранилища, при изменении обработки метео все станции нужно загрузить заново
+META_FNAME = '_meta.json' # файл с описанием станции в хранилище
+
+
+def get_store_dir() -> Optional[str]:
+    '''
+    Директория с хранилищем разобранных срочных метео данных
+    :return: str, путь до директории или None, если хранилище отключено
+    '''
+    if METEO_STORE_DIR is None:
+        return None
+    return os.path.join(DATASETS_PATH, METEO_STORE_DIR)
+
+
+def source_stamp(fname: str) -> dict:
+    '''
+    Размер и время изменения исходного файла метеостанции - при их изменении данные в хранилище устаревают
+    '''
+    stat = os.stat(fname)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'version': STORE_VERSION}
+
+
+def _atomic_savez(fname: str, **arrays) -> None:
+    '''
+    Запись .npz через временный файл, чтобы параллельное чтение не видело недописанный файл
+    '''
+    tmp_fname = f'{fname}.{os.getpid()}.tmp'
+    with open(tmp_fname, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_fname, fname)
+
+
+def write_station(store_dir: str, identifier: str, df: pd.DataFrame, stamp: dict) -> None:
+    '''
+    Запись срочных данных одной метеостанции в хранилище: по файлу .npz на каждый год,
+    колонки сохраняются как есть (с исходными типами), datetime - в int64
+    Описание станции (_meta.json) пишется последним, поэтому прерванная запись не будет считаться актуальной
+    :param store_dir: str, директория хранилища
+    :param identifier: str, идентификатор метеостанции
+    :param df: pd.DataFrame, результат parse_meteo_station
+    :param stamp: dict, см. source_stamp
+    '''
+    station_dir = os.path.join(store_dir, identifier)
+    if os.path.isdir(station_dir):
+        shutil.rmtree(station_dir)
+    os.makedirs(station_dir)
+
+    columns = [col for col in df.columns if col != 'identifier']
+    years = df['datetime'].dt.year.values
+    unique_years = np.unique(years)
+    for year in unique_years:
+        part = df[years == year]
+        arrays = {col: part[col].values for col in columns}
+        arrays['datetime'] = part['datetime'].values.astype('datetime64[ns]').astype(np.int64)
+        _atomic_savez(os.path.join(station_dir, f'{year}.npz'), **arrays)
+
+    meta = dict(stamp, columns=columns, all_columns=list(df.columns),
+                dtypes={col: str(df[col].dtype) for col in columns}, years=[int(year) for year in unique_years])
+    tmp_fname = os.path.join(station_dir, f'{META_FNAME}.{os.getpid()}.tmp')
+    with open(tmp_fname, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_fname, os.path.join(station_dir, META_FNAME))
+
+
+def read_station_meta(store_dir: str, identifier: str) -> Optional[dict]:
+    '''
+    Описание станции в хранилище
+    :return: dict или None, если станции в хранилище нет
+    '''
+    try:
+        with open(os.path.join(store_dir, identifier, META_FNAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def is_fresh(meta: Optional[dict], stamp: dict) -> bool:
+    '''
+    Актуальны ли данные станции в хранилище относительно исходного файла
+    '''
+    return meta is not None and all(meta.get(key) == value for key, value in stamp.items())
+
+
+def read_station(store_dir: str, identifier: str, meta: dict,
+                 start_date: Union[str,date,datetime], end_date: Union[str,date,datetime]) -> pd.DataFrame:
+    '''
+    Чтение из хранилища срочных данных метеостанции за интервал [start_date, end_date]
+    Открываются только файлы тех лет, которые пересекаются с интервалом
+    :param store_dir: str, директория хранилища
+    :param identifier: str, идентификатор метеостанции
+    :param meta: dict, описание станции (см. read_station_meta)
+    :param start_date: str,datetime,date - начальная дата
+    :param end_date: str,datetime,date - конечная дата
+    :return: pd.DataFrame в том же формате, что и parse_meteo_station
+    '''
+    start_year, end_year = pd.Timestamp(start_date).year, pd.Timestamp(end_date).year
+    parts = {col: [] for col in meta['columns']}
+    for year in meta['years']:
+        if year < start_year or year > end_year:
+            continue
+        with np.load(os.path.join(store_dir, identifier, f'{year}.npz'), allow_pickle=False) as data:
+            for col in meta['columns']:
+                parts[col].append(data[col])
+
+    frame = {col: np.concatenate(arrays) if len(arrays) > 0 else np.array([], dtype=meta['dtypes'][col])
+             for col, arrays in parts.items()}
+    frame['datetime'] = frame['datetime'].astype('datetime64[ns]')
+    df = pd.DataFrame(frame, columns=meta['columns'])
+    df['identifier'] = identifier
+    df = df[meta['all_columns']].astype(meta['dtypes'])
+    df = df[(df['datetime'] >= start_date) & (df['datetime'] <= end_date)]
+    return df.reset_index(drop=True)
+
+
+def purge_store() -> int:
+    '''
+    Полная очистка хранилища метео данных
+    :return: int, количество удаленных станций
+    '''
+    store_dir = get_store_dir()
+    if store_dir is None or not os.path.isdir(store_dir):
+        return 0
+    removed = 0
+    for _f in os.listdir(store_dir):
+        if os.path.isdir(os.path.join(store_dir, _f)):
+            shutil.rmtree(os.path.join(store_dir, _f))
+            removed += 1
+    return removed
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    from .meteo import ingest_meteo_store
+
+    parser = ArgumentParser(description='Управление хранилищем разобранных срочных метео данных')
+    parser.add_argument('--ingest', action='store_true',
+                        help='Загрузить в хранилище все новые и изменившиеся файлы из meteo_new')
+    parser.add_argument('--force', action='store_true', help='При загрузке перезаписать все станции')
+    parser.add_argument('--n_jobs', type=int, default=None, help='Количество процессов, по умолчанию - по количеству ядер')
+    parser.add_argument('--purge', action='store_true', help='Удалить все данные из хранилища')
+    args = parser.parse_args()
+
+    store_dir = get_store_dir()
+    if args.purge:
+        print(f'Removed {purge_store()} stations from {store_dir}')
+    if args.ingest:
+        ingested = ingest_meteo_store(force=args.force, n_jobs=args.n_jobs)
+        print(f'Ingested {len(ingested)} stations into {store_dir}')
+    if not args.purge and not args.ingest:
+        stations = [_f for _f in os.listdir(store_dir) if read_station_meta(store_dir, _f) is not None] \
+            if store_dir is not None and os.path.isdir(store_dir) else []
+        print(f'{store_dir}: {len(stations)} stations')
@@ -3,7 +3,96 @@
 import numpy as np
 import pandas as pd
 import math
-from typing import Tuple,List
+from typing import Tuple,List,Optional,Union,Dict
+
+
+def _window_sums(values: np.ndarray, lengths: np.ndarray, m: int) -> np.ndarray:
+    '''
+    Взвешенные суммы по скользящему окну из 2*m+2 элементов (крайние элементы окна с весом 0.5)
+    Для i >= 2*m-2 окно берется назад [i-2*m-2,i), для остальных - вперед [i,i+2*m+2)
+    Отрицательные индексы окна заворачиваются на конец ряда (как в исходной реализации)
+    Суммы считаются через кумулятивные суммы, т.е. за O(n) вместо O(n*T)
+    :param values: np.ndarray, шейп [n_rows, n_days], ряды, дополненные нулями до n_days
+    :param lengths: np.ndarray, шейп [n_rows], фактическая длина каждого ряда
+    :param m: int, полупериод окна
+    :return: np.ndarray, шейп [n_rows, n_days]
+    '''
+    n_rows, n_days = values.shape
+    width = 2 * m + 2
+    cumsum = np.zeros((n_rows, n_days + 1))
+    np.cumsum(values, axis=1, out=cumsum[:, 1:])
+
+    i = np.arange(n_days)
+    start = np.where(i >= 2 * m - 2, i - 2 * m - 2, i)
+    end = np.minimum(start + width, n_days)
+    rows = np.arange(n_rows)[:, None]
+
+    sums = cumsum[:, end] - cumsum[:, np.maximum(start, 0)]
+    last = values[:, np.maximum(end - 1, 0)]
+    first = values[:, np.maximum(start, 0)]
+
+    wrapped = start < 0
+    if wrapped.any():
+        wrap_start = lengths[:, None] + start[wrapped][None, :]
+        wrap_start = np.clip(wrap_start, 0, n_days)
+        sums[:, wrapped] += cumsum[rows, lengths[:, None]] - cumsum[rows, wrap_start]
+        first[:, wrapped] = values[rows, np.minimum(wrap_start, n_days - 1)]
+
+    return sums - 0.5 * first - 0.5 * last
+
+
+def demodul_batch(x: np.ndarray, T: float,
+                  lengths: Optional[np.ndarray]=None) -> Tuple[np.ndarray,np.ndarray,np.ndarray]:
+    '''
+    Векторизованный метод частотно-фазовой демодуляции сразу для нескольких рядов (например, по всем станциям)
+    Каждая строка x обрабатывается так же, как в demodul, но без циклов по дням
+    :param x: np.ndarray, шейп [n_rows, n_days] (или [n_days]), исходные ряды с наблюдениями
+    :param T: float, частота колебаний (1/период)
+    :param lengths: np.ndarray, шейп [n_rows] - длины рядов, если ряды разной длины и дополнены справа.
+                    Если None, то все ряды длины n_days
+    :return: tuple (шейпы как у x, за пределами длины ряда - np.nan):
+                  A - восстановленная динамическая амплитуда
+                  tetta - восстановленная динамическая фаза
+                  demodul - восстановленный ряд
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    squeeze = x.ndim == 1
+    x = np.atleast_2d(x)
+    n_rows, n_days = x.shape
+    if lengths is None:
+        lengths = np.full(n_rows, n_days)
+    lengths = np.asarray(lengths, dtype=np.int64)
+
+    m = int(1 / T)
+    omega = T
+    if n_days == 0:
+        empty = np.zeros((n_rows, 0))
+        return (empty[0], empty[0], empty[0]) if squeeze else (empty, empty.copy(), empty.copy())
+    short = (lengths > 0) & (lengths < 4 * m - 1)
+    if short.any():
+        raise ValueError(f'Series is too short for demodulation with T={m}: '
+                         f'need at least {4 * m - 1} values, got {lengths[short].min()}')
+
+    i = np.arange(n_days, dtype=np.float64)
+    valid = i[None, :] < lengths[:, None]
+    phase = omega * i * 2.0 * math.pi
+    sealevelcos = np.where(valid, x * np.cos(phase), 0.0)
+    sealevelsin = np.where(valid, x * np.sin(phase), 0.0)
+
+    macos = _window_sums(sealevelcos, lengths, m) / (2 * m + 1)
+    masin = _window_sums(sealevelsin, lengths, m) / (2 * m + 1)
+    A = 2 * np.sqrt(macos ** 2 + masin ** 2)
+    tetta = np.arctan2(masin, macos)
+    phase = i * 2 * math.pi * omega
+    demodul = 2.0 * masin * np.sin(phase) + 2.0 * macos * np.cos(phase)
+
+    A[~valid] = np.nan
+    tetta[~valid] = np.nan
+    demodul[~valid] = np.nan
+    if squeeze:
+        return A[0], tetta[0], demodul[0]
+    return A, tetta, demodul
+
 
 def demodul(x: List[float], T: int) -> Tuple[List[float],List[float],List[float]]:
     '''
@@ -18,50 +107,173 @@ def demodul(x: List[float], T: int) -> Tuple[List[float],List[float],List[float]
 
     demodul == A*sin(tetta+(pi*2*T/365))
     '''
-    m = int(1 / T)
-    omega = T
-    sealevelcos = np.array([x[i] * math.cos(omega * i * 2.0 * math.pi) for i in range(len(x))])
-    sealevelsin = np.array([x[i] * math.sin(omega * i * 2.0 * math.pi) for i in range(len(x))])
-    macos = np.zeros(len(x))
-    masin = np.zeros(len(x))
-    A = np.zeros(len(x))
-    demodul = np.zeros(len(x))
-    tetta = np.zeros(len(x))
-
-    for i in range(len(x)):
-        if i >= 2 * m - 2:
-            a = 0.0
-            b = 0.0
-            for n, k in enumerate(range(i - 2 * m - 2, i)):
-                if k == i - 2 * m - 2 or k == i - 1:
-                    a += 0.5 * sealevelcos[k]
-                    b += 0.5 * sealevelsin[k]
-                elif k < len(x):
-                    a += sealevelcos[k]
-                    b += sealevelsin[k]
-                elif k >= len(x):
-                    a += sealevelcos[k - len(x)]
-                    b += sealevelsin[k - len(x)]
-        else:
-            a = 0.0
-            b = 0.0
-            for n, k in enumerate(range(i, 2 * m + 2 + i)):
-                if k == i or k == i + 1 + 2 * m:
-                    a += 0.5 * sealevelcos[k]
-                    b += 0.5 * sealevelsin[k]
-                elif k >= 0:
-                    a += sealevelcos[k]
-                    b += sealevelsin[k]
-                elif k < 0:
-                    a += sealevelcos[len(x) + k]
-                    b += sealevelsin[len(x) + k]
-                    # print(n,2*m+1)
-        macos[i] = a / (2 * m + 1)
-        masin[i] = b / (2 * m + 1)
-        A[i] = 2 * math.sqrt(macos[i] ** 2 + masin[i] ** 2)
-        tetta[i] = np.arctan2(masin[i], macos[i])
-        demodul[i] = 2.0 * masin[i] * math.sin(i * 2 * math.pi * omega) + 2.0 * macos[i] * math.cos(i * 2 * math.pi * omega)
-    return A, tetta, demodul
+    return demodul_batch(np.asarray(x, dtype=np.float64), T)
+
+
+def _stations_matrix(x: pd.Series, identifiers: pd.Series) -> Tuple[np.ndarray,np.ndarray,np.ndarray,np.ndarray,np.ndarray,list]:
+    '''
+    Разворачивание длинного ряда в массив [станции, дни] с той же предобработкой, что в level_demodul_365:
+    вычитание среднего по станции, линейная интерполяция пропусков, заполнение краев
+    :param x: pd.Series - исходный ряд с наблюдениями из общего датафрейма
+    :param identifiers: pd.Series - идентификаторы станций для каждой строки x
+    :return: tuple:
+                  vals - массив [станции, дни], дополненный справа
+                  lengths - длина ряда по каждой станции
+                  codes, rank - номер станции и номер дня для каждой строки x
+                  means - среднее по станции для каждой строки x
+                  uniques - идентификаторы станций в порядке строк vals
+    '''
+    codes, uniques = pd.factorize(identifiers.values)
+    grp = x.groupby(codes)
+    rank = grp.cumcount().values
+    means = grp.transform('mean').values
+    lengths = np.bincount(codes, minlength=len(uniques))
+
+    vals = np.full((len(uniques), lengths.max() if len(lengths) > 0 else 0), np.nan)
+    vals[codes, rank] = x.values - means
+    vals = pd.DataFrame(vals).interpolate(method='linear', axis=1)\
+                             .fillna(method='bfill', axis=1).fillna(method='ffill', axis=1).values
+    return vals, lengths, codes, rank, means, list(uniques)
+
+
+def level_demodul_stations(x: pd.Series, identifiers: pd.Series, period: int) -> pd.Series:
+    '''
+    Применение метода демодуляции с периодом period сразу для всех станций
+    Эквивалентно x.groupby(identifiers).apply(level_demodul_365) (или level_demodul_121),
+    но все станции обрабатываются одним вызовом demodul_batch над массивом [станции, дни]
+    :param x: pd.Series - исходный ряд с наблюдениями из общего датафрейма
+    :param identifiers: pd.Series - идентификаторы станций для каждой строки x
+    :param period: int, период колебаний в днях
+    :return: pd.Series - восстановленный ряд с тем же индексом, что у x
+    '''
+    vals, lengths, codes, rank, means, _ = _stations_matrix(x, identifiers)
+    A, tetta, B = demodul_batch(vals, 1 / period, lengths)
+    return pd.Series(B[codes, rank] + means, index=x.index)
+
+
+class OnlineDemodulator():
+    '''
+    Инкрементальная демодуляция с периодом period для набора станций
+    Для каждой станции хранится кольцевой буфер x*cos, x*sin за последние 2*m+2 дней, их скользящие суммы,
+    номер следующего дня от начала ряда и среднее значение исторического ряда.
+    Добавление нового дня стоит O(1) на станцию, поэтому для ежедневного прогноза
+    не нужно заново демодулировать многолетнюю историю.
+
+    Значение за день i считается по окну [i-2*m-2,i) (как в demodul для i >= 2*m-2), т.е. не зависит от x[i].
+    Отличия от level_demodul_stations: среднее ряда фиксируется в момент fit,
+    а пропуски в новых днях заполняются последним известным значением (интерполяция требует будущих данных)
+
+    :param period: int, период колебаний в днях
+    '''
+    def __init__(self, period: int):
+        self.period = period
+        self.m = int(period)
+        self.width = 2 * self.m + 2
+        self.identifiers = []
+        self.means = np.zeros(0)
+        self.positions = np.zeros(0, dtype=np.int64)
+        self.last_values = np.zeros(0)
+        self.cos_buffer = np.zeros((0, self.width))
+        self.sin_buffer = np.zeros((0, self.width))
+        self.cos_sum = np.zeros(0)
+        self.sin_sum = np.zeros(0)
+        self.head = 0 # индекс самого старого элемента в кольцевом буфере
+        self.n_appended = 0
+
+    def fit(self, x: pd.Series, identifiers: pd.Series) -> pd.Series:
+        '''
+        Инициализация состояния по историческим данным
+        Результат совпадает с level_demodul_stations(x, identifiers, period)
+        :param x: pd.Series - исходный ряд с наблюдениями из общего датафрейма (по каждой станции упорядочен по дате)
+        :param identifiers: pd.Series - идентификаторы станций для каждой строки x
+        :return: pd.Series - восстановленный ряд с тем же индексом, что у x
+        '''
+        vals, lengths, codes, rank, means, identifiers = _stations_matrix(x, identifiers)
+        A, tetta, B = demodul_batch(vals, 1 / self.period, lengths)
+
+        n_stations = len(identifiers)
+        self.identifiers = [str(_id) for _id in identifiers]
+        self.means = np.full(n_stations, np.nan)
+        self.means[codes] = means
+        self.positions = lengths.astype(np.int64)
+        self.last_values = vals[np.arange(n_stations), np.maximum(lengths - 1, 0)]
+
+        # последние 2*m+2 значения каждого ряда, самый старый - в начале буфера
+        days = lengths[:, None] - self.width + np.arange(self.width)[None, :]
+        values = vals[np.arange(n_stations)[:, None], np.maximum(days, 0)]
+        values[days < 0] = 0.0
+        phase = 1 / self.period * days * 2.0 * math.pi
+        self.cos_buffer = values * np.cos(phase)
+        self.sin_buffer = values * np.sin(phase)
+        self.cos_sum = self.cos_buffer.sum(axis=1)
+        self.sin_sum = self.sin_buffer.sum(axis=1)
+        self.head = 0
+        self.n_appended = 0
+
+        return pd.Series(B[codes, rank] + means, index=x.index)
+
+    def append(self, values: Union[pd.Series, Dict[str, float]]) -> pd.Series:
+        '''
+        Добавление наблюдений за следующий день по всем станциям
+        :param values: pd.Series, dict - значения за день по идентификаторам станций.
+                       Отсутствующие станции и np.nan заменяются последним известным значением
+        :return: pd.Series - восстановленный ряд за этот день по идентификаторам станций
+        '''
+        values = pd.Series(values, dtype=np.float64).reindex(self.identifiers).values - self.means
+        values = np.where(np.isnan(values), self.last_values, values)
+
+        first = self.cos_buffer[:, self.head], self.sin_buffer[:, self.head]
+        last = self.cos_buffer[:, self.head - 1], self.sin_buffer[:, self.head - 1]
+        macos = (self.cos_sum - 0.5 * first[0] - 0.5 * last[0]) / (2 * self.m + 1)
+        masin = (self.sin_sum - 0.5 * first[1] - 0.5 * last[1]) / (2 * self.m + 1)
+        phase = self.positions * 2 * math.pi * (1 / self.period)
+        demodul = 2.0 * masin * np.sin(phase) + 2.0 * macos * np.cos(phase)
+
+        phase = 1 / self.period * self.positions * 2.0 * math.pi
+        new_cos = values * np.cos(phase)
+        new_sin = values * np.sin(phase)
+        self.cos_sum += new_cos - self.cos_buffer[:, self.head]
+        self.sin_sum += new_sin - self.sin_buffer[:, self.head]
+        self.cos_buffer[:, self.head] = new_cos
+        self.sin_buffer[:, self.head] = new_sin
+        self.head = (self.head + 1) % self.width
+        self.positions += 1
+        self.last_values = values
+
+        # раз в полный оборот буфера пересчитываем суммы, чтобы не копилась ошибка округления
+        self.n_appended += 1
+        if self.n_appended % self.width == 0:
+            self.cos_sum = self.cos_buffer.sum(axis=1)
+            self.sin_sum = self.sin_buffer.sum(axis=1)
+
+        return pd.Series(demodul + self.means, index=self.identifiers)
+
+    def save(self, fname: str) -> None:
+        '''
+        Сохранение состояния в .npz файл
+        :param fname: str, путь до файла
+        '''
+        np.savez(fname, period=self.period, identifiers=np.array(self.identifiers, dtype=str),
+                 means=self.means, positions=self.positions, last_values=self.last_values,
+                 cos_buffer=self.cos_buffer, sin_buffer=self.sin_buffer,
+                 cos_sum=self.cos_sum, sin_sum=self.sin_sum,
+                 head=self.head, n_appended=self.n_appended)
+
+    @classmethod
+    def load(cls, fname: str) -> 'OnlineDemodulator':
+        '''
+        Восстановление состояния из .npz файла, сохраненного методом save
+        :param fname: str, путь до файла
+        :return: OnlineDemodulator
+        '''
+        with np.load(fname) as state:
+            demodulator = cls(int(state['period']))
+            demodulator.identifiers = [str(_id) for _id in state['identifiers']]
+            for attr in ['means', 'positions', 'last_values', 'cos_buffer', 'sin_buffer', 'cos_sum', 'sin_sum']:
+                setattr(demodulator, attr, state[attr].copy())
+            demodulator.head = int(state['head'])
+            demodulator.n_appended = int(state['n_appended'])
+        return demodulator
 
 
 def level_demodul_365(x: pd.Series) -> pd.Series:
@@ -83,4 +295,4 @@ def level_demodul_121(x: List[float]) -> pd.Series:
     '''
     vals = (x - x.mean()).interpolate(method='linear').fillna(method='bfill').fillna(method='ffill').values
     A, tetta, B = demodul(vals, 1 / 121)
-    return pd.Series(B + x.mean(), index=x.index)
\ No newline at end of file
+    return pd.Series(B + x.mean(), index=x.index)
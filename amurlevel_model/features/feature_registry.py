@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+import pandas as pd
+import numpy as np
+import re
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .demodulation import level_demodul_stations
+from .kernels import StationIndex, day_of_year_angle, days_without_precipitation, shift_grouped, \
+    rolling_days_mean, rolling_rows_mean, past_year_positions, take_positions
+
+
+class FeatureFamily():
+    '''
+    Описание семейства признаков: регулярное выражение для названий признаков, функция, возвращающая
+    входные колонки для конкретного признака, и функция расчета.
+    compute(columns, index, match) возвращает значения признака для всех строк (см. FeatureColumns, StationIndex)
+    '''
+
+    def __init__(self, pattern: str, inputs: Callable[[re.Match], List[str]],
+                 compute: Callable[['FeatureColumns', StationIndex, re.Match], np.ndarray]):
+        self.pattern = re.compile(pattern)
+        self.inputs = inputs
+        self.compute = compute
+
+    def match(self, name: str) -> Optional[re.Match]:
+        return self.pattern.fullmatch(name)
+
+
+class FeatureColumns():
+    '''
+    Доступ к колонкам исходного датафрейма и уже посчитанным признакам по названию (как к датафрейму)
+    '''
+
+    def __init__(self, df: pd.DataFrame):
+        self.df = df
+        self.new = {}
+
+    def __getitem__(self, name: str) -> pd.Series:
+        if name in self.new:
+            return pd.Series(self.new[name], index=self.df.index, name=name)
+        return self.df[name]
+
+
+def _sin_cos_day_of_year(df: FeatureColumns, index: StationIndex, match: re.Match) -> np.ndarray:
+    func = np.sin if match.group('func') == 'sin' else np.cos
+    return func(day_of_year_angle(index.dates))
+
+
+def _perc_days(df: FeatureColumns, index: StationIndex, match: re.Match) -> np.ndarray:
+    return days_without_precipitation(df['totalAccumulatedPrecipitation'].values, index)
+
+
+def _shift(df: FeatureColumns, index: StationIndex, match: re.Match) -> np.ndarray:
+    return shift_grouped(df[match.group('col')].values, index, int(match.group('shift')))
+
+
+def _accumulate(df: FeatureColumns, index: StationIndex, match: re.Match) -> np.ndarray:
+    # среднее за acc дней (по датам, включая текущий день)
+    return rolling_days_mean(df[match.group('col')].values, index, int(match.group('acc')))
+
+
+def _demodule_365(df: FeatureColumns, index: StationIndex, match: re.Match) -> np.ndarray:
+    return level_demodul_stations(df['shift_10_days_sealevel_max'], df['identifier'], 365)
+
+
+def _demodule_121(df: FeatureColumns, index: StationIndex, match: re.Match) -> np.ndarray:
+    return level_demodul_stations(df['shift_10_days_sealevel_max'] - df['demodule_365_sealevel_max'],
+                                  df['identifier'], 121)
+
+
+def _demodule_diff(df: FeatureColumns, index: StationIndex, match: re.Match) -> np.ndarray:
+    return (df['shift_10_days_sealevel_max'] - df['demodule_365_sealevel_max'] -
+            df['demodule_121_sealevel_max'] + df['shift_10_days_sealevel_max'].mean()).values
+
+
+def _past_year_3d(df: FeatureColumns, index: StationIndex, match: re.Match) -> np.ndarray:
+    # прошлогодний уровень, усредненный за три дня
+    return take_positions(rolling_rows_mean(df['sealevel_max'].values, index, 3), past_year_positions(index))
+
+
+def _past_year(df: FeatureColumns, index: StationIndex, match: re.Match) -> np.ndarray:
+    return take_positions(df['sealevel_max'].values, past_year_positions(index))
+
+
+# все семейства признаков. Признаки, не подошедшие ни под одно семейство, берутся из исходных данных как есть
+FEATURE_REGISTRY = [
+    FeatureFamily(r'(?P<func>sin|cos)_day_of_year', lambda m: ['date'], _sin_cos_day_of_year),
+    FeatureFamily(r'perc_days', lambda m: ['totalAccumulatedPrecipitation'], _perc_days),
+    FeatureFamily(r'shift_(?P<shift>\d+)_days_(?P<col>.+)', lambda m: [m.group('col')], _shift),
+    FeatureFamily(r'accumulate_(?P<acc>\d+)_days_(?P<col>.+)_sum', lambda m: [m.group('col')], _accumulate),
+    FeatureFamily(r'demodule_365_sealevel_max', lambda m: ['shift_10_days_sealevel_max'], _demodule_365),
+    FeatureFamily(r'demodule_121_sealevel_max', lambda m: ['shift_10_days_sealevel_max', 'demodule_365_sealevel_max'],
+                  _demodule_121),
+    FeatureFamily(r'demodule_diff', lambda m: ['shift_10_days_sealevel_max', 'demodule_365_sealevel_max',
+                                               'demodule_121_sealevel_max'], _demodule_diff),
+    FeatureFamily(r'past_year_sealevel_max_3D', lambda m: ['sealevel_max'], _past_year_3d),
+    FeatureFamily(r'past_year_sealevel_max', lambda m: ['sealevel_max'], _past_year),
+]
+
+
+def find_family(name: str) -> Tuple[Optional[FeatureFamily], Optional[re.Match]]:
+    '''
+    Поиск семейства, к которому относится признак
+    :param name: str, название признака (без идентификатора станции)
+    :return: (семейство, результат сопоставления) или (None, None) для исходных колонок
+    '''
+    for family in FEATURE_REGISTRY:
+        match = family.match(name)
+        if match is not None:
+            return family, match
+    return None, None
+
+
+def split_station_features(names: List[str], stations: Tuple[str, ...]) -> Dict[str, List[str]]:
+    '''
+    Разбор финальных названий признаков вида {признак}_{станция}
+    :param names: list, финальные названия (например, NUMERICAL_FEATURES)
+    :param stations: tuple, допустимые идентификаторы станций
+    :return: dict, признак -> список станций, для которых он нужен (в порядке names)
+    '''
+    plan = {}
+    for name in names:
+        feature, station = name.rsplit('_', 1)
+        if station not in stations:
+            raise ValueError(f'Feature {name} does not end with a station identifier from ALL_STATIONS')
+        plan.setdefault(feature, []).append(station)
+    return plan
+
+
+def resolve_features(features: List[str], columns: List[str]) -> List[str]:
+    '''
+    Порядок расчета признаков с учетом зависимостей между ними
+    :param features: list, признаки, которые нужны в датасете
+    :param columns: list, колонки исходного датафрейма
+    :return: list, признаки, которые нужно посчитать, в порядке расчета
+    '''
+    order, visiting = [], set()
+
+    def visit(name: str):
+        if name in order or (name in columns and find_family(name)[0] is None):
+            return
+        family, match = find_family(name)
+        if family is None:
+            raise ValueError(f'Unknown feature {name}: no such column and no feature family in FEATURE_REGISTRY')
+        if name in visiting:
+            raise ValueError(f'Cyclic dependency for feature {name}')
+        visiting.add(name)
+        for input_name in family.inputs(match):
+            visit(input_name)
+        visiting.discard(name)
+        order.append(name)
+
+    for name in features:
+        visit(name)
+    return order
+
+
+def compute_features(df: pd.DataFrame, features: List[str],
+                     overrides: Optional[Dict[str, Callable[[FeatureColumns, StationIndex, re.Match], np.ndarray]]]=None
+                     ) -> pd.DataFrame:
+    '''
+    Расчет признаков в заданном порядке (см. resolve_features)
+    :param df: pd.DataFrame, гидро-метео данные, отсортированные по станции и дате, без дубликатов
+    :param features: list, признаки в порядке расчета
+    :param overrides: dict, признак -> функция расчета вместо функции из семейства
+                      (например, онлайн-демодуляция в хранилище признаков)
+    :return: pd.DataFrame с добавленными признаками
+    '''
+    index = StationIndex(df['identifier'].values, df['date'])
+    # новые колонки копим отдельно и добавляем в датафрейм одним concat
+    columns = FeatureColumns(df)
+    overrides = overrides or {}
+    for name in features:
+        family, match = find_family(name)
+        compute = overrides.get(name, family.compute)
+        columns.new[name] = np.asarray(compute(columns, index, match))
+    return pd.concat([df, pd.DataFrame(columns.new, index=df.index)], axis=1)
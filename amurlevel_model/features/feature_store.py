@@ -0,0 +1,447 @@
+# -*- coding: utf-8 -*-
+
+import pandas as pd
+import numpy as np
+import os
+import re
+import copy
+import json
+import shutil
+import logging
+from argparse import ArgumentParser
+from datetime import timedelta
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+
+from .amur_features import dataset_plan, prepare_hydro, build_feature_tensor
+from .feature_registry import resolve_features, compute_features, FeatureColumns
+from .kernels import StationIndex
+from .demodulation import OnlineDemodulator
+from ..config import DATASETS_PATH, FEATURE_STORE_DIR, FEATURE_STORE_HISTORY_DAYS
+from ..utils.normalizer import Normalizer, get_normalizer
+
+FEATURE_STORE_VERSION = 1 # версия формата хранилища признаков
+
+# признаки демодуляции считаются по состоянию OnlineDemodulator, вход - уровень 10 дней назад
+DEMODUL_FEATURES = ('demodule_365_sealevel_max', 'demodule_121_sealevel_max', 'demodule_diff')
+DEMODUL_INPUT = 'shift_10_days_sealevel_max'
+DEMODUL_LAG = 10
+PAST_YEAR_DAYS = 367 # сколько дней истории нужно для прошлогодних признаков (год и день для среднего за 3 дня)
+
+
+def get_feature_store_dir() -> Optional[str]:
+    '''
+    Директория хранилища признаков
+    :return: str, путь до директории или None, если хранилище отключено
+    '''
+    if FEATURE_STORE_DIR is None:
+        return None
+    return os.path.join(DATASETS_PATH, FEATURE_STORE_DIR)
+
+
+def _atomic_write(fname: str, write) -> None:
+    '''
+    Запись во временный файл и переименование, чтобы читатели не видели недописанный файл
+    :param write: Callable, функция записи, принимает путь до временного файла
+    '''
+    root, ext = os.path.splitext(fname)
+    tmp_fname = f'{root}.{os.getpid()}.tmp{ext}'
+    write(tmp_fname)
+    os.replace(tmp_fname, fname)
+
+
+def observed_date(long_df: pd.DataFrame) -> pd.Timestamp:
+    '''
+    Последняя дата, до которой уровень воды известен по всем станциям
+    (минимум по станциям из последней даты с непустым sealevel_max)
+    '''
+    last = long_df[long_df['sealevel_max'].notnull()].groupby('identifier')['date'].max()
+    return last.min() if len(last) > 0 else long_df['date'].min() - timedelta(1)
+
+
+class FeatureStore():
+    '''
+    Хранилище готовых строк датасета make_dataset по датам (сырые и нормализованные значения).
+    На диске:
+        rows/{год}.npz - даты, сырые и нормализованные строки широкого датафрейма за год
+        history.pkl - последние FEATURE_STORE_HISTORY_DAYS дней длинного гидро-метео датафрейма
+        demodul_365.npz, demodul_121.npz - состояние OnlineDemodulator на дату demodul_date
+        meta.json - колонки, даты, отпечаток статистики нормализации (пишется последним)
+
+    Строки, начиная с provisional_date (пропуски в конце рядов заполнены последним значением),
+    считаются предварительными и пересчитываются при следующем append_days.
+
+    append_days пересчитывает признаки только для хвоста: окно истории покрывает сдвиги на 30 дней,
+    средние за 45 дней и прошлогодние значения, демодуляция продолжается с сохраненного состояния.
+    Отличия от make_dataset по всей истории: пропуски в конце ряда заполняются последним значением
+    (будущих данных для интерполяции нет), среднее для демодуляции фиксируется при build,
+    количество дней без осадков считается в пределах окна истории
+    '''
+
+    def __init__(self, store_dir: Optional[str]=None, asunp=None, asunp_hydro=None):
+        '''
+        :param store_dir: str, директория хранилища, по умолчанию - get_feature_store_dir()
+        :param asunp: GeoDataFrame, все станции asunp (для append_days). Если None, то выгружается по API
+        :param asunp_hydro: GeoDataFrame, гидростанции asunp (для append_days). Если None, то выгружается по API
+        '''
+        self.store_dir = store_dir if store_dir is not None else get_feature_store_dir()
+        if self.store_dir is None:
+            raise ValueError('Feature store is disabled (FEATURE_STORE_DIR is None)')
+        self.asunp = asunp
+        self.asunp_hydro = asunp_hydro
+        self.meta = self._read_meta()
+
+    def _path(self, *parts: str) -> str:
+        return os.path.join(self.store_dir, *parts)
+
+    def _read_meta(self) -> Optional[dict]:
+        try:
+            with open(self._path('meta.json'), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return meta if meta.get('version') == FEATURE_STORE_VERSION else None
+
+    def _write_meta(self) -> None:
+        def write(fname):
+            with open(fname, 'w', encoding='utf-8') as f:
+                json.dump(self.meta, f, ensure_ascii=False)
+        _atomic_write(self._path('meta.json'), write)
+
+    @staticmethod
+    def _date_str(value: Optional[pd.Timestamp]) -> Optional[str]:
+        return None if value is None else str(pd.Timestamp(value).date())
+
+    def exists(self) -> bool:
+        return self.meta is not None
+
+    @property
+    def columns(self) -> List[str]:
+        return self.meta['columns']
+
+    @property
+    def last_date(self) -> pd.Timestamp:
+        return pd.Timestamp(self.meta['last_date'])
+
+    @property
+    def observed_date(self) -> pd.Timestamp:
+        return pd.Timestamp(self.meta['observed_date'])
+
+    # ------- нормализация
+
+    @staticmethod
+    def _fingerprint(normalizer: Optional[Normalizer]) -> Optional[str]:
+        return None if normalizer is None else normalizer.fingerprint
+
+    def _normalizer(self) -> Optional[Normalizer]:
+        '''
+        Нормализатор для колонок хранилища (колонки не из NUMERICAL_FEATURES не меняются)
+        :return: Normalizer или None, если статистики нет
+        '''
+        try:
+            return get_normalizer(self.columns)
+        except (OSError, ValueError) as e:
+            logging.getLogger().warning(f'No normalizer stats, normalized rows are not stored: {e}')
+            return None
+
+    # ------- строки датасета
+
+    def _years(self) -> List[int]:
+        return sorted(int(_f[:-4]) for _f in os.listdir(self._path('rows')) if re.fullmatch(r'\d+\.npz', _f)) \
+            if os.path.isdir(self._path('rows')) else []
+
+    def _read_year(self, year: int) -> Optional[Dict[str, np.ndarray]]:
+        fname = self._path('rows', f'{year}.npz')
+        if not os.path.exists(fname):
+            return None
+        with np.load(fname, allow_pickle=False) as data:
+            return {key: data[key] for key in data.files}
+
+    def _write_year(self, year: int, data: Dict[str, np.ndarray]) -> None:
+        os.makedirs(self._path('rows'), exist_ok=True)
+        _atomic_write(self._path('rows', f'{year}.npz'), lambda fname: np.savez(fname, **data))
+
+    def _write_rows(self, frame: pd.DataFrame, normalizer: Optional[Normalizer]) -> None:
+        '''
+        Запись строк в хранилище: строки за те же даты заменяются
+        :param frame: pd.DataFrame, колонка date и колонки self.columns
+        :param normalizer: результат _normalizer
+        '''
+        dates = frame['date'].values.astype('datetime64[D]')
+        raw = frame[self.columns].to_numpy(dtype=np.float32)
+        years = dates.astype('datetime64[Y]').astype(np.int64) + 1970
+        for year in np.unique(years):
+            in_year = years == year
+            data = {'dates': dates[in_year], 'raw': raw[in_year]}
+            old = self._read_year(int(year))
+            if old is not None:
+                keep = ~np.isin(old['dates'], data['dates'])
+                data = {key: np.concatenate([old[key][keep], data[key]]) for key in ['dates', 'raw']}
+                order = np.argsort(data['dates'], kind='stable')
+                data = {key: value[order] for key, value in data.items()}
+            if normalizer is not None:
+                data['normalized'] = normalizer(data['raw'])
+            self._write_year(int(year), data)
+
+    def refresh_normalized(self) -> None:
+        '''
+        Пересчет нормализованных строк (например, после обновления mean_std_stats.json)
+        '''
+        normalizer = self._normalizer()
+        for year in self._years():
+            data = self._read_year(year)
+            data.pop('normalized', None)
+            if normalizer is not None:
+                data['normalized'] = normalizer(data['raw'])
+            self._write_year(year, data)
+        self.meta['stats'] = self._fingerprint(normalizer)
+        self._write_meta()
+
+    def read(self, start_date=None, end_date=None, normalized: bool=False) -> pd.DataFrame:
+        '''
+        Строки датасета за период [start_date, end_date) в формате make_dataset
+        :param start_date: date,str - начало периода, None - с начала хранилища
+        :param end_date: date,str - конец периода (не включая), None - до конца хранилища
+        :param normalized: bool, если True - значения NUMERICAL_FEATURES нормализованы
+        :return: pd.DataFrame с колонкой date и колонками {признак}_{станция}
+        '''
+        if not self.exists():
+            raise FileNotFoundError(f'There is no feature store in {self.store_dir}')
+        if normalized and self.meta.get('stats') != self._fingerprint(self._normalizer()):
+            self.refresh_normalized()
+        key = 'normalized' if normalized else 'raw'
+        start = pd.Timestamp(start_date) if start_date is not None else None
+        end = pd.Timestamp(end_date) if end_date is not None else None
+
+        parts, dates = [], []
+        for year in self._years():
+            if (start is not None and year < start.year) or (end is not None and year > end.year):
+                continue
+            data = self._read_year(year)
+            if key not in data:
+                raise ValueError('There are no normalized rows in feature store (no normalizer stats)')
+            mask = np.ones(len(data['dates']), dtype=bool)
+            if start is not None:
+                mask &= data['dates'] >= np.datetime64(start, 'D')
+            if end is not None:
+                mask &= data['dates'] < np.datetime64(end, 'D')
+            parts.append(data[key][mask])
+            dates.append(data['dates'][mask])
+
+        values = np.concatenate(parts) if parts else np.zeros((0, len(self.columns)), dtype=np.float32)
+        frame = pd.DataFrame(values, columns=self.columns, copy=False)
+        frame['date'] = pd.DatetimeIndex(np.concatenate(dates).astype('datetime64[ns]') if dates else [])
+        return frame
+
+    # ------- история и состояние демодуляции
+
+    def _read_history(self) -> pd.DataFrame:
+        return pd.read_pickle(self._path('history.pkl'))
+
+    def _write_history(self, history: pd.DataFrame) -> None:
+        _atomic_write(self._path('history.pkl'), lambda fname: history.to_pickle(fname))
+
+    def _read_demodulators(self) -> Tuple[OnlineDemodulator, OnlineDemodulator]:
+        return (OnlineDemodulator.load(self._path('demodul_365.npz')),
+                OnlineDemodulator.load(self._path('demodul_121.npz')))
+
+    def _write_demodulators(self, demodulators: Tuple[OnlineDemodulator, OnlineDemodulator]) -> None:
+        for demodulator in demodulators:
+            _atomic_write(self._path(f'demodul_{demodulator.period}.npz'), demodulator.save)
+
+    def _online_demodulation(self, state: dict, columns: FeatureColumns, index: StationIndex) -> Dict[str, np.ndarray]:
+        '''
+        Признаки демодуляции для дней после state['date'] по состоянию OnlineDemodulator
+        Состояние на дату state['snapshot_date'] сохраняется в state['snapshot']
+        Для строк не позже state['date'] - значения из хранилища, чтобы пропуски новых дней
+        заполнялись в fill_missing по ним (как в make_dataset), а не оставались np.nan
+        '''
+        shifted = columns[DEMODUL_INPUT].values
+        identifiers = columns['identifier'].values
+        result = {name: np.full(index.n_rows, np.nan) for name in DEMODUL_FEATURES}
+        stored_rows = np.where(index.days <= np.datetime64(state['date'], 'D').astype(np.int64))[0]
+        if len(stored_rows) > 0:
+            stored = self.read(start_date=index.dates.min(), end_date=state['date'] + timedelta(1))
+            positions = pd.DatetimeIndex(stored['date']).get_indexer(index.dates[stored_rows])
+            for name in DEMODUL_FEATURES:
+                for identifier in np.unique(identifiers[stored_rows]):
+                    column = f'{name}_{identifier}'
+                    rows = (identifiers[stored_rows] == identifier) & (positions >= 0)
+                    if column in stored.columns and rows.any():
+                        result[name][stored_rows[rows]] = stored[column].values[positions[rows]]
+        demodul_365, demodul_121 = state['demodulators']
+        for day in pd.date_range(state['date'] + timedelta(1), index.dates.max(), freq='1D'):
+            rows = np.where(index.days == day.to_datetime64().astype('datetime64[D]').astype(np.int64))[0]
+            values = pd.Series(shifted[rows], index=identifiers[rows], dtype=np.float64)
+            values = values.reindex(demodul_365.identifiers)
+            level_365 = demodul_365.append(values)
+            level_121 = demodul_121.append(values - level_365)
+            diff = values - level_365 - level_121 + state['mean']
+            for name, series in zip(DEMODUL_FEATURES, [level_365, level_121, diff]):
+                result[name][rows] = series.reindex(identifiers[rows]).values
+            if day == state['snapshot_date']:
+                state['snapshot'] = (copy.deepcopy(demodul_365), copy.deepcopy(demodul_121))
+        return result
+
+    def _demodulated(self, state: dict, name: str, columns: FeatureColumns, index: StationIndex,
+                     match: re.Match) -> np.ndarray:
+        '''
+        Функция расчета признака демодуляции для compute_features: все три признака считаются при первом вызове
+        '''
+        if 'result' not in state:
+            state['result'] = self._online_demodulation(state, columns, index)
+        return state['result'][name]
+
+    # ------- построение и дополнение
+
+    def build(self, hydro_df: pd.DataFrame) -> pd.DataFrame:
+        '''
+        Построение хранилища с нуля по длинному гидро-метео датафрейму (результат merge_hydro_meteo)
+        :param hydro_df: pd.DataFrame, гидро-метео данные за всю историю (для демодуляции нужно больше 4 лет)
+        :return: pd.DataFrame, записанные строки
+        '''
+        logger = logging.getLogger()
+        plan = dataset_plan()
+        history = hydro_df.sort_values(['identifier', 'date']).drop_duplicates(['identifier', 'date'], keep='last')
+        long_df = prepare_hydro(history)
+        to_compute = resolve_features(list(plan), list(long_df.columns))
+        long_df = compute_features(long_df, to_compute)
+        tensor, columns = build_feature_tensor(long_df, plan)
+        frame = tensor.to_frame(columns)
+
+        last_date = frame['date'].max()
+        observed = observed_date(long_df)
+        meta = {'version': FEATURE_STORE_VERSION, 'columns': columns, 'last_date': str(last_date.date()),
+                'observed_date': str(observed.date()), 'demodul_date': None, 'demodul_mean': None,
+                'provisional_date': self._date_str(tensor.filled_from)}
+
+        shutil.rmtree(self.store_dir, ignore_errors=True)
+        os.makedirs(self.store_dir)
+        if DEMODUL_FEATURES[0] in to_compute:
+            # состояние демодуляции - на дату, после которой вход демодуляции еще может измениться
+            demodul_date = min(observed + timedelta(DEMODUL_LAG), last_date)
+            stable = long_df[long_df['date'] <= demodul_date]
+            demodul_365, demodul_121 = OnlineDemodulator(365), OnlineDemodulator(121)
+            level_365 = demodul_365.fit(stable[DEMODUL_INPUT], stable['identifier'])
+            demodul_121.fit(stable[DEMODUL_INPUT] - level_365, stable['identifier'])
+            self._write_demodulators((demodul_365, demodul_121))
+            meta['demodul_date'] = str(demodul_date.date())
+            meta['demodul_mean'] = float(long_df[DEMODUL_INPUT].mean())
+
+        self.meta = meta
+        normalizer = self._normalizer()
+        self._write_rows(frame, normalizer)
+        self._write_history(history[history['date'] > last_date - timedelta(FEATURE_STORE_HISTORY_DAYS)])
+        self.meta['stats'] = self._fingerprint(normalizer)
+        self._write_meta()
+        logger.info(f'Feature store built: {len(frame)} days, {len(columns)} columns, '
+                    f'observed up to {meta["observed_date"]}')
+        return frame
+
+    def append_merged(self, new_df: pd.DataFrame) -> pd.DataFrame:
+        '''
+        Добавление новых (или обновленных) дней длинного гидро-метео датафрейма и пересчет хвоста хранилища
+        Строки с теми же станцией и датой заменяются новыми
+        :param new_df: pd.DataFrame, гидро-метео данные за новые дни (формат merge_hydro_meteo)
+        :return: pd.DataFrame, перезаписанные строки датасета
+        '''
+        if not self.exists():
+            raise FileNotFoundError(f'There is no feature store in {self.store_dir}, build it first')
+        if new_df.empty:
+            return self.read(start_date=self.last_date + timedelta(1))
+        plan = dataset_plan()
+        history = pd.concat([self._read_history(), new_df], ignore_index=True)
+        history = history.sort_values(['identifier', 'date']).drop_duplicates(['identifier', 'date'], keep='last')
+        last_date = history['date'].max()
+        history = history[history['date'] > last_date - timedelta(FEATURE_STORE_HISTORY_DAYS)]
+
+        long_df = prepare_hydro(history)
+        to_compute = resolve_features(list(plan), list(long_df.columns))
+        first_affected = new_df['date'].min()
+        if self.meta.get('provisional_date') is not None:
+            first_affected = min(first_affected, pd.Timestamp(self.meta['provisional_date']))
+        observed = observed_date(long_df)
+
+        overrides, state = {}, None
+        if self.meta['demodul_date'] is not None:
+            demodul_date = pd.Timestamp(self.meta['demodul_date'])
+            if demodul_date < long_df['date'].min() + timedelta(DEMODUL_LAG):
+                raise ValueError(f'Feature store is older than {FEATURE_STORE_HISTORY_DAYS} days, rebuild it')
+            state = {'date': demodul_date, 'mean': self.meta['demodul_mean'],
+                     'demodulators': self._read_demodulators(),
+                     'snapshot_date': min(observed + timedelta(DEMODUL_LAG), last_date)}
+            overrides = {name: partial(self._demodulated, state, name) for name in DEMODUL_FEATURES}
+            first_affected = min(first_affected, demodul_date + timedelta(1))
+        long_df = compute_features(long_df, to_compute, overrides)
+
+        tensor, columns = build_feature_tensor(long_df, plan)
+        if columns != self.columns:
+            raise ValueError('Feature set has changed since the feature store was built, rebuild it')
+        frame = tensor.to_frame(columns)
+        # раньше окно истории не покрывает прошлогодние значения - такие строки не перезаписываем
+        first_affected = max(first_affected, long_df['date'].min() + timedelta(PAST_YEAR_DAYS))
+        frame = frame[frame['date'] >= first_affected].reset_index(drop=True)
+
+        if state is not None:
+            # до даты состояния демодуляции ее значения уже окончательные - берем из хранилища
+            stored = self.read(start_date=first_affected, end_date=state['date'] + timedelta(1))
+            demodul_cols = [col for col in columns if col.rsplit('_', 1)[0] in DEMODUL_FEATURES]
+            positions = pd.DatetimeIndex(stored['date']).get_indexer(frame['date'])
+            found = positions >= 0
+            frame.loc[found, demodul_cols] = stored[demodul_cols].values[positions[found]]
+
+        normalizer = self._normalizer()
+        self._write_rows(frame, normalizer)
+        self._write_history(history)
+        if state is not None and 'snapshot' in state:
+            self._write_demodulators(state['snapshot'])
+            self.meta['demodul_date'] = str(state['snapshot_date'].date())
+        self.meta['last_date'] = str(max(self.last_date, frame['date'].max()).date())
+        self.meta['observed_date'] = str(observed.date())
+        self.meta['provisional_date'] = self._date_str(tensor.filled_from)
+        self.meta['stats'] = self._fingerprint(normalizer)
+        self._write_meta()
+        logging.getLogger().info(f'Feature store: {len(frame)} days rewritten from {first_affected.date()}')
+        return frame
+
+    def append_days(self, new_hydro: pd.DataFrame, new_meteo: pd.DataFrame) -> pd.DataFrame:
+        '''
+        Добавление новых дней по сырым данным: мердж с asunp, интерполяция метео в гидростанции, пересчет хвоста
+        :param new_hydro: pd.DataFrame, новые данные с гидропостов (формат read_hydro_all)
+        :param new_meteo: pd.DataFrame, новые метео данные (формат read_history_meteo)
+        :return: pd.DataFrame, перезаписанные строки датасета
+        '''
+        from ..dataloaders.asunp import get_asunp_stations, get_asunp_hydro_stations
+        from ..processing.merge_hydro_asunp import merge_hydro_asunp
+        from ..processing.merge_meteo_asunp import merge_meteo_asunp
+        from ..processing.merge_hydro_meteo import merge_hydro_meteo
+
+        if self.asunp is None:
+            self.asunp = get_asunp_stations()
+        if self.asunp_hydro is None:
+            self.asunp_hydro = get_asunp_hydro_stations()
+        hydro_df = merge_hydro_asunp(new_hydro, self.asunp_hydro)
+        meteo_df = merge_meteo_asunp(new_meteo, self.asunp)
+        return self.append_merged(merge_hydro_meteo(hydro_df, meteo_df, self.asunp_hydro))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Информация о хранилище признаков')
+    parser.add_argument('--purge', action='store_true', help='Удалить хранилище')
+    parser.add_argument('--renormalize', action='store_true',
+                        help='Пересчитать нормализованные строки по текущему mean_std_stats.json')
+    args = parser.parse_args()
+
+    store_dir = get_feature_store_dir()
+    if args.purge:
+        shutil.rmtree(store_dir, ignore_errors=True)
+        print(f'Removed {store_dir}')
+    else:
+        store = FeatureStore(store_dir)
+        if not store.exists():
+            print(f'There is no feature store in {store_dir}')
+        else:
+            if args.renormalize:
+                store.refresh_normalized()
+            print(f"{store_dir}: {len(store.columns)} columns, up to {store.meta['last_date']}, "
+                  f"observed up to {store.meta['observed_date']}, demodulation state {store.meta['demodul_date']}")
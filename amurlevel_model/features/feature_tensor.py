@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+import pandas as pd
+import numpy as np
+from typing import List, Optional
+
+
+def fill_linear(values: np.ndarray) -> np.ndarray:
+    '''
+    Векторный аналог interpolate(method='linear').fillna(method='ffill').fillna(method='bfill')
+    по оси 0 для всех столбцов сразу: пропуски внутри ряда заполняются линейно (значения считаются
+    равноотстоящими), на краях - ближайшим известным значением. Полностью пустые столбцы остаются пустыми
+    :param values: np.ndarray (дни x столбцы)
+    :return: np.ndarray того же шейпа и типа
+    '''
+    nans = np.isnan(values)
+    cols = np.where(nans.any(axis=0) & ~nans.all(axis=0))[0]
+    if len(cols) == 0:
+        return values
+    part = values[:, cols].astype(np.float64)
+    valid = ~nans[:, cols]
+    n_days = len(values)
+    positions = np.arange(n_days)[:, None]
+    prev_idx = np.maximum.accumulate(np.where(valid, positions, -1), axis=0)
+    next_idx = np.minimum.accumulate(np.where(valid, positions, n_days)[::-1], axis=0)[::-1]
+    # на краях берем ближайшее известное значение с другой стороны
+    prev_idx = np.where(prev_idx < 0, next_idx, prev_idx)
+    next_idx = np.where(next_idx >= n_days, prev_idx, next_idx)
+    prev_values = np.take_along_axis(part, prev_idx, axis=0)
+    next_values = np.take_along_axis(part, next_idx, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = (next_values - prev_values) / (next_idx - prev_idx)
+        filled = np.where(next_idx == prev_idx, prev_values, slope * (positions - prev_idx) + prev_values)
+    values = values.copy()
+    values[:, cols] = np.where(valid, part, filled)
+    return values
+
+
+class FeatureTensor():
+    '''
+    Плотный тензор признаков float32 (дни x станции x признаки) с индексами дат, станций и признаков.
+    Дни - первая ось в памяти, поэтому широкий датафрейм (колонки {признак}_{станция}, сгруппированные
+    по станциям) получается из тензора reshape-ом без копирования
+    '''
+
+    def __init__(self, values: np.ndarray, dates: pd.DatetimeIndex, stations: List[str], features: List[str]):
+        '''
+        :param values: np.ndarray float32 (дни x станции x признаки)
+        :param dates: pd.DatetimeIndex, даты (ось 0)
+        :param stations: list, идентификаторы станций (ось 1)
+        :param features: list, названия признаков (ось 2)
+        '''
+        self.values = values
+        self.dates = dates
+        self.stations = list(stations)
+        self.features = list(features)
+        self.station_index = {station: i for i, station in enumerate(self.stations)}
+        self.column_index = {feature: i for i, feature in enumerate(self.features)}
+        self.filled_from = None # первая дата, с которой пропуски в конце рядов заполнены последним значением
+
+    @classmethod
+    def from_long(cls, df: pd.DataFrame, stations: List[str], features: List[str],
+                  dates: pd.DatetimeIndex) -> 'FeatureTensor':
+        '''
+        Тензор из длинного датафрейма (строка - станция и дата) без дубликатов по станции и дате
+        Строки других станций и дат игнорируются, отсутствующие пары (станция, дата) - np.nan
+        :param df: pd.DataFrame с колонками identifier, date и features
+        :param stations: list, станции тензора
+        :param features: list, признаки тензора
+        :param dates: pd.DatetimeIndex, даты тензора
+        :return: FeatureTensor
+        '''
+        values = np.full((len(dates), len(stations), len(features)), np.nan, dtype=np.float32)
+        station_pos = pd.Index(stations).get_indexer(df['identifier'])
+        day_pos = dates.get_indexer(df['date'])
+        rows = (station_pos >= 0) & (day_pos >= 0)
+        values[day_pos[rows], station_pos[rows]] = df[features].to_numpy(dtype=np.float32)[rows]
+        return cls(values, dates, stations, features)
+
+    def get(self, station: str, feature: str) -> np.ndarray:
+        '''
+        Ряд признака для станции по всем дням (view)
+        '''
+        return self.values[:, self.station_index[station], self.column_index[feature]]
+
+    def column_names(self) -> List[str]:
+        '''
+        Названия колонок широкого датафрейма в порядке reshape
+        '''
+        return [f'{feature}_{station}' for station in self.stations for feature in self.features]
+
+    def fill_missing(self, mask: Optional[np.ndarray]=None):
+        '''
+        Заполнение пропусков по дням (см. fill_linear)
+        Если в конце каких-то рядов были пропуски, в filled_from запоминается дата начала таких пропусков
+        :param mask: np.ndarray bool (станции x признаки), какие ряды заполнять. По умолчанию - все
+        '''
+        wide = self.values.reshape(len(self.dates), -1)
+        cols = np.arange(wide.shape[1]) if mask is None else np.where(mask.ravel())[0]
+        valid = ~np.isnan(wide[:, cols])
+        valid = valid[:, valid.any(axis=0)]
+        if valid.size > 0 and not valid[-1].all():
+            last_valid = len(valid) - 1 - np.argmax(valid[::-1], axis=0)
+            self.filled_from = self.dates[last_valid.min() + 1]
+        wide[:, cols] = fill_linear(wide[:, cols])
+
+    def to_frame(self, columns: Optional[List[str]]=None) -> pd.DataFrame:
+        '''
+        Широкий датафрейм с колонкой date и колонками {признак}_{станция}
+        Если columns не задан (или совпадает со всеми колонками тензора) - данные не копируются
+        :param columns: list, какие колонки {признак}_{станция} оставить
+        :return: pd.DataFrame
+        '''
+        names = self.column_names()
+        wide = self.values.reshape(len(self.dates), -1)
+        if columns is not None and list(columns) != names:
+            positions = pd.Index(names).get_indexer(columns)
+            if (positions < 0).any():
+                raise KeyError(f'Columns not in tensor: {[col for col, pos in zip(columns, positions) if pos < 0]}')
+            wide, names = wide[:, positions], list(columns)
+        frame = pd.DataFrame(wide, columns=names, copy=False)
+        frame['date'] = self.dates
+        return frame
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+import pandas as pd
+import numpy as np
+import math
+
+
+class StationIndex():
+    '''
+    Индекс длинного датафрейма, отсортированного по станции и дате: номер станции для каждой строки,
+    начало блока станции и дата в днях. Считается один раз и переиспользуется всеми ядрами
+    '''
+
+    def __init__(self, identifiers: np.ndarray, dates: pd.Series):
+        '''
+        :param identifiers: np.ndarray, идентификаторы станций (строки идут блоками по станциям)
+        :param dates: pd.Series, даты (внутри станции по возрастанию)
+        '''
+        self.group, _ = pd.factorize(np.asarray(identifiers))
+        self.n_rows = len(self.group)
+        self.positions = np.arange(self.n_rows)
+        is_start = np.ones(self.n_rows, dtype=bool)
+        is_start[1:] = self.group[1:] != self.group[:-1]
+        self.is_start = is_start
+        self.start = np.maximum.accumulate(np.where(is_start, self.positions, 0)) # начало блока станции для строки
+        self.dates = pd.DatetimeIndex(dates)
+        self.days = self.dates.values.astype('datetime64[D]').astype(np.int64)
+
+    def key(self, days: np.ndarray) -> np.ndarray:
+        '''
+        Ключ (станция, день) одним int64, возрастает вместе с порядком строк
+        '''
+        return self.group.astype(np.int64) * (1 << 32) + days
+
+
+def day_of_year_angle(dates: pd.DatetimeIndex) -> np.ndarray:
+    '''
+    Угол дня в году для sin/cos преобразования: 2 * pi * день года / 365
+    '''
+    return 2 * math.pi * np.asarray(dates.dayofyear) / 365
+
+
+def days_without_precipitation(precipitation: np.ndarray, index: StationIndex) -> np.ndarray:
+    '''
+    Количество дней без осадков (больше 0.01) с последнего дня с осадками внутри станции
+    :param precipitation: np.ndarray, количество осадков
+    :param index: StationIndex
+    :return: np.ndarray int64
+    '''
+    with np.errstate(invalid='ignore'):
+        rain = np.asarray(precipitation, dtype=np.float64) > 0.01
+    # последняя строка с осадками или начало станции
+    last = np.maximum.accumulate(np.where(rain | index.is_start, index.positions, 0))
+    return np.clip(index.positions - last - 1, 0, None)
+
+
+def shift_grouped(values: np.ndarray, index: StationIndex, shift: int) -> np.ndarray:
+    '''
+    Сдвиг на shift строк вниз внутри станции (аналог groupby('identifier').shift(shift))
+    :return: np.ndarray float64, np.nan там, где сдвинутого значения нет
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    result = np.full(index.n_rows, np.nan)
+    if shift == 0:
+        result[:] = values
+    elif shift < index.n_rows:
+        same = index.group[shift:] == index.group[:-shift]
+        result[shift:] = np.where(same, values[:-shift], np.nan)
+    return result
+
+
+def rolling_days_mean(values: np.ndarray, index: StationIndex, window: int) -> np.ndarray:
+    '''
+    Среднее за window дней по датам (интервал (дата - window, дата]) внутри станции без учета пропусков
+    (аналог groupby('identifier').rolling(f'{window}D', on='date', min_periods=1).mean())
+    Считается через кумулятивные суммы и бинарный поиск начала окна
+    :return: np.ndarray float64, np.nan если в окне нет значений
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    sums = np.concatenate([[0.0], np.cumsum(np.where(valid, values, 0.0))])
+    counts = np.concatenate([[0], np.cumsum(valid)])
+    keys = index.key(index.days)
+    left = np.searchsorted(keys, index.key(index.days - window), side='right')
+    right = index.positions + 1
+    count = counts[right] - counts[left]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, (sums[right] - sums[left]) / count, np.nan)
+
+
+def rolling_rows_mean(values: np.ndarray, index: StationIndex, window: int) -> np.ndarray:
+    '''
+    Центрированное среднее по window строкам внутри станции без учета пропусков
+    (аналог groupby('identifier').rolling(window, center=True, min_periods=1).mean())
+    :return: np.ndarray float64
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    sums = np.concatenate([[0.0], np.cumsum(np.where(valid, values, 0.0))])
+    counts = np.concatenate([[0], np.cumsum(valid)])
+    # граница блока станции: первая строка следующей станции
+    end = np.empty(index.n_rows, dtype=np.int64)
+    starts = np.append(np.where(index.is_start)[0], index.n_rows)
+    end[:] = np.repeat(starts[1:], np.diff(starts))
+    offset = window // 2
+    left = np.maximum(index.positions - offset, index.start)
+    right = np.minimum(index.positions - offset + window, end)
+    count = counts[right] - counts[left]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, (sums[right] - sums[left]) / count, np.nan)
+
+
+def past_year_positions(index: StationIndex) -> np.ndarray:
+    '''
+    Для каждой строки - строка той же станции ровно на год раньше (29 февраля переходит в 28 февраля
+    следующего года, как relativedelta). Если таких строк две (28 и 29 февраля), берется последняя
+    :return: np.ndarray int64, -1 если строки год назад нет
+    '''
+    shifted = (index.dates + pd.DateOffset(years=1)).values.astype('datetime64[D]').astype(np.int64)
+    source_keys = index.key(shifted)
+    target_keys = index.key(index.days)
+    positions = np.searchsorted(source_keys, target_keys, side='right') - 1
+    found = (positions >= 0) & (source_keys[np.maximum(positions, 0)] == target_keys)
+    return np.where(found, positions, -1)
+
+
+def take_positions(values: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    '''
+    values[positions] с np.nan для positions == -1
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    return np.where(positions >= 0, values[np.maximum(positions, 0)], np.nan)
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+import pandas as pd
+import numpy as np
+import os
+import re
+import json
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from datetime import date
+from typing import Dict, List, Optional, Union
+
+from .amur_features import prepare_hydro, build_feature_tensor
+from .feature_registry import FeatureColumns, resolve_features, compute_features, split_station_features
+from .kernels import StationIndex, shift_grouped
+from ..config import ALL_STATIONS, DATASETS_PATH, N_JOBS
+from ..config_features import NUMERICAL_FEATURES
+from ..utils.common import get_n_jobs
+
+STATS_BLOCK_DAYS = 365 # сколько дней обрабатывается за одно обновление статистики
+
+
+class RunningStats():
+    '''
+    Потоковые среднее и дисперсия по колонкам без учета пропусков:
+    блоки строк добавляются по формулам Уэлфорда/Чана (count, mean, M2), состояния можно объединять
+    '''
+
+    def __init__(self, n_columns: int):
+        self.count = np.zeros(n_columns, dtype=np.int64)
+        self.mean = np.zeros(n_columns, dtype=np.float64)
+        self.m2 = np.zeros(n_columns, dtype=np.float64)
+
+    def merge(self, count: np.ndarray, mean: np.ndarray, m2: np.ndarray) -> 'RunningStats':
+        '''
+        Объединение с другим состоянием (count, mean, M2) по формуле Чана
+        '''
+        total = self.count + count
+        with np.errstate(invalid='ignore', divide='ignore'):
+            share = np.where(total > 0, count / total, 0.0)
+        delta = np.where(count > 0, mean - self.mean, 0.0)
+        self.mean = self.mean + delta * share
+        self.m2 = self.m2 + np.where(count > 0, m2 + delta ** 2 * self.count * share, 0.0)
+        self.count = total
+        return self
+
+    def update(self, block: np.ndarray) -> 'RunningStats':
+        '''
+        Добавление блока строк (строки x колонки), np.nan не учитываются
+        '''
+        block = np.asarray(block, dtype=np.float64)
+        valid = ~np.isnan(block)
+        count = valid.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(count > 0, np.where(valid, block, 0.0).sum(axis=0) / count, 0.0)
+        m2 = np.where(valid, (block - mean) ** 2, 0.0).sum(axis=0)
+        return self.merge(count, mean, m2)
+
+    def std(self, ddof: int=1) -> np.ndarray:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.sqrt(np.where(self.count > ddof, self.m2 / (self.count - ddof), np.nan))
+
+
+def _demodule_diff(columns: FeatureColumns, index: StationIndex, match: re.Match, level_mean: float) -> np.ndarray:
+    # как demodule_diff из feature_registry, но среднее уровня посчитано по всем станциям, а не по куску
+    return (columns['shift_10_days_sealevel_max'] - columns['demodule_365_sealevel_max'] -
+            columns['demodule_121_sealevel_max'] + level_mean).values
+
+
+def _chunk_stats(hydro_df: pd.DataFrame, plan: Dict[str, List[str]], dates: pd.DatetimeIndex,
+                 level_mean: float, columns: List[str]) -> Dict[str, tuple]:
+    '''
+    Статистика колонок для куска станций: признаки считаются как в make_dataset(train=True),
+    затем дни тензора проходятся блоками по STATS_BLOCK_DAYS
+    :return: dict, колонка -> (count, mean, M2)
+    '''
+    long_df = prepare_hydro(hydro_df)
+    to_compute = resolve_features(list(plan), list(long_df.columns))
+    long_df = compute_features(long_df, to_compute, {'demodule_diff': partial(_demodule_diff, level_mean=level_mean)})
+    tensor, _ = build_feature_tensor(long_df, plan, train=True, dates=dates)
+    names = tensor.column_names()
+    wanted = set(columns)
+    positions = [i for i, name in enumerate(names) if name in wanted]
+    wide = tensor.values.reshape(len(tensor.dates), -1)
+    stats = RunningStats(len(positions))
+    for start in range(0, len(wide), STATS_BLOCK_DAYS):
+        stats.update(wide[start:start + STATS_BLOCK_DAYS, positions])
+    return {names[pos]: (stats.count[i], stats.mean[i], stats.m2[i]) for i, pos in enumerate(positions)}
+
+
+def build_normalizer_stats(hydro_df: pd.DataFrame, end_date: Union[date, str],
+                           columns: Optional[List[str]]=None, fname: Optional[str]=None,
+                           n_jobs: Optional[int]=N_JOBS, ddof: int=1) -> Dict[str, Dict[str, float]]:
+    '''
+    Статистика mean, std признаков для нормализации (формат mean_std_stats.json, см. get_normalizer_stats)
+    Используются только данные до end_date (не включая) - тестовая выборка в статистику не попадает.
+    Признаки считаются по кускам станций в n_jobs процессах, mean и std накапливаются потоково (RunningStats)
+    :param hydro_df: pd.DataFrame, гидро-метео данные (результат merge_hydro_meteo)
+    :param end_date: date,str - дата, с которой начинается тестовая выборка
+    :param columns: list, колонки {признак}_{станция}, по умолчанию NUMERICAL_FEATURES
+    :param fname: str, куда записать json. None - не записывать
+    :param n_jobs: int, количество процессов, None - по количеству ядер, 1 - без распараллеливания
+    :param ddof: int, поправка в знаменателе дисперсии (1 - как pandas.Series.std)
+    :return: dict, колонка -> {'mean','std'}
+    '''
+    logger = logging.getLogger()
+    if columns is None:
+        columns = NUMERICAL_FEATURES
+    hydro_df = hydro_df[hydro_df['date'] < pd.Timestamp(end_date)]
+    plan = split_station_features(columns, ALL_STATIONS)
+
+    # demodule_diff использует среднее уровня 10 дней назад по всем станциям - считаем его до деления на куски
+    level_df = hydro_df[['identifier', 'date', 'sealevel_max']].sort_values(['identifier', 'date'])
+    level_df = level_df.drop_duplicates(['identifier', 'date'], keep='last')
+    index = StationIndex(level_df['identifier'].values, level_df['date'])
+    level_mean = float(np.nanmean(shift_grouped(level_df['sealevel_max'].values, index, 10)))
+
+    # даты датасета - даты первой станции, как в make_dataset
+    stations = [station for station in sorted(level_df['identifier'].unique()) if station in ALL_STATIONS]
+    if not stations:
+        raise ValueError(f'There is no data before {end_date} for stations from ALL_STATIONS')
+    dates = pd.DatetimeIndex(level_df.loc[level_df['identifier'] == stations[0], 'date'])
+    del level_df, index
+
+    # признаки считаются только для станций из нужных колонок, станции делятся на куски по процессам
+    needed = sorted({station for feature_stations in plan.values() for station in feature_stations})
+    n_jobs = min(get_n_jobs(n_jobs), len(needed))
+    tasks = []
+    for chunk in np.array_split(needed, n_jobs):
+        chunk = set(chunk)
+        chunk_plan = {feature: [station for station in feature_stations if station in chunk]
+                      for feature, feature_stations in plan.items()}
+        chunk_plan = {feature: feature_stations for feature, feature_stations in chunk_plan.items() if feature_stations}
+        if chunk_plan:
+            tasks.append((hydro_df[hydro_df['identifier'].isin(chunk)], chunk_plan))
+    logger.info(f'Normalizer stats for {len(columns)} columns: {len(needed)} stations in {len(tasks)} chunks')
+
+    run = partial(_chunk_stats, dates=dates, level_mean=level_mean, columns=columns)
+    if len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=len(tasks)) as executor:
+            results = list(executor.map(run, *zip(*tasks)))
+    else:
+        results = [run(*task) for task in tasks]
+
+    merged = {}
+    for result in results:
+        merged.update(result)
+    missing = [col for col in columns if col not in merged]
+    if missing:
+        raise ValueError(f'No data to compute normalizer stats for {missing[:5]}...')
+
+    stats = RunningStats(len(columns))
+    stats.merge(*[np.array([merged[col][k] for col in columns]) for k in range(3)])
+    std = stats.std(ddof)
+    normalizer_stats = {}
+    for col, _mean, _std in zip(columns, stats.mean, std):
+        if not np.isfinite(_std) or _std == 0:
+            logger.warning(f'Zero or undefined std for {col}, std is set to 1')
+            _std = 1.0
+        normalizer_stats[col] = {'mean': float(_mean), 'std': float(_std)}
+
+    if fname is not None:
+        save_normalizer_stats(normalizer_stats, fname)
+        logger.info(f'Normalizer stats saved to {fname}')
+    return normalizer_stats
+
+
+def save_normalizer_stats(normalizer_stats: Dict[str, Dict[str, float]], fname: Optional[str]=None) -> None:
+    '''
+    Запись статистики в json (атомарно - читатели не увидят недописанный файл)
+    :param normalizer_stats: dict, колонка -> {'mean','std'}
+    :param fname: str, путь до файла, по умолчанию DATASETS_PATH/mean_std_stats.json
+    '''
+    if fname is None:
+        fname = os.path.join(DATASETS_PATH, 'mean_std_stats.json')
+    tmp_fname = f'{fname}.{os.getpid()}.tmp'
+    with open(tmp_fname, 'w', encoding='utf-8') as f:
+        json.dump(normalizer_stats, f)
+    os.replace(tmp_fname, fname)
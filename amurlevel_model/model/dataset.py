@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import tensorflow as tf
+
+from .windows import WindowSet
+from ..config import BATCH_SIZE, SHUFFLE_BUFFER
+
+
+def make_tf_dataset(windows: WindowSet, batch_size: int=BATCH_SIZE, shuffle: bool=True,
+                    shuffle_buffer: int=SHUFFLE_BUFFER, seed: int=None) -> tf.data.Dataset:
+    '''
+    tf.data пайплайн по окнам WindowSet (обычно открытым через memmap, см. WindowSet.load).
+    Перемешиваются только номера окон (буфер ограничен shuffle_buffer), сами окна батча читаются
+    из матриц при обращении в параллельных map, следующие батчи готовятся заранее (prefetch).
+    Память не зависит от длины истории - в ней только номера окон и несколько батчей
+
+    :param windows: WindowSet с таргетами
+    :param batch_size: int, размер батча
+    :param shuffle: bool, перемешивать ли окна (для обучающей выборки)
+    :param shuffle_buffer: int, размер буфера перемешивания
+    :param seed: int, seed перемешивания
+    :return: tf.data.Dataset с батчами (x [batch, window, n_features], y [batch, window, n_targets])
+    '''
+    n_features = windows.features.shape[1]
+    n_targets = windows.targets.shape[1]
+
+    def gather(idx: np.ndarray):
+        return windows.inputs(idx).astype(np.float32), windows.labels(idx).astype(np.float32)
+
+    def read_batch(idx: tf.Tensor):
+        x, y = tf.numpy_function(gather, [idx], (tf.float32, tf.float32))
+        x.set_shape([None, windows.window, n_features])
+        y.set_shape([None, windows.window, n_targets])
+        return x, y
+
+    dataset = tf.data.Dataset.range(len(windows))
+    if shuffle:
+        dataset = dataset.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(read_batch, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    return dataset.prefetch(tf.data.experimental.AUTOTUNE)
@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import os
+import json
+import shutil
+import inspect
+import logging
+from argparse import RawTextHelpFormatter, ArgumentParser
+from typing import Dict, Optional, Tuple
+
+import tensorflow as tf
+import tensorflow.keras.layers as L
+
+from .model import build_model, FeatureNormalization
+from ..config import DATASETS_PATH, EXPORT_DIR
+from ..utils.common import set_logger
+from ..utils.normalizer import get_normalizer
+
+SAVED_MODEL_DIR = 'saved_model' # имя SavedModel внутри директории экспорта
+TFLITE_FILE = 'model.tflite' # имя TFLite модели внутри директории экспорта
+EXPORT_META_FILE = 'export.json' # параметры экспорта по форматам (нормализация и т.д.) внутри директории экспорта
+
+
+def get_export_dir(weights: str) -> str:
+    '''
+    Директория экспорта по умолчанию для весов: DATASETS_PATH/EXPORT_DIR/{имя файла весов без .h5}
+    '''
+    return os.path.join(DATASETS_PATH, EXPORT_DIR, os.path.splitext(os.path.basename(weights))[0])
+
+
+def _bn_affine(bn: L.BatchNormalization) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    BatchNormalization на инференсе - поканальное x * scale + shift
+    '''
+    gamma, beta, mean, var = bn.get_weights()
+    scale = gamma / np.sqrt(var + bn.epsilon)
+    return scale, beta - mean * scale
+
+
+def _fold_input(kernel: np.ndarray, bias: np.ndarray, scale: np.ndarray, shift: np.ndarray,
+                rows: slice=slice(None)) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Свертка x * scale + shift на входах rows в следующий линейный слой (kernel [входы, выходы])
+    '''
+    kernel = kernel.copy()
+    bias = bias + shift @ kernel[rows]
+    kernel[rows] *= scale[:, None]
+    return kernel, bias
+
+
+def _fold_output(kernel: np.ndarray, bias: np.ndarray, scale: np.ndarray,
+                 shift: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Свертка x * scale + shift в выходы предыдущего линейного слоя (без активации)
+    '''
+    return kernel * scale, bias * scale + shift
+
+
+def _producer(layer: L.Layer) -> L.Layer:
+    inbound = layer.inbound_nodes[0].inbound_layers
+    return inbound[0] if isinstance(inbound, (list, tuple)) else inbound
+
+
+def build_inference_model(model: tf.keras.Model) -> tf.keras.Model:
+    '''
+    Модель только для инференса с теми же предсказаниями, что у model из build_model:
+    dropout убраны, BatchNormalization свернуты в соседние линейные слои
+    (после Conv1D - в саму свертку, после активации - во входы следующего Dense/LSTM)
+    :param model: модель из build_model с загруженными весами
+    :return: tf.keras.Model без BatchNormalization и Dropout
+    '''
+    def of_type(layer_type):
+        return [layer for layer in model.layers if isinstance(layer, layer_type)]
+
+    dense, lstm, conv = of_type(L.Dense), of_type(L.Bidirectional), of_type(L.Conv1D)
+    embedding, normalization = of_type(L.Embedding), of_type(FeatureNormalization)
+    bn_after = {_producer(layer).name: layer for layer in of_type(L.BatchNormalization)}
+    if len(dense) != 4 or len(lstm) != 2 or len(conv) != 2 or len(bn_after) != 6:
+        raise ValueError('Model architecture differs from build_model, can not fold it')
+    dense_in, dense_hidden1, dense_hidden2, dense_out = dense  # порядок слоев топологический
+    numerical = dense_in.get_weights()[0].shape[0]
+    categorical = model.input_shape[-1] - numerical
+    hidden_dim = lstm[0].forward_layer.units
+
+    inputs = L.Input(shape=model.input_shape[1:], name='inputs')
+    features = inputs
+    if normalization:
+        features = FeatureNormalization(normalization[0].mean, normalization[0].std, name='normalization')(inputs)
+    num_inputs = features[:, :, :numerical]
+
+    layers = {'dense_in': L.Dense(dense_in.units, activation='relu', name='dense_in')}
+    hidden = layers['dense_in'](num_inputs)
+    n_embed = 0
+    if categorical > 0:
+        layers['embedding'] = L.Embedding(input_dim=embedding[0].input_dim, output_dim=embedding[0].output_dim,
+                                          name='embedding')
+        embed = layers['embedding'](features[:, :, numerical:numerical + categorical])
+        embed = tf.reshape(embed, shape=(-1, embed.shape[1], embed.shape[2] * embed.shape[3]))
+        n_embed = embed.shape[2]
+        hidden = tf.concat([embed, hidden], axis=2)
+    for i in range(2):
+        layers[f'lstm{i}'] = L.Bidirectional(L.LSTM(hidden_dim, return_sequences=True), name=f'lstm{i}')
+        hidden = layers[f'lstm{i}'](hidden)
+    for i, layer in enumerate([dense_hidden1, dense_hidden2]):
+        layers[f'dense{i}'] = L.Dense(layer.units, activation='relu', name=f'dense{i}')
+        hidden = layers[f'dense{i}'](hidden)
+    convbn = num_inputs
+    for i, layer in enumerate(conv):
+        layers[f'conv{i}'] = L.Conv1D(filters=layer.filters, kernel_size=layer.kernel_size,
+                                      dilation_rate=layer.dilation_rate, padding='same', name=f'conv{i}')
+        convbn = layers[f'conv{i}'](convbn)
+    layers['levels'] = L.Dense(dense_out.units, activation='linear', name='levels')
+    out = layers['levels'](tf.concat([hidden, num_inputs, convbn], axis=2))
+    inference_model = tf.keras.Model(inputs=inputs, outputs=out, name='amurlevel_inference')
+
+    layers['dense_in'].set_weights(dense_in.get_weights())
+    if categorical > 0:
+        layers['embedding'].set_weights(embedding[0].get_weights())
+    # BN после Dense(relu) - во входы первого LSTM (после эмбедингов), обоих направлений
+    scale, shift = _bn_affine(bn_after[dense_in.name])
+    weights = lstm[0].get_weights()  # kernel, recurrent_kernel, bias прямого, затем обратного направления
+    for i in (0, 3):
+        weights[i], weights[i + 2] = _fold_input(weights[i], weights[i + 2], scale, shift, slice(n_embed, None))
+    layers['lstm0'].set_weights(weights)
+    layers['lstm1'].set_weights(lstm[1].get_weights())
+    # BN после LSTM и после Dense(relu) - во входы следующего Dense
+    for i, (layer, previous) in enumerate([(dense_hidden1, lstm[1]), (dense_hidden2, dense_hidden1)]):
+        layers[f'dense{i}'].set_weights(_fold_input(*layer.get_weights(), *_bn_affine(bn_after[previous.name])))
+    # BN после Conv1D (без активации) - в саму свертку
+    for i, layer in enumerate(conv):
+        layers[f'conv{i}'].set_weights(_fold_output(*layer.get_weights(), *_bn_affine(bn_after[layer.name])))
+    # BN после последнего Dense(relu) - в первые входы выходного слоя
+    layers['levels'].set_weights(_fold_input(*dense_out.get_weights(), *_bn_affine(bn_after[dense_hidden2.name]),
+                                             slice(0, dense_hidden2.units)))
+    return inference_model
+
+
+def _jit_kwargs(xla: bool) -> Dict[str, bool]:
+    # tensorflow 2.3 - experimental_compile, в новых версиях - jit_compile
+    if 'jit_compile' in inspect.signature(tf.function).parameters:
+        return {'jit_compile': xla}
+    return {'experimental_compile': xla}
+
+
+def _replace(tmp_path: str, path: str) -> None:
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+
+def export_saved_model(model: tf.keras.Model, dirname: str, xla: bool=True) -> None:
+    '''
+    Экспорт в SavedModel с сигнатурой serving_default: inputs [n, DAYS_FORECAST, признаки] -> levels
+    :param model: tf.keras.Model (см. build_inference_model)
+    :param dirname: str, директория SavedModel
+    :param xla: bool, компилировать сигнатуру XLA
+    '''
+    spec = tf.TensorSpec([None] + list(model.input_shape[1:]), tf.float32, name='inputs')
+    module = tf.Module()
+    module.model = model
+    module.serve = tf.function(lambda inputs: {'levels': model(inputs, training=False)},
+                               input_signature=[spec], **_jit_kwargs(xla))
+    tmp_dirname = f'{dirname}.{os.getpid()}.tmp'
+    tf.saved_model.save(module, tmp_dirname, signatures={'serving_default': module.serve})
+    _replace(tmp_dirname, dirname)
+
+
+def export_tflite(model: tf.keras.Model, fname: str, quantize: bool=False) -> None:
+    '''
+    Экспорт в TFLite
+    :param model: tf.keras.Model (см. build_inference_model)
+    :param fname: str, путь до .tflite файла
+    :param quantize: bool, квантизация весов в int8 (меньше и быстрее, но предсказания немного отличаются)
+    '''
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    # операции, которых нет среди встроенных в TFLite, берутся из tensorflow
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+    if quantize:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    content = converter.convert()
+    tmp_fname = f'{fname}.{os.getpid()}.tmp'
+    with open(tmp_fname, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_fname, fname)
+
+
+class SavedModelPredictor():
+    '''
+    Экспортированная SavedModel с интерфейсом model.predict
+    '''
+
+    def __init__(self, dirname: str, in_graph_normalization: bool=False):
+        self.dirname = dirname
+        self.in_graph_normalization = in_graph_normalization
+        self.serve = tf.saved_model.load(dirname).signatures['serving_default']
+
+    def predict(self, inputs: np.ndarray, batch_size: Optional[int]=None) -> np.ndarray:
+        '''
+        :param inputs: np.ndarray [n, DAYS_FORECAST, признаки]
+        :param batch_size: int, размер батча (None - все окна одним батчем)
+        :return: np.ndarray [n, DAYS_FORECAST, станции]
+        '''
+        batch_size = batch_size or max(len(inputs), 1)
+        return np.concatenate([self.serve(inputs=tf.constant(inputs[start:start + batch_size], tf.float32))['levels'].numpy()
+                               for start in range(0, len(inputs), batch_size)])
+
+
+class TFLitePredictor():
+    '''
+    TFLite модель с интерфейсом model.predict. Не потокобезопасна
+    '''
+
+    def __init__(self, fname: str, in_graph_normalization: bool=False):
+        self.fname = fname
+        self.in_graph_normalization = in_graph_normalization
+        self.interpreter = tf.lite.Interpreter(model_path=fname)
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.batch_size = None
+
+    def _resize(self, batch_size: int) -> None:
+        if batch_size != self.batch_size:
+            shape = self.interpreter.get_input_details()[0]['shape']
+            self.interpreter.resize_tensor_input(self.input_index, [batch_size] + list(shape[1:]))
+            self.interpreter.allocate_tensors()
+            self.batch_size = batch_size
+
+    def predict(self, inputs: np.ndarray, batch_size: Optional[int]=None) -> np.ndarray:
+        '''
+        :param inputs: np.ndarray [n, DAYS_FORECAST, признаки]
+        :param batch_size: int, размер батча (None - все окна одним батчем)
+        :return: np.ndarray [n, DAYS_FORECAST, станции]
+        '''
+        batch_size = batch_size or max(len(inputs), 1)
+        outputs = []
+        for start in range(0, len(inputs), batch_size):
+            batch = np.ascontiguousarray(inputs[start:start + batch_size], dtype=np.float32)
+            self._resize(len(batch))
+            self.interpreter.set_tensor(self.input_index, batch)
+            self.interpreter.invoke()
+            outputs.append(self.interpreter.get_tensor(self.output_index).copy())
+        return np.concatenate(outputs)
+
+
+def is_exported(path: str) -> bool:
+    '''
+    Путь указывает на экспортированную модель (SavedModel или .tflite), а не на веса .h5
+    '''
+    return path.endswith('.tflite') or os.path.exists(os.path.join(path, 'saved_model.pb')) or \
+        os.path.exists(os.path.join(path, SAVED_MODEL_DIR, 'saved_model.pb'))
+
+
+def _export_format(path: str) -> Tuple[str, str]:
+    '''
+    Директория экспорта и формат модели по пути до нее
+    '''
+    if path.endswith('.tflite'):
+        return os.path.dirname(path), 'tflite'
+    if os.path.isdir(os.path.join(path, SAVED_MODEL_DIR)):
+        return path, 'saved_model'
+    return os.path.dirname(os.path.normpath(path)), 'saved_model'
+
+
+def read_export_meta(path: str) -> Optional[Dict]:
+    '''
+    Параметры экспорта модели из EXPORT_META_FILE директории экспорта
+    :param path: str, путь до экспортированной модели (как в load_exported)
+    :return: dict (weights, in_graph_normalization, ...) или None, если модель экспортирована без метаданных
+    '''
+    dirname, fmt = _export_format(path)
+    fname = os.path.join(dirname, EXPORT_META_FILE)
+    if not os.path.exists(fname):
+        return None
+    with open(fname) as f:
+        return json.load(f).get(fmt)
+
+
+def write_export_meta(dirname: str, meta: Dict[str, Dict]) -> None:
+    '''
+    Запись параметров экспорта по форматам в EXPORT_META_FILE (параметры других форматов сохраняются)
+    :param dirname: str, директория экспорта
+    :param meta: dict, формат -> параметры экспорта
+    '''
+    fname = os.path.join(dirname, EXPORT_META_FILE)
+    current = {}
+    if os.path.exists(fname):
+        with open(fname) as f:
+            current = json.load(f)
+    current.update(meta)
+    tmp_fname = f'{fname}.{os.getpid()}.tmp'
+    with open(tmp_fname, 'w') as f:
+        json.dump(current, f, indent=2)
+    os.replace(tmp_fname, fname)
+
+
+def exported_normalization(path: str, default: bool=False) -> bool:
+    '''
+    Встроена ли нормализация признаков в экспортированную модель (по EXPORT_META_FILE, модель не загружается)
+    :param path: str, путь до экспортированной модели (как в load_exported)
+    :param default: bool, значение, если у экспорта нет EXPORT_META_FILE
+    :return: bool
+    '''
+    meta = read_export_meta(path)
+    if meta is None:
+        logging.getLogger().warning(f'There is no {EXPORT_META_FILE} for {path}, in_graph_normalization={default} is assumed')
+        return default
+    return meta['in_graph_normalization']
+
+
+def load_exported(path: str, in_graph_normalization: bool=False):
+    '''
+    Загрузка экспортированной модели. Встроена ли в нее нормализация (атрибут in_graph_normalization),
+    берется из EXPORT_META_FILE
+    :param path: str, директория SavedModel (или директория экспорта с saved_model внутри) или .tflite файл
+    :param in_graph_normalization: bool, нормализация внутри модели, если у экспорта нет EXPORT_META_FILE
+    :return: SavedModelPredictor или TFLitePredictor
+    '''
+    in_graph_normalization = exported_normalization(path, in_graph_normalization)
+    if path.endswith('.tflite'):
+        return TFLitePredictor(path, in_graph_normalization=in_graph_normalization)
+    if os.path.isdir(os.path.join(path, SAVED_MODEL_DIR)):
+        path = os.path.join(path, SAVED_MODEL_DIR)
+    if not os.path.exists(os.path.join(path, 'saved_model.pb')):
+        raise FileNotFoundError(f'There is no SavedModel or .tflite model in {path}')
+    return SavedModelPredictor(path, in_graph_normalization=in_graph_normalization)
+
+
+def export_model(weights: str, dirname: Optional[str]=None, formats: Tuple[str, ...]=('saved_model', 'tflite'),
+                 in_graph_normalization: bool=False, xla: bool=True, quantize: bool=False) -> Dict[str, str]:
+    '''
+    Экспорт весов .h5 в модели для инференса, параметры экспорта пишутся в EXPORT_META_FILE
+    :param weights: str, путь до файла с весами (или имя файла в DATASETS_PATH)
+    :param dirname: str, директория экспорта (по умолчанию get_export_dir(weights))
+    :param formats: tuple, форматы: saved_model, tflite
+    :param in_graph_normalization: bool, встроить нормализацию признаков в модель
+    :param xla: bool, компилировать сигнатуру SavedModel XLA
+    :param quantize: bool, квантизация весов TFLite
+    :return: dict, формат -> путь до модели
+    '''
+    logger = logging.getLogger()
+    if not os.path.exists(weights):
+        weights = os.path.join(DATASETS_PATH, weights)
+    if dirname is None:
+        dirname = get_export_dir(weights)
+    os.makedirs(dirname, exist_ok=True)
+    model = build_model(normalizer=get_normalizer() if in_graph_normalization else None)
+    model.load_weights(weights)
+    inference_model = build_inference_model(model)
+
+    # проверка свертки: предсказания на случайных входах должны совпадать
+    check = np.random.RandomState(0).normal(size=(4,) + model.input_shape[1:]).astype(np.float32)
+    diff = np.abs(model.predict(check) - inference_model.predict(check)).max()
+    logger.info(f'Inference model: {len(model.layers)} -> {len(inference_model.layers)} layers, max abs diff {diff:.2e}')
+
+    paths = {}
+    if 'saved_model' in formats:
+        paths['saved_model'] = os.path.join(dirname, SAVED_MODEL_DIR)
+        export_saved_model(inference_model, paths['saved_model'], xla=xla)
+    if 'tflite' in formats:
+        paths['tflite'] = os.path.join(dirname, TFLITE_FILE)
+        export_tflite(inference_model, paths['tflite'], quantize=quantize)
+    meta = {'weights': os.path.basename(weights), 'in_graph_normalization': in_graph_normalization}
+    extra = {'saved_model': {'xla': xla}, 'tflite': {'quantize': quantize}}
+    write_export_meta(dirname, {fmt: dict(meta, **extra[fmt]) for fmt in paths})
+    for fmt, path in paths.items():
+        diff = np.abs(model.predict(check) - load_exported(path).predict(check)).max()
+        logger.info(f'Exported {fmt} to {path}, max abs diff {diff:.2e}')
+    return paths
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='''
+        Экспорт обученной модели (.h5) для инференса на CPU: dropout убраны, BatchNormalization свернуты в веса,
+        SavedModel с XLA-компилируемой сигнатурой и TFLite. Экспортированную модель можно передать в predict.py -w
+
+        Пример:  python -m amurlevel_model.model.export -w weights-aij2020amurlevel-2017.h5
+        python predict.py -f_day 2020-11-01 -w export/weights-aij2020amurlevel-2017/model.tflite
+        ''', formatter_class=RawTextHelpFormatter)
+    parser.add_argument('-w', '--weights', dest='w', type=str, required=True, help='Путь до файла с весами модели')
+    parser.add_argument('-o', '--output', dest='output', type=str, default=None,
+                        help='Директория экспорта (по умолчанию DATASETS_PATH/EXPORT_DIR/{имя весов})')
+    parser.add_argument('--formats', nargs='+', default=['saved_model', 'tflite'], choices=['saved_model', 'tflite'],
+                        help='Форматы экспорта')
+    parser.add_argument('--no-xla', dest='no_xla', action='store_true', help='Не компилировать SavedModel XLA')
+    parser.add_argument('--quantize', action='store_true', help='Квантизация весов TFLite')
+    parser.add_argument('--in-graph-normalization', dest='in_graph_normalization', action='store_true',
+                        help='Нормализовать признаки внутри модели (записывается в export.json, predict.py берет его оттуда)')
+    args = parser.parse_args()
+
+    set_logger()
+    export_model(args.w, args.output, formats=tuple(args.formats), in_graph_normalization=args.in_graph_normalization,
+                 xla=not args.no_xla, quantize=args.quantize)
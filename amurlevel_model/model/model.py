@@ -1,12 +1,15 @@
 # -*- coding: utf-8 -*-
 
+import numpy as np
 import tensorflow as tf
 import tensorflow.keras.layers as L
 import tensorflow.keras.backend as K
+from typing import Optional
 
 from .metrics import rmse,mae,mae_inference
 from ..config_features import NUMERICAL_FEATURES,CATEGORICAL_FEATURES,CAT_MAP
 from ..config import DAYS_FORECAST,ALL_STATIONS
+from ..utils.normalizer import Normalizer
 
 
 def lstm_layer(hidden_dim, dropout):
@@ -16,6 +19,28 @@ def lstm_layer(hidden_dim, dropout):
                              return_sequences=True,
                              kernel_initializer='orthogonal'))
 
+class FeatureNormalization(L.Layer):
+    '''
+    Нормализация (x - mean) / std внутри графа модели.
+    mean, std - константы слоя, а не веса, поэтому веса .h5 совместимы с моделью без нормализации
+    :param mean: list, средние по входным признакам
+    :param std: list, стандартные отклонения по входным признакам
+    '''
+    def __init__(self, mean, std, **kwargs):
+        super().__init__(**kwargs)
+        self.trainable = False
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.std = np.asarray(std, dtype=np.float32)
+
+    def call(self, inputs):
+        return (inputs - self.mean) / self.std
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({'mean': self.mean.tolist(), 'std': self.std.tolist()})
+        return config
+
+
 class Conv1BN():
     '''
     Архитектура - conv1D->Batchnorm->conv1D->Batchnorm->Droput
@@ -44,7 +69,9 @@ class Conv1BN():
 
 def build_model(dropout=0.35, hidden_dim=256, embed_dim=1,
                 numerical=len(NUMERICAL_FEATURES),
-                categorical=len(CATEGORICAL_FEATURES)):
+                categorical=len(CATEGORICAL_FEATURES),
+                normalizer: Optional[Normalizer]=None,
+                clear_session: bool=True):
     '''
     Итоговая модель для предсказания уровня
 
@@ -53,14 +80,24 @@ def build_model(dropout=0.35, hidden_dim=256, embed_dim=1,
     :param embed_dim: int, размерность эмбединга для категориальных признаков
     :param numerical: int, количество численных признаков
     :param categorical: int, количество категориальных признаков
+    :param normalizer: Normalizer для входов модели (см. utils.normalizer.get_normalizer). Если задан, нормализация
+                       встраивается в модель и на вход подаются ненормализованные признаки
+    :param clear_session: bool, сбросить состояние keras перед построением
+                          (False - если в процессе должны работать несколько моделей, например в serve.py)
     :return: model
     '''
-    K.clear_session()
+    if clear_session:
+        K.clear_session()
     inputs = L.Input(shape=(DAYS_FORECAST, numerical + categorical))
-    num_inputs = inputs[:, :, :numerical]
+    features = inputs
+    if normalizer is not None:
+        if len(normalizer.columns) != numerical + categorical:
+            raise ValueError(f'Normalizer has {len(normalizer.columns)} columns, model has {numerical + categorical} inputs')
+        features = FeatureNormalization(normalizer.mean, normalizer.std, name='normalization')(inputs)
+    num_inputs = features[:, :, :numerical]
 
     if categorical > 0:
-        embed_inputs = inputs[:, :, numerical:numerical + categorical]
+        embed_inputs = features[:, :, numerical:numerical + categorical]
         embed = L.Embedding(input_dim=len(CAT_MAP), output_dim=embed_dim)(embed_inputs)
         conv_embed_inputs = tf.reshape(embed, shape=(-1, embed.shape[1], embed.shape[2] * embed.shape[3]))
 
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+import pandas as pd
+import numpy as np
+import os
+import json
+from numpy.lib.stride_tricks import as_strided
+try:
+    from numpy.lib.stride_tricks import sliding_window_view
+except ImportError: # numpy < 1.20 (tensorflow 2.3 требует numpy < 1.19)
+    sliding_window_view = None
+from typing import List, Optional
+
+from ..config import DAYS_FORECAST, DATASETS_PATH, WINDOWS_DIR
+from ..utils.normalizer import Normalizer
+
+
+def get_windows_dir() -> str:
+    '''
+    Директория для выгрузки окон в .npy файлы (см. WindowSet.save)
+    '''
+    return os.path.join(DATASETS_PATH, WINDOWS_DIR)
+
+
+def feature_matrix(df: pd.DataFrame, columns: List[str], normalizer: Optional[Normalizer]=None) -> np.ndarray:
+    '''
+    Непрерывная матрица float32 (дни x колонки) из датафрейма, строки по возрастанию даты
+    :param df: pd.DataFrame с колонкой date
+    :param columns: list, колонки матрицы
+    :param normalizer: Normalizer для тех же колонок, если матрицу нужно нормализовать
+    :return: np.ndarray float32, C-contiguous
+    '''
+    order = np.argsort(df['date'].values, kind='stable')
+    matrix = np.ascontiguousarray(df[columns].to_numpy(dtype=np.float32)[order])
+    if normalizer is not None:
+        if normalizer.columns != list(columns):
+            raise ValueError('Normalizer columns do not match the feature matrix columns')
+        normalizer(matrix, out=matrix)
+    return matrix
+
+
+def sliding_windows(matrix: np.ndarray, window: int=DAYS_FORECAST) -> np.ndarray:
+    '''
+    Все окна по window подряд идущих строк без копирования
+    :param matrix: np.ndarray (дни x колонки)
+    :param window: int, длина окна
+    :return: np.ndarray-view (дни - window + 1, window, колонки)
+    '''
+    if len(matrix) < window:
+        return np.empty((0, window) + matrix.shape[1:], dtype=matrix.dtype)
+    if sliding_window_view is None:
+        shape = (len(matrix) - window + 1, window) + matrix.shape[1:]
+        return as_strided(matrix, shape=shape, strides=matrix.strides[:1] + matrix.strides, writeable=False)
+    return np.moveaxis(sliding_window_view(matrix, window, axis=0), -1, 1)
+
+
+def window_starts(n_rows: int, window: int=DAYS_FORECAST, stride: int=1,
+                  targets: Optional[np.ndarray]=None, tail: int=0) -> np.ndarray:
+    '''
+    Начала окон с шагом stride. Если заданы таргеты - только окна, где все таргеты известны
+    (количество известных значений в окне считается по кумулятивной сумме)
+    :param n_rows: int, количество строк
+    :param window: int, длина окна
+    :param stride: int, шаг между началами окон
+    :param targets: np.ndarray (дни x таргеты) или None
+    :param tail: int, сколько строк должно остаться после окна
+    :return: np.ndarray int64, номера строк начала окон
+    '''
+    starts = np.arange(0, max(n_rows - window - tail + 1, 0), stride)
+    if targets is not None and len(starts) > 0:
+        counts = np.concatenate([np.zeros((1, targets.shape[1]), dtype=np.int64),
+                                 np.cumsum(~np.isnan(targets), axis=0)])
+        in_window = counts[starts + window] - counts[starts]
+        starts = starts[(in_window == window).all(axis=1)]
+    return starts
+
+
+class WindowSet():
+    '''
+    Выборка окон для модели: матрицы признаков и таргетов и номера строк начала окон.
+    Окна берутся из sliding_windows без копирования, копируются только выбранные при обращении
+    '''
+
+    def __init__(self, features: np.ndarray, starts: np.ndarray, targets: Optional[np.ndarray]=None,
+                 window: int=DAYS_FORECAST):
+        '''
+        :param features: np.ndarray float32 (дни x признаки)
+        :param starts: np.ndarray int64, начала окон
+        :param targets: np.ndarray float32 (дни x таргеты) или None
+        :param window: int, длина окна
+        '''
+        self.features = features
+        self.targets = targets
+        self.starts = starts
+        self.window = window
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def inputs(self, idx: Optional[np.ndarray]=None) -> np.ndarray:
+        '''
+        Окна признаков [n, window, n_features] для окон idx (по умолчанию - все)
+        '''
+        starts = self.starts if idx is None else self.starts[idx]
+        return sliding_windows(self.features, self.window)[starts]
+
+    def labels(self, idx: Optional[np.ndarray]=None) -> np.ndarray:
+        '''
+        Окна таргетов [n, window, n_targets] для окон idx (по умолчанию - все)
+        '''
+        starts = self.starts if idx is None else self.starts[idx]
+        return sliding_windows(self.targets, self.window)[starts]
+
+    def save(self, dirname: str) -> None:
+        '''
+        Сохранение матриц и начал окон в .npy файлы директории dirname (meta.json пишется последним)
+        :param dirname: str, путь до директории
+        '''
+        os.makedirs(dirname, exist_ok=True)
+        arrays = {'features': self.features, 'targets': self.targets, 'starts': self.starts}
+        for name, values in arrays.items():
+            fname = os.path.join(dirname, f'{name}.npy')
+            if values is None:
+                if os.path.exists(fname):
+                    os.remove(fname)
+                continue
+            tmp_fname = os.path.join(dirname, f'{name}.{os.getpid()}.tmp.npy')
+            np.save(tmp_fname, values)
+            os.replace(tmp_fname, fname)
+        meta = {'window': self.window, 'n_windows': len(self.starts), 'features_shape': list(self.features.shape),
+                'targets': self.targets is not None}
+        tmp_fname = os.path.join(dirname, f'meta.{os.getpid()}.tmp.json')
+        with open(tmp_fname, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_fname, os.path.join(dirname, 'meta.json'))
+
+    @classmethod
+    def load(cls, dirname: str, mmap_mode: Optional[str]='r') -> 'WindowSet':
+        '''
+        Загрузка окон, сохраненных методом save. По умолчанию матрицы открываются как memmap -
+        в память читаются только те окна, к которым обращаемся
+        :param dirname: str, путь до директории
+        :param mmap_mode: str, режим np.load (None - прочитать в память целиком)
+        :return: WindowSet
+        '''
+        with open(os.path.join(dirname, 'meta.json')) as f:
+            meta = json.load(f)
+        features = np.load(os.path.join(dirname, 'features.npy'), mmap_mode=mmap_mode)
+        targets = np.load(os.path.join(dirname, 'targets.npy'), mmap_mode=mmap_mode) if meta['targets'] else None
+        starts = np.load(os.path.join(dirname, 'starts.npy'))
+        return cls(features, starts, targets=targets, window=meta['window'])
+
+
+def make_windows(df: pd.DataFrame, features: List[str], targets: Optional[List[str]]=None,
+                 stride: int=1, tail: int=0, normalizer: Optional[Normalizer]=None,
+                 window: int=DAYS_FORECAST) -> WindowSet:
+    '''
+    Выборка окон из широкого датасета (строка - день)
+    :param df: pd.DataFrame с колонкой date
+    :param features: list, признаки модели
+    :param targets: list, таргеты. Если заданы - берутся только окна, где известны все таргеты
+    :param stride: int, шаг между началами окон
+    :param tail: int, сколько строк должно остаться после последнего окна
+    :param normalizer: Normalizer для признаков (см. feature_matrix)
+    :param window: int, длина окна
+    :return: WindowSet
+    '''
+    x = feature_matrix(df, features, normalizer)
+    y = feature_matrix(df, targets) if targets is not None else None
+    starts = window_starts(len(x), window=window, stride=stride, targets=y, tail=tail)
+    return WindowSet(x, starts, targets=y, window=window)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from sklearn.neighbors import BallTree, KDTree
+
+MIN_DISTANCE = 1e-9 # минимальное расстояние (в радианах) для весов idw, чтобы не делить на 0
+DAYS_PER_CHUNK = 256 # количество дней, обрабатываемых за раз (ограничивает расход памяти)
+
+
+def rank_nearest_stations(meteo_lon: np.ndarray, meteo_lat: np.ndarray,
+                          hydro_lon: np.ndarray, hydro_lat: np.ndarray) -> np.ndarray:
+    '''
+    Упорядочивание всех метеостанций по удаленности от каждой гидростанции
+    (евклидово расстояние в градусах lon/lat, как в исходном поиске ближайшего соседа для категориальных признаков)
+    :param meteo_lon,meteo_lat: np.ndarray, координаты метеостанций
+    :param hydro_lon,hydro_lat: np.ndarray, координаты гидростанций
+    :return: np.ndarray (гидростанции x метеостанции) с индексами метеостанций от ближайшей к самой дальней
+    '''
+    tree = KDTree(np.stack([meteo_lon, meteo_lat], axis=1))
+    return tree.query(np.stack([hydro_lon, hydro_lat], axis=1), k=len(meteo_lon), return_distance=False)
+
+
+class NeighboursInterpolator():
+    '''
+    Быстрая интерполяция метео параметров в точки гидростанций по k ближайшим метеостанциям,
+    где значение не пропущено:
+    - method='idw' - веса обратно пропорциональны расстоянию в степени power
+    - method='nearest' - простое среднее по k ближайшим
+    Порядок метеостанций по удаленности от каждой гидростанции считается один раз через BallTree (haversine),
+    дальше все дни и все признаки считаются векторно
+    '''
+
+    def __init__(self, meteo_lon: np.ndarray, meteo_lat: np.ndarray,
+                 hydro_lon: np.ndarray, hydro_lat: np.ndarray,
+                 method: str='idw', k: int=3, power: float=2.0):
+        '''
+        :param meteo_lon,meteo_lat: np.ndarray, координаты метеостанций в градусах
+        :param hydro_lon,hydro_lat: np.ndarray, координаты гидростанций в градусах
+        :param method: str, 'idw' или 'nearest'
+        :param k: int, по скольким ближайшим метеостанциям интерполируем
+        :param power: float, степень расстояния для idw
+        '''
+        if method not in ('idw', 'nearest'):
+            raise ValueError(f'Unknown interpolation method {method}')
+        tree = BallTree(np.radians(np.stack([meteo_lat, meteo_lon], axis=1)), metric='haversine')
+        distances, self.order = tree.query(np.radians(np.stack([hydro_lat, hydro_lon], axis=1)), k=len(meteo_lon))
+        if method == 'idw':
+            self.base_weights = 1.0 / np.maximum(distances, MIN_DISTANCE) ** power
+        else:
+            self.base_weights = np.ones_like(distances)
+        self.k = k
+
+    def interpolate(self, values: np.ndarray) -> np.ndarray:
+        '''
+        :param values: np.ndarray (дни x метеостанции x признаки), пропуски - np.nan
+        :return: np.ndarray (дни x гидростанции x признаки), np.nan если за день нет ни одного значения
+        '''
+        result = np.empty((len(values), len(self.order), values.shape[2]), dtype=np.float64)
+        for start in range(0, len(values), DAYS_PER_CHUNK):
+            chunk = values[start:start + DAYS_PER_CHUNK][:, self.order, :] # дни x гидро x метео (по удаленности) x признаки
+            valid = ~np.isnan(chunk)
+            selected = valid & (np.cumsum(valid, axis=2) <= self.k)
+            weights = np.where(selected, self.base_weights[None, :, :, None], 0.0)
+            with np.errstate(invalid='ignore'):
+                result[start:start + DAYS_PER_CHUNK] = (weights * np.where(selected, chunk, 0.0)).sum(axis=2) / \
+                                                       weights.sum(axis=2)
+        return result
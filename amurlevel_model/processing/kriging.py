@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+
+import pandas as pd
+import numpy as np
+from scipy.optimize import least_squares
+from typing import Optional, Tuple
+
+KRIGING_EPS = 1e-10 # расстояние, меньше которого точка считается совпадающей с метеостанцией (как в pykrige)
+NLAGS = 6 # количество бинов по расстоянию в эмпирической вариограмме (как в pykrige)
+
+
+def great_circle_distance(lon1: np.ndarray, lat1: np.ndarray, lon2: np.ndarray, lat2: np.ndarray) -> np.ndarray:
+    '''
+    Расстояние по большому кругу в градусах (та же формула, что в pykrige)
+    :param lon1,lat1: np.ndarray, координаты первых точек в градусах
+    :param lon2,lat2: np.ndarray, координаты вторых точек в градусах
+    :return: np.ndarray, расстояния в градусах
+    '''
+    lat1 = np.array(lat1) * np.pi / 180.0
+    lat2 = np.array(lat2) * np.pi / 180.0
+    dlon = (lon2 - lon1) * np.pi / 180.0
+    c1, s1, c2, s2, cd = np.cos(lat1), np.sin(lat1), np.cos(lat2), np.sin(lat2), np.cos(dlon)
+    return 180.0 / np.pi * np.arctan2(np.sqrt((c2 * np.sin(dlon)) ** 2 + (c1 * s2 - s1 * c2 * cd) ** 2),
+                                      s1 * s2 + c1 * c2 * cd)
+
+
+def _unit_sphere(lon: np.ndarray, lat: np.ndarray) -> np.ndarray:
+    '''
+    Перевод координат в точки на единичной сфере (так pykrige ищет ближайших соседей)
+    '''
+    lon, lat = np.asarray(lon) * np.pi / 180.0, np.asarray(lat) * np.pi / 180.0
+    return np.stack([np.cos(lon) * np.cos(lat), np.sin(lon) * np.cos(lat), np.sin(lat)], axis=1)
+
+
+def spherical_variogram(params: Tuple[float, float, float], d: np.ndarray) -> np.ndarray:
+    '''
+    Сферическая модель вариограммы
+    :param params: (psill, range, nugget)
+    :param d: np.ndarray, расстояния
+    :return: np.ndarray
+    '''
+    psill, range_, nugget = params
+    d = np.asarray(d, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inside = psill * ((3.0 * d) / (2.0 * range_) - (d ** 3.0) / (2.0 * range_ ** 3.0)) + nugget
+    return np.where(d <= range_, inside, psill + nugget)
+
+
+def fit_spherical_variogram(d: np.ndarray, g: np.ndarray, counts: Optional[np.ndarray]=None,
+                            nlags: int=NLAGS) -> Tuple[float, float, float]:
+    '''
+    Подбор параметров сферической вариограммы по эмпирической (биннинг и soft_l1 как в pykrige)
+    :param d: np.ndarray, расстояния между парами точек
+    :param g: np.ndarray, полуквадраты разностей значений для пар (средние, если counts задан)
+    :param counts: np.ndarray, количество наблюдений, по которым усреднено g для каждой пары
+    :param nlags: int, количество бинов
+    :return: (psill, range, nugget)
+    '''
+    if counts is None:
+        counts = np.ones(len(d))
+    dmin, dmax = np.amin(d), np.amax(d)
+    dd = (dmax - dmin) / nlags
+    bins = [dmin + n * dd for n in range(nlags)] + [dmax + 0.001]
+    lags, semivariance = [], []
+    for n in range(nlags):
+        in_bin = (d >= bins[n]) & (d < bins[n + 1])
+        if counts[in_bin].sum() > 0:
+            lags.append(np.average(d[in_bin], weights=counts[in_bin]))
+            semivariance.append(np.average(g[in_bin], weights=counts[in_bin]))
+    lags, semivariance = np.array(lags), np.array(semivariance)
+
+    x0 = [np.amax(semivariance) - np.amin(semivariance), 0.25 * np.amax(lags), np.amin(semivariance)]
+    bnds = ([0.0, 0.0, 0.0], [10.0 * np.amax(semivariance), np.amax(lags), np.amax(semivariance)])
+    res = least_squares(lambda params: spherical_variogram(params, lags) - semivariance,
+                        x0, bounds=bnds, loss='soft_l1')
+    return tuple(float(param) for param in res.x)
+
+
+def get_season(dates: pd.DatetimeIndex) -> np.ndarray:
+    '''
+    Сезон для каждой даты: 0 - зима (дек-фев), 1 - весна, 2 - лето, 3 - осень
+    '''
+    return np.asarray(pd.DatetimeIndex(dates).month) % 12 // 3
+
+
+class KrigingEngine():
+    '''
+    Ординарный кригинг по n_closest_points ближайшим метеостанциям (сферическая вариограмма,
+    географические координаты) с переиспользованием вычислений между днями:
+    - матрицы расстояний метео x метео и гидро x метео считаются один раз
+    - параметры вариограммы подбираются один раз на признак и сезон по всем дням сезона
+    - веса кригинга (метео x гидро) кэшируются для каждого набора метеостанций, где признак не пропущен
+    Тогда интерполяция признака за все дни с одинаковым набором станций - одно умножение матриц
+    '''
+
+    def __init__(self, meteo_lon: np.ndarray, meteo_lat: np.ndarray,
+                 hydro_lon: np.ndarray, hydro_lat: np.ndarray, n_closest_points: int=3):
+        '''
+        :param meteo_lon,meteo_lat: np.ndarray, координаты метеостанций
+        :param hydro_lon,hydro_lat: np.ndarray, координаты гидростанций
+        :param n_closest_points: int, по скольким ближайшим метеостанциям интерполируем
+        '''
+        meteo_lon, meteo_lat = np.asarray(meteo_lon, dtype=np.float64), np.asarray(meteo_lat, dtype=np.float64)
+        self.n_closest_points = n_closest_points
+        self.n_hydro = len(hydro_lon)
+        self.meteo_dist = great_circle_distance(meteo_lon[:, None], meteo_lat[:, None],
+                                                meteo_lon[None, :], meteo_lat[None, :])
+        # как в pykrige: соседи ищутся по хорде на единичной сфере, затем хорда переводится в градусы
+        chord = np.linalg.norm(_unit_sphere(hydro_lon, hydro_lat)[:, None, :] -
+                               _unit_sphere(meteo_lon, meteo_lat)[None, :, :], axis=2)
+        self.hydro_chord = chord
+        self.hydro_dist = 180.0 / np.pi * 2.0 * np.arcsin(0.5 * chord)
+        self.variograms = {} # (признак, сезон) -> параметры вариограммы
+        self._weights = {} # (параметры вариограммы, маска метеостанций) -> матрица весов
+
+    def fit_variogram(self, values: np.ndarray) -> Optional[Tuple[float, float, float]]:
+        '''
+        Подбор вариограммы по всем дням сразу: для каждой пары метеостанций полуквадрат разности
+        усредняется по дням, где у обеих станций есть значение
+        :param values: np.ndarray (дни x метеостанции), пропуски - np.nan
+        :return: (psill, range, nugget) или None, если нет ни одной пары станций с общими днями
+                 (например, все дни сезона с одинаковыми значениями)
+        '''
+        valid = (~np.isnan(values)).astype(np.float64)
+        filled = np.where(np.isnan(values), 0.0, values)
+        counts = valid.T @ valid
+        squares = (filled ** 2).T @ valid
+        sum_g = 0.5 * (squares + squares.T - 2.0 * filled.T @ filled)
+        upper = np.triu_indices(len(counts), k=1)
+        counts, sum_g, d = counts[upper], sum_g[upper], self.meteo_dist[upper]
+        used = counts > 0
+        if not used.any():
+            return None
+        return fit_spherical_variogram(d[used], sum_g[used] / counts[used], counts[used])
+
+    def weights(self, params: Optional[Tuple[float, float, float]], mask: np.ndarray) -> np.ndarray:
+        '''
+        Матрица весов кригинга для набора метеостанций
+        :param params: параметры вариограммы. None (вариограмму не по чему подобрать) - среднее
+                       по n_closest_points ближайшим метеостанциям
+        :param mask: np.ndarray bool, метеостанции, где значение есть
+        :return: np.ndarray (метеостанции x гидростанции), столбцы в сумме дают 1
+        '''
+        key = (params, np.packbits(mask).tobytes())
+        if key in self._weights:
+            return self._weights[key]
+
+        stations = np.where(mask)[0]
+        n = min(self.n_closest_points, len(stations))
+        weights = np.zeros((len(mask), self.n_hydro), dtype=np.float64)
+        closest = stations[np.argsort(self.hydro_chord[:, stations], axis=1, kind='stable')[:, :n]] # гидро x n
+        if params is None:
+            np.add.at(weights, (closest, np.repeat(np.arange(self.n_hydro)[:, None], n, axis=1)), 1.0 / n)
+            self._weights[key] = weights
+            return weights
+        bd = np.take_along_axis(self.hydro_dist, closest, axis=1)
+
+        a = np.ones((self.n_hydro, n + 1, n + 1), dtype=np.float64)
+        a[:, :n, :n] = -spherical_variogram(params, self.meteo_dist[closest[:, :, None], closest[:, None, :]])
+        a[:, np.arange(n), np.arange(n)] = 0.0
+        a[:, n, n] = 0.0
+        b = np.ones((self.n_hydro, n + 1), dtype=np.float64)
+        b[:, :n] = np.where(np.abs(bd) <= KRIGING_EPS, 0.0, -spherical_variogram(params, bd))
+        x = np.linalg.solve(a, b[:, :, None])[:, :n, 0]
+        np.add.at(weights, (closest, np.repeat(np.arange(self.n_hydro)[:, None], n, axis=1)), x)
+        self._weights[key] = weights
+        return weights
+
+    def interpolate(self, prop: str, dates: pd.DatetimeIndex, values: np.ndarray) -> np.ndarray:
+        '''
+        Интерполяция признака за все дни в точки гидростанций
+        Дни с одинаковыми сезоном и набором метеостанций считаются одним умножением матриц
+        :param prop: str, название признака (ключ для кэша вариограмм)
+        :param dates: pd.DatetimeIndex, даты (строки values)
+        :param values: np.ndarray (дни x метеостанции), пропуски - np.nan
+        :return: np.ndarray (дни x гидростанции)
+        '''
+        result = np.full((len(values), self.n_hydro), np.nan)
+        seasons = get_season(dates)
+        valid = ~np.isnan(values)
+        filled = np.where(valid, values, 0.0)
+        constant = np.where(valid, values, -np.inf).max(axis=1) == np.where(valid, values, np.inf).min(axis=1)
+        for season in np.unique(seasons):
+            in_season = seasons == season
+            if (prop, season) not in self.variograms:
+                self.variograms[(prop, season)] = self.fit_variogram(values[in_season & ~constant])
+            params = self.variograms[(prop, season)]
+
+            masks, inverse = np.unique(valid[in_season], axis=0, return_inverse=True)
+            days = np.where(in_season)[0]
+            for i, mask in enumerate(masks):
+                if not mask.any():
+                    continue
+                group = days[inverse.ravel() == i]
+                result[group] = filled[group] @ self.weights(params, mask)
+
+        # если все значения за день одинаковые - берем среднее (как в исходной реализации)
+        means = filled.sum(axis=1) / np.maximum(valid.sum(axis=1), 1)
+        result[constant] = means[constant][:, None]
+        return result
+
+    def check_against_pykrige(self, values: np.ndarray, meteo_lon: np.ndarray, meteo_lat: np.ndarray,
+                              hydro_lon: np.ndarray, hydro_lat: np.ndarray, interpolated: np.ndarray,
+                              n_days: int=10, seed: int=0) -> float:
+        '''
+        Сравнение с OrdinaryKriging из pykrige (вариограмма подбирается по каждому дню отдельно)
+        на случайной выборке дней
+        :param values: np.ndarray (дни x метеостанции), исходные значения
+        :param interpolated: np.ndarray (дни x гидростанции), результат interpolate
+        :param n_days: int, количество дней для проверки
+        :return: float, максимальное отклонение, деленное на стандартное отклонение признака
+        '''
+        from pykrige.ok import OrdinaryKriging
+
+        valid = ~np.isnan(values)
+        candidates = np.where(valid.sum(axis=1) > self.n_closest_points)[0]
+        days = np.random.RandomState(seed).choice(candidates, min(n_days, len(candidates)), replace=False)
+        max_diff = 0.0
+        for day in days:
+            mask = valid[day]
+            day_values = values[day, mask]
+            if day_values.max() == day_values.min():
+                continue
+            OK = OrdinaryKriging(meteo_lon[mask], meteo_lat[mask], day_values,
+                                 variogram_model='spherical', coordinates_type="geographic")
+            expected, ss1 = OK.execute("points", hydro_lon, hydro_lat, backend="C",
+                                       n_closest_points=self.n_closest_points)
+            max_diff = max(max_diff, np.max(np.abs(np.asarray(expected) - interpolated[day])))
+        std = np.nanstd(values)
+        return max_diff / std if std > 0 else max_diff
@@ -4,23 +4,246 @@ import pandas as pd
 from geopandas.geodataframe import GeoDataFrame
 import numpy as np
 from pykrige.ok import OrdinaryKriging
-from sklearn.neighbors import KDTree
 import gc
-from typing import Optional
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Optional, List, Tuple
 import logging
 from tqdm import tqdm
 
+from ..config import N_JOBS
 from ..dataloaders.asunp import get_asunp_hydro_stations
+from ..utils.common import get_n_jobs
+from .kriging import KrigingEngine
+from .interpolation import NeighboursInterpolator, rank_nearest_stations
+
+# численные метео параметры, которые интерполируются кригингом на гидростанции
+KRIGING_COLS = ['windDirection', 'windSpeed', 'maximumWindGustSpeed',
+                'totalAccumulatedPrecipitation', 'soilTemperature', 'airTemperature_min', 'airTemperature_max',
+                'relativeHumidity', 'pressureReducedToMeanSeaLevel', 'pressure']
+
+INTERPOLATORS = ('kriging', 'kriging_exact', 'idw', 'nearest') # способы интерполяции метео в точки гидростанций
+
+CATEGORICAL_COLS = ['pastWeather', 'presentWeather', 'cloudCoverTotal'] # берутся с ближайшей метеостанции
+
+KRIGING_DAYS_PER_TASK = 64 # количество дней в одной задаче для процесса при параллельном кригинге
+KRIGING_CHECK_DAYS = 10 # количество случайных дней для сверки KrigingEngine с pykrige по каждому признаку
+KRIGING_TOLERANCE = 0.25 # допустимое отклонение от pykrige (в стандартных отклонениях признака)
+
+
+def join_nearest_categorical(full_df: pd.DataFrame, meteo_df: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Категориальные метео признаки (CATEGORICAL_COLS) для каждой строки гидро берутся с ближайшей метеостанции,
+    у которой за этот день есть значение, иначе - со следующей по удаленности.
+    Порядок метеостанций для каждой точки гидростанции считается один раз, дальше значения выбираются
+    по целочисленному ключу (день, метеостанция) из плотного массива
+    :param full_df: pd.DataFrame, данные с гидростанций (date, lon, lat)
+    :param meteo_df: pd.DataFrame, метео данные (identifier, datetime, lon, lat и CATEGORICAL_COLS)
+    :return: pd.DataFrame, full_df с добавленными CATEGORICAL_COLS (np.nan, если за день нет метео)
+    '''
+    stations = meteo_df.drop_duplicates('identifier')[['identifier', 'lon', 'lat']]
+    meteo_days = meteo_df['datetime'].values.astype('datetime64[D]').astype(np.int64)
+    first_day = meteo_days.min()
+    n_days = meteo_days.max() - first_day + 1
+    station_index = pd.Index(stations['identifier']).get_indexer(meteo_df['identifier'])
+    values = np.full((n_days, len(stations), len(CATEGORICAL_COLS)), np.nan)
+    values[meteo_days - first_day, station_index] = meteo_df[CATEGORICAL_COLS].values.astype(np.float64)
+
+    # ранжирование метеостанций по уникальным точкам гидростанций
+    points, point_index = np.unique(full_df[['lon', 'lat']].values.astype(np.float64), axis=0, return_inverse=True)
+    point_index = point_index.ravel()
+    known = ~np.isnan(points).any(axis=1)
+    ranking = np.zeros((len(points), len(stations)), dtype=np.int64)
+    ranking[known] = rank_nearest_stations(stations['lon'].values, stations['lat'].values,
+                                           points[known, 0], points[known, 1])
+
+    hydro_days = full_df['date'].values.astype('datetime64[D]').astype(np.int64) - first_day
+    rows = np.where((hydro_days >= 0) & (hydro_days < n_days) & known[point_index])[0]
+    result = np.full((len(full_df), len(CATEGORICAL_COLS)), np.nan)
+    for i in range(len(CATEGORICAL_COLS)):
+        pending = rows
+        for rank in range(len(stations)):
+            if len(pending) == 0:
+                break
+            candidate = values[hydro_days[pending], ranking[point_index[pending], rank], i]
+            found = ~np.isnan(candidate)
+            result[pending[found], i] = candidate[found]
+            pending = pending[~found]
+
+    full_df = full_df.copy()
+    for i, col in enumerate(CATEGORICAL_COLS):
+        full_df[col] = result[:, i]
+    return full_df
+
+
+def krige_day(day_meteo: pd.DataFrame, hydro_lon: np.ndarray, hydro_lat: np.ndarray) -> np.ndarray:
+    '''
+    Кригинг численных метео параметров за один день в точки гидростанций
+    :param day_meteo: pd.DataFrame, метео данные за день (lon, lat и KRIGING_COLS)
+    :param hydro_lon: np.ndarray, долготы гидростанций
+    :param hydro_lat: np.ndarray, широты гидростанций
+    :return: np.ndarray размера (гидростанции x KRIGING_COLS)
+    '''
+    result = np.empty((len(hydro_lon), len(KRIGING_COLS)), dtype=np.float64)
+    for i, prop in enumerate(KRIGING_COLS):
+        notnull = day_meteo[prop].notnull()
+        longitudes = day_meteo[notnull].lon
+        latitudes = day_meteo[notnull].lat
+        values = day_meteo[notnull][prop].values
+        if values.max() == values.min():
+            interpolated_values = np.full(len(hydro_lon), values.mean())
+        else:
+            OK = OrdinaryKriging(
+                longitudes,
+                latitudes,
+                values,
+                variogram_model='spherical',
+                coordinates_type="geographic")
+            interpolated_values, ss1 = OK.execute("points", hydro_lon, hydro_lat, backend="C", n_closest_points=3)
+        result[:, i] = interpolated_values
+    return result
+
+
+def krige_days(days_meteo: List[pd.DataFrame], hydro_lon: np.ndarray, hydro_lat: np.ndarray) -> np.ndarray:
+    '''
+    Кригинг для нескольких дней подряд (одна задача для процесса)
+    :param days_meteo: list, метео данные по дням
+    :return: np.ndarray размера (дни x гидростанции x KRIGING_COLS)
+    '''
+    result = np.empty((len(days_meteo), len(hydro_lon), len(KRIGING_COLS)), dtype=np.float64)
+    for i, day_meteo in enumerate(days_meteo):
+        result[i] = krige_day(day_meteo, hydro_lon, hydro_lat)
+    return result
+
+
+def pivot_meteo(meteo_df: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Перевод метео данных в массив (дни x метеостанции x KRIGING_COLS)
+    :param meteo_df: pd.DataFrame, метео данные (identifier, datetime, lon, lat и KRIGING_COLS)
+    :return: (дни, долготы метеостанций, широты метеостанций, массив значений с np.nan на месте пропусков)
+    '''
+    stations = meteo_df.drop_duplicates('identifier')[['identifier', 'lon', 'lat']]
+    days = np.sort(meteo_df['datetime'].unique()).astype('datetime64[ns]')
+    day_index = np.searchsorted(days, meteo_df['datetime'].values)
+    station_index = pd.Index(stations['identifier']).get_indexer(meteo_df['identifier'])
+    values = np.full((len(days), len(stations), len(KRIGING_COLS)), np.nan)
+    values[day_index, station_index] = meteo_df[KRIGING_COLS].values.astype(np.float64)
+    return days, stations['lon'].values.astype(np.float64), stations['lat'].values.astype(np.float64), values
+
+
+def krige_exact(meteo_df: pd.DataFrame, hydro_lon: np.ndarray, hydro_lat: np.ndarray,
+                n_jobs: Optional[int]=N_JOBS) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Кригинг через pykrige отдельно для каждого дня, дни распределяются по n_jobs процессам
+    :param meteo_df: pd.DataFrame, метео данные (datetime, lon, lat и KRIGING_COLS)
+    :param hydro_lon: np.ndarray, долготы гидростанций
+    :param hydro_lat: np.ndarray, широты гидростанций
+    :param n_jobs: int, количество процессов, None - по количеству ядер, 1 - без распараллеливания
+    :return: (дни, np.ndarray размера дни x гидростанции x KRIGING_COLS)
+    '''
+    days, days_meteo = [], []
+    for day, day_meteo in meteo_df[['datetime', 'lon', 'lat'] + KRIGING_COLS].groupby('datetime'):
+        days.append(day)
+        days_meteo.append(day_meteo)
+    kriged = np.empty((len(days), len(hydro_lon), len(KRIGING_COLS)), dtype=np.float64)
+
+    tasks = [days_meteo[i:i + KRIGING_DAYS_PER_TASK] for i in range(0, len(days_meteo), KRIGING_DAYS_PER_TASK)]
+    n_jobs = min(get_n_jobs(n_jobs), len(tasks))
+    krige_task = partial(krige_days, hydro_lon=hydro_lon, hydro_lat=hydro_lat)
+    with tqdm(total=len(days)) as pbar:
+        if n_jobs > 1:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                results = executor.map(krige_task, tasks)
+                for i, result in enumerate(results):
+                    kriged[i * KRIGING_DAYS_PER_TASK:i * KRIGING_DAYS_PER_TASK + len(result)] = result
+                    pbar.update(len(result))
+        else:
+            for i, task in enumerate(tasks):
+                kriged[i * KRIGING_DAYS_PER_TASK:i * KRIGING_DAYS_PER_TASK + len(task)] = krige_task(task)
+                pbar.update(len(task))
+    return np.array(days, dtype='datetime64[ns]'), kriged
+
+
+def krige_cached(meteo_df: pd.DataFrame, hydro_lon: np.ndarray, hydro_lat: np.ndarray,
+                 check_days: int=KRIGING_CHECK_DAYS) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Кригинг через KrigingEngine: каждый признак за все дни считается умножением матриц
+    (дни x метеостанции) @ (метеостанции x гидростанции) с кэшированными весами.
+    Для check_days случайных дней результат сверяется с pykrige, при большом отклонении пишется warning
+    :param meteo_df: pd.DataFrame, метео данные (identifier, datetime, lon, lat и KRIGING_COLS)
+    :param hydro_lon: np.ndarray, долготы гидростанций
+    :param hydro_lat: np.ndarray, широты гидростанций
+    :param check_days: int, количество дней для сверки с pykrige, 0 - не сверять
+    :return: (дни, np.ndarray размера дни x гидростанции x KRIGING_COLS)
+    '''
+    logger = logging.getLogger()
+    days, meteo_lon, meteo_lat, values = pivot_meteo(meteo_df)
+    engine = KrigingEngine(meteo_lon, meteo_lat, hydro_lon, hydro_lat)
+    kriged = np.empty((len(days), len(hydro_lon), len(KRIGING_COLS)), dtype=np.float64)
+    for i, prop in enumerate(tqdm(KRIGING_COLS)):
+        kriged[:, :, i] = engine.interpolate(prop, pd.DatetimeIndex(days), values[:, :, i])
+        if check_days > 0:
+            deviation = engine.check_against_pykrige(values[:, :, i], meteo_lon, meteo_lat, hydro_lon, hydro_lat,
+                                                     kriged[:, :, i], n_days=check_days)
+            if deviation > KRIGING_TOLERANCE:
+                logger.warning(f'Kriging for {prop} deviates from pykrige by {deviation:.3f} std '
+                               f'(tolerance {KRIGING_TOLERANCE}), consider interpolator="kriging_exact"')
+    return days, kriged
+
+
+def interpolate_neighbours(meteo_df: pd.DataFrame, hydro_lon: np.ndarray, hydro_lat: np.ndarray,
+                           method: str) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Интерполяция по ближайшим метеостанциям (idw или среднее), сразу по всем дням и признакам
+    :param meteo_df: pd.DataFrame, метео данные (identifier, datetime, lon, lat и KRIGING_COLS)
+    :param hydro_lon: np.ndarray, долготы гидростанций
+    :param hydro_lat: np.ndarray, широты гидростанций
+    :param method: str, 'idw' или 'nearest' (см. NeighboursInterpolator)
+    :return: (дни, np.ndarray размера дни x гидростанции x KRIGING_COLS)
+    '''
+    days, meteo_lon, meteo_lat, values = pivot_meteo(meteo_df)
+    interpolator = NeighboursInterpolator(meteo_lon, meteo_lat, hydro_lon, hydro_lat, method=method)
+    return days, interpolator.interpolate(values)
+
+
+def interpolate_meteo(meteo_df: pd.DataFrame, hydro_lon: np.ndarray, hydro_lat: np.ndarray,
+                      interpolator: str='kriging_exact', n_jobs: Optional[int]=N_JOBS) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Интерполяция численных метео параметров в точки гидростанций выбранным способом (см. INTERPOLATORS)
+    :param meteo_df: pd.DataFrame, метео данные (identifier, datetime, lon, lat и KRIGING_COLS)
+    :param hydro_lon: np.ndarray, долготы гидростанций
+    :param hydro_lat: np.ndarray, широты гидростанций
+    :param interpolator: str, способ интерполяции
+    :param n_jobs: int, количество процессов для kriging_exact
+    :return: (дни, np.ndarray размера дни x гидростанции x KRIGING_COLS)
+    '''
+    if interpolator == 'kriging':
+        return krige_cached(meteo_df, hydro_lon, hydro_lat)
+    if interpolator == 'kriging_exact':
+        return krige_exact(meteo_df, hydro_lon, hydro_lat, n_jobs)
+    if interpolator in ('idw', 'nearest'):
+        return interpolate_neighbours(meteo_df, hydro_lon, hydro_lat, interpolator)
+    raise ValueError(f'Unknown interpolator {interpolator}, expected one of {INTERPOLATORS}')
+
 
 def merge_hydro_meteo(hydro_df: pd.DataFrame, meteo_df: pd.DataFrame,
-                                   asunp_hydro: Optional[GeoDataFrame]=None) -> pd.DataFrame:
+                                   asunp_hydro: Optional[GeoDataFrame]=None,
+                                   n_jobs: Optional[int]=N_JOBS, interpolator: str='kriging_exact') -> pd.DataFrame:
     '''
     Мердж данных с гидростанций с историческими метеоданными
     Для категориальных значений ищется ближайшая метеостанция
-    Для численных значений применяется кригинг по трем ближайшим меоестанциям
+    Для численных значений применяется кригинг по трем ближайшим меоестанциям (или более быстрая интерполяция):
+    - interpolator='kriging_exact' - через pykrige отдельно для каждого дня (параллельно, результат не зависит от n_jobs).
+      По умолчанию: на таких признаках обучены веса модели
+    - interpolator='kriging' - через KrigingEngine (вариограммы по сезонам, кэш весов). Быстрее, но приближенно:
+      отдельные значения отличаются от pykrige на единицы (до ~0.8 стандартного отклонения признака)
+    - interpolator='idw' - обратно взвешенные расстояния по трем ближайшим метеостанциям
+    - interpolator='nearest' - среднее по трем ближайшим метеостанциям
     :param hydro_df: pd.DataFrame, датафрейм с данными с гидростанций
     :param meteo_df: pd.DataFrame, датафрейм с метео данными
     :param asunp_hydro: GeoDataFrame, датафрейм с гидростанциями. Если None, то выгружается по API
+    :param n_jobs: int, количество процессов для kriging_exact, None - по количеству ядер, 1 - без распараллеливания
+    :param interpolator: str, способ интерполяции численных признаков (см. INTERPOLATORS)
     :return: pd.DataFrame, смердженный датафрейм с гидро-метео данными
     '''
     logger = logging.getLogger()
@@ -29,52 +252,22 @@ def merge_hydro_meteo(hydro_df: pd.DataFrame, meteo_df: pd.DataFrame,
     if asunp_hydro is None:
         asunp_hydro = get_asunp_hydro_stations()
     # ---- добавляем категориальные признаки - их заменяаем по ближайшему соседу
-    meteo_df['ts'] = (meteo_df['datetime'].astype(np.int64) / 10 ** 10)*2
-    full_df['ts'] = (full_df['date'].values.astype(np.int64) / 10 ** 10)*2
-    kd = KDTree(meteo_df[['lon', 'lat', 'ts']])
-    union_ind = full_df[full_df['ts'].astype(np.int).astype(str).isin(meteo_df['ts'].astype(np.int).astype(str))].index
-    indices = kd.query(full_df.loc[union_ind][['lon', 'lat', 'ts']], 1, return_distance=False)[:, 0]
-    for col in ['pastWeather', 'presentWeather', 'cloudCoverTotal']:
-        full_df[col] = np.nan
-        full_df.loc[union_ind,col] = meteo_df.iloc[indices][col].values
-
-    del kd
-    gc.collect()
+    full_df = join_nearest_categorical(full_df, meteo_df)
 
     # ---- численные признаки с помощью киргинга по 3 ближайшим соседям (как в примере решения)
-    new_df = pd.DataFrame(columns=['identifier', 'date', 'windDirection', 'windSpeed', 'maximumWindGustSpeed',
-                                   'totalAccumulatedPrecipitation', 'soilTemperature', 'airTemperature_min',
-                                   'airTemperature_max',
-                                   'relativeHumidity', 'pressureReducedToMeanSeaLevel', 'pressure'])
-    logger.info('Kriging for meteo')
-    for day, day_meteo in tqdm(meteo_df.groupby('datetime'),total=len(meteo_df['datetime'].unique())):
-        part_df = pd.DataFrame(columns=['identifier', 'date', 'windDirection', 'windSpeed', 'maximumWindGustSpeed',
-                                        'totalAccumulatedPrecipitation', 'soilTemperature', 'airTemperature_min',
-                                        'airTemperature_max',
-                                        'relativeHumidity', 'pressureReducedToMeanSeaLevel', 'pressure'])
-        part_df['identifier'] = asunp_hydro.index.values
-        part_df['date'] = [day] * len(part_df)
-        for prop in ['windDirection', 'windSpeed', 'maximumWindGustSpeed',
-                     'totalAccumulatedPrecipitation', 'soilTemperature', 'airTemperature_min', 'airTemperature_max',
-                     'relativeHumidity', 'pressureReducedToMeanSeaLevel', 'pressure']:
-            longitudes = day_meteo[day_meteo[prop].notnull()].lon
-            latitudes = day_meteo[day_meteo[prop].notnull()].lat
-            values = day_meteo[day_meteo[prop].notnull()][prop].values
-            if values.max() == values.min():
-                interpolated_values = np.full(len(asunp_hydro), values.mean())
-            else:
-                OK = OrdinaryKriging(
-                    longitudes,
-                    latitudes,
-                    values,
-                    variogram_model='spherical',
-                    coordinates_type="geographic")
-                interpolated_values, ss1 = OK.execute("points", asunp_hydro.lon, asunp_hydro.lat, backend="C", n_closest_points=3)
-            part_df[prop] = interpolated_values
-        new_df = new_df.append(part_df)
-        gc.collect()
+    # результаты пишутся в заранее выделенный массив (дни x гидростанции x признаки)
+    logger.info(f'Interpolation of meteo ({interpolator})')
+    hydro_lon, hydro_lat = asunp_hydro.lon.values, asunp_hydro.lat.values
+    days, kriged = interpolate_meteo(meteo_df, hydro_lon, hydro_lat, interpolator, n_jobs)
+    gc.collect()
+
+    new_df = pd.DataFrame(kriged.reshape(-1, len(KRIGING_COLS)), columns=KRIGING_COLS)
+    new_df.insert(0, 'identifier', np.tile(asunp_hydro.index.values, len(days)))
+    new_df.insert(1, 'date', np.repeat(np.array(days, dtype='datetime64[ns]'), len(asunp_hydro)))
     full_df = full_df.merge(new_df, on=['identifier', 'date'], how='left')
-    new_df = new_df[new_df['date'] > full_df['date'].max()]
+    # дни после последней даты гидро (или все дни, если гидро данных нет) - только с метео
+    if not full_df.empty:
+        new_df = new_df[new_df['date'] > full_df['date'].max()]
     if not new_df.empty:
         full_df = pd.concat([full_df,new_df],ignore_index=True)
-    return full_df
\ No newline at end of file
+    return full_df
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import queue
+import threading
+import time
+import logging
+from concurrent.futures import Future
+from typing import Callable, Dict, Hashable, List
+
+from ..config import SERVE_MAX_BATCH, SERVE_BATCH_WAIT_MS
+
+
+class _Request():
+
+    def __init__(self, key: Hashable, inputs: np.ndarray):
+        self.key = key
+        self.inputs = inputs
+        self.future = Future()
+
+
+class MicroBatcher():
+    '''
+    Объединение одновременных запросов к модели в один вызов predict_fn.
+    Запросы копятся в очереди: батч отправляется, когда набралось max_batch окон или прошло max_wait секунд
+    с первого запроса батча. Запросы с разными ключами (например, весами модели) считаются отдельными вызовами.
+    predict_fn вызывается только из одного фонового потока
+    '''
+
+    def __init__(self, predict_fn: Callable[[Hashable, np.ndarray], np.ndarray],
+                 max_batch: int=SERVE_MAX_BATCH, max_wait: float=SERVE_BATCH_WAIT_MS / 1000):
+        '''
+        :param predict_fn: функция (ключ, входы [n, ...]) -> выходы [n, ...]
+        :param max_batch: int, максимальное количество окон в одном вызове
+        :param max_wait: float, сколько секунд ждать другие запросы после первого
+        '''
+        self.predict_fn = predict_fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.n_calls = 0
+        self.n_requests = 0
+        self.thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self.thread.start()
+
+    def submit(self, key: Hashable, inputs: np.ndarray) -> np.ndarray:
+        '''
+        Предсказание для входов inputs [n, ...] (блокирует до готовности батча)
+        :param key: ключ модели
+        :param inputs: np.ndarray, входы модели
+        :return: np.ndarray, выходы модели для этих входов
+        '''
+        request = _Request(key, inputs)
+        self.queue.put(request)
+        return request.future.result()
+
+    def close(self) -> None:
+        self.queue.put(None)
+        self.thread.join()
+
+    def _collect(self, first: _Request) -> List[_Request]:
+        batch, size = [first], len(first.inputs)
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                self.queue.put(None) # остановка после обработки текущего батча
+                break
+            batch.append(request)
+            size += len(request.inputs)
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            first = self.queue.get()
+            if first is None:
+                return
+            groups: Dict[Hashable, List[_Request]] = {}
+            for request in self._collect(first):
+                groups.setdefault(request.key, []).append(request)
+            for key, requests in groups.items():
+                self._predict(key, requests)
+
+    def _predict(self, key: Hashable, requests: List[_Request]) -> None:
+        try:
+            outputs = self.predict_fn(key, np.concatenate([request.inputs for request in requests]))
+        except Exception as e:
+            logging.getLogger().exception(f'Batch prediction failed for {key}')
+            for request in requests:
+                request.future.set_exception(e)
+            return
+        self.n_calls += 1
+        self.n_requests += len(requests)
+        offset = 0
+        for request in requests:
+            request.future.set_result(outputs[offset:offset + len(request.inputs)])
+            offset += len(request.inputs)
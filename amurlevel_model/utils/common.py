@@ -1,6 +1,13 @@
 from datetime import datetime
+import codecs
 import logging
+import os
 import sys
+import numpy as np
+import pandas as pd
+from typing import Iterable,Optional
+
+INVALID_DATE = datetime(2100, 12, 31) # дата, которую получают нераспарсенные даты в исходных данных
 
 def dateparse(date_str: str) -> datetime:
     '''
@@ -11,7 +18,117 @@ def dateparse(date_str: str) -> datetime:
     try:
         return datetime.strptime(date_str, '%d.%m.%Y')
     except:
-        return datetime(2100, 12, 31)
+        return INVALID_DATE
+
+def parse_dates(values: Iterable) -> pd.DatetimeIndex:
+    '''
+    Векторизованный аналог dateparse для массива строк в формате %d.%m.%Y
+    Строки ровно вида dd.mm.yyyy разбираются по позициям символов без вызова strptime,
+    остальные (например, без ведущих нулей) - через dateparse.
+    Невалидные даты и даты, не помещающиеся в datetime64[ns], заменяются на INVALID_DATE
+    :param values: Iterable, массив строк с датами
+    :return: pd.DatetimeIndex
+    '''
+    values = pd.Series(values, dtype=object)
+    strings = values.where(values.map(type) == str, '').values.astype('U11')
+    codes = strings.view(np.uint32).reshape(-1, 11).astype(np.int64)
+    digits = codes - ord('0')
+    fixed_width = ((digits[:, [0, 1, 3, 4, 6, 7, 8, 9]] >= 0) & (digits[:, [0, 1, 3, 4, 6, 7, 8, 9]] <= 9)).all(axis=1) & \
+                  (codes[:, 2] == ord('.')) & (codes[:, 5] == ord('.')) & (codes[:, 10] == 0)
+
+    day = digits[:, 0] * 10 + digits[:, 1]
+    month = digits[:, 3] * 10 + digits[:, 4]
+    year = digits[:, 6] * 1000 + digits[:, 7] * 100 + digits[:, 8] * 10 + digits[:, 9]
+    valid = fixed_width & (year >= 1) & (month >= 1) & (month <= 12) & (day >= 1)
+    months = np.where(valid, (year - 1970) * 12 + month - 1, 0).astype('datetime64[M]')
+    days_in_month = ((months + 1).astype('datetime64[D]') - months.astype('datetime64[D]')).astype(np.int64)
+    valid &= day <= days_in_month
+
+    result = np.full(len(strings), np.datetime64(INVALID_DATE, 'D'))
+    result[valid] = months[valid].astype('datetime64[D]') + (day[valid] - 1)
+    # даты, не помещающиеся в datetime64[ns], считаем невалидными
+    in_bounds = (result >= np.datetime64(pd.Timestamp.min.ceil('D'), 'D')) & \
+                (result <= np.datetime64(pd.Timestamp.max.floor('D'), 'D'))
+    result[~in_bounds] = np.datetime64(INVALID_DATE, 'D')
+    result = result.astype('datetime64[ns]')
+
+    for i in np.where(~fixed_width)[0]:
+        parsed = dateparse(values.iat[i])
+        result[i] = np.datetime64(parsed if pd.Timestamp.min <= parsed <= pd.Timestamp.max else INVALID_DATE, 'ns')
+    return pd.DatetimeIndex(result)
+
+def interpolate_linear(df: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Быстрый аналог df.interpolate(method='linear') для численных колонок (через np.interp):
+    пропуски внутри ряда заполняются линейно (значения считаются равноотстоящими),
+    пропуски в конце - последним известным значением, пропуски в начале остаются
+    :param df: pd.DataFrame
+    :return: pd.DataFrame
+    '''
+    df = df.copy()
+    for col in df.columns:
+        values = df[col].values
+        if values.dtype.kind != 'f':
+            continue
+        nans = np.isnan(values)
+        if nans.all() or not nans.any():
+            continue
+        positions = np.arange(len(values))
+        filled = values.copy()
+        filled[nans] = np.interp(positions[nans], positions[~nans], values[~nans])
+        filled[:np.argmin(nans)] = np.nan
+        df[col] = filled
+    return df
+
+def detect_encoding(fname: str, prefix_size: int = 65536) -> str:
+    '''
+    Определение кодировки файла по первым байтам: utf-8, если префикс корректно декодируется, иначе cp1251
+    :param fname: str, путь до файла
+    :param prefix_size: int, количество байт для проверки
+    :return: str, кодировка
+    '''
+    with open(fname, 'rb') as f:
+        prefix = f.read(prefix_size)
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(prefix, final=False)
+    except UnicodeDecodeError:
+        return 'cp1251'
+    return 'utf-8'
+
+def get_n_jobs(n_jobs: Optional[int]=None) -> int:
+    '''
+    Количество процессов для параллельной обработки
+    :param n_jobs: int, если None или <= 0 - по количеству ядер
+    :return: int
+    '''
+    if n_jobs is None or n_jobs <= 0:
+        return os.cpu_count() or 1
+    return n_jobs
+
+def evict_lru_files(cache_dir: str, max_size_mb: float, suffix: str) -> None:
+    '''
+    Удаление самых давно использованных файлов кэша (по времени изменения), пока размер кэша больше max_size_mb
+    :param cache_dir: str, директория кэша
+    :param max_size_mb: float, максимальный размер кэша
+    :param suffix: str, расширение файлов с записями кэша
+    '''
+    entries = []
+    for _f in os.listdir(cache_dir):
+        if _f.endswith(suffix):
+            try:
+                stat = os.stat(os.path.join(cache_dir, _f))
+            except FileNotFoundError: # запись удалена параллельным процессом
+                continue
+            entries.append((stat.st_mtime, stat.st_size, _f))
+    total = sum(size for _, size, _ in entries)
+    for _, size, _f in sorted(entries):
+        if total <= max_size_mb * 1024 * 1024:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, _f))
+        except FileNotFoundError:
+            pass
+        total -= size
 
 def set_logger():
     '''
@@ -1,16 +1,103 @@
 import json
 import os
-from typing import Optional
+import hashlib
+import numpy as np
+from typing import List, Optional, Tuple
 from ..config import DATASETS_PATH
+from ..config_features import NUMERICAL_FEATURES, CATEGORICAL_FEATURES
+
+_STATS_CACHE = {} # (путь, mtime, размер файла) -> статистика
+_NORMALIZER_CACHE = {} # (путь, mtime, размер файла, колонки, нормализуемые колонки) -> Normalizer
+
+
+def _stats_key(fname: Optional[str]) -> Tuple[str, int, int]:
+    if fname is None:
+        fname = os.path.join(DATASETS_PATH,'mean_std_stats.json')
+    stat = os.stat(fname)
+    return os.path.abspath(fname), stat.st_mtime_ns, stat.st_size
+
 
 def get_normalizer_stats(fname: Optional[str]=None) -> dict:
     '''
     Получение данных со статистикой mean,std для каждой фичи для нормализации
+    Файл читается один раз и перечитывается только после изменения (результат общий - не изменять)
     :param fname: str, путь до файла json cо статистикой mean,std для каждого поля
     :return: dict
     '''
-    if fname is None:
-        fname = os.path.join(DATASETS_PATH,'mean_std_stats.json')
-    with open(fname, 'r', encoding='utf-8') as f:
-        normalizer_stats = json.loads(f.read())
-    return normalizer_stats
\ No newline at end of file
+    key = _stats_key(fname)
+    if key not in _STATS_CACHE:
+        with open(key[0], 'r', encoding='utf-8') as f:
+            normalizer_stats = json.loads(f.read())
+        for old_key in [_key for _key in _STATS_CACHE if _key[0] == key[0]]:
+            del _STATS_CACHE[old_key]
+        _STATS_CACHE[key] = normalizer_stats
+    return _STATS_CACHE[key]
+
+
+def stats_fingerprint(stats: dict) -> str:
+    '''
+    Хэш статистики нормализации (для проверки, что нормализованные данные посчитаны по той же статистике)
+    '''
+    return hashlib.sha1(json.dumps(stats, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class Normalizer():
+    '''
+    Нормализация (x - mean) / std матрицы с заданными колонками. Векторы mean, std float32 выровнены
+    по колонкам, для колонок, которые не нормализуются (категориальные, таргеты), mean = 0 и std = 1
+    '''
+
+    def __init__(self, columns: List[str], mean: np.ndarray, std: np.ndarray, fingerprint: Optional[str]=None):
+        '''
+        :param columns: list, колонки матрицы
+        :param mean: np.ndarray float32, средние по колонкам
+        :param std: np.ndarray float32, стандартные отклонения по колонкам
+        :param fingerprint: str, хэш статистики, по которой посчитаны векторы
+        '''
+        self.columns = list(columns)
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.std = np.asarray(std, dtype=np.float32)
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def from_stats(cls, stats: dict, columns: List[str], numerical: Optional[List[str]]=None) -> 'Normalizer':
+        '''
+        :param stats: dict, колонка -> {'mean','std'} (см. get_normalizer_stats)
+        :param columns: list, колонки матрицы
+        :param numerical: list, какие колонки нормализовать (по умолчанию NUMERICAL_FEATURES)
+        :return: Normalizer
+        '''
+        numerical = set(NUMERICAL_FEATURES if numerical is None else numerical)
+        mean = np.array([stats[col]['mean'] if col in numerical else 0.0 for col in columns], dtype=np.float32)
+        std = np.array([stats[col]['std'] if col in numerical else 1.0 for col in columns], dtype=np.float32)
+        return cls(columns, mean, std, fingerprint=stats_fingerprint(stats))
+
+    def __call__(self, matrix: np.ndarray, out: Optional[np.ndarray]=None) -> np.ndarray:
+        '''
+        Нормализация матрицы (... x колонки)
+        :param matrix: np.ndarray, последняя ось - колонки в порядке self.columns
+        :param out: np.ndarray, куда записать результат (можно передать саму matrix)
+        :return: np.ndarray float32
+        '''
+        result = np.subtract(matrix, self.mean, out=out, dtype=np.float32)
+        return np.divide(result, self.std, out=result)
+
+
+def get_normalizer(columns: Optional[List[str]]=None, fname: Optional[str]=None,
+                   numerical: Optional[List[str]]=None) -> Normalizer:
+    '''
+    Нормализатор для колонок по статистике из файла. Кэшируется по файлу (с учетом изменения) и колонкам
+    :param columns: list, колонки матрицы (по умолчанию входы модели NUMERICAL_FEATURES + CATEGORICAL_FEATURES)
+    :param fname: str, путь до файла json cо статистикой mean,std для каждого поля
+    :param numerical: list, какие колонки нормализовать (по умолчанию NUMERICAL_FEATURES)
+    :return: Normalizer
+    '''
+    if columns is None:
+        columns = NUMERICAL_FEATURES + CATEGORICAL_FEATURES
+    key = _stats_key(fname) + (tuple(columns), None if numerical is None else tuple(numerical))
+    if key not in _NORMALIZER_CACHE:
+        stats = get_normalizer_stats(fname)
+        for old_key in [_key for _key in _NORMALIZER_CACHE if _key[0] == key[0] and _key[1:3] != key[1:3]]:
+            del _NORMALIZER_CACHE[old_key]
+        _NORMALIZER_CACHE[key] = Normalizer.from_stats(stats, columns, numerical)
+    return _NORMALIZER_CACHE[key]
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+import pandas as pd
+import numpy as np
+import os
+import json
+import pickle
+import tempfile
+import hashlib
+import fnmatch
+import logging
+from argparse import ArgumentParser
+from datetime import date, datetime
+from typing import Callable, Iterable, Optional, Any
+
+from .. import config
+from ..config import DATASETS_PATH, STAGE_CACHE_DIR, STAGE_CACHE_MAX_SIZE_MB
+from .common import evict_lru_files
+
+STAGE_CACHE_VERSION = 1 # версия формата кэша этапов
+
+# параметры конфига, от которых зависят результаты этапов пайплайна
+FINGERPRINT_CONFIG = ('DATASETS_PATH', 'DAYS_FORECAST', 'ALL_STATIONS', 'MAX_DATE')
+
+# файлы в директориях-источниках, которые входят в отпечаток: исходные .csv и описания станций
+# в хранилище метео (пишутся последними при загрузке станции). Служебные файлы рядом с исходниками
+# (например, .idx.npz индексы hydro_index) в отпечаток не входят
+SOURCE_PATTERNS = ('*.csv', '_meta.json')
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def get_stage_cache_dir() -> Optional[str]:
+    '''
+    Директория с кэшем этапов пайплайна
+    :return: str, путь до директории или None, если кэш отключен
+    '''
+    if STAGE_CACHE_DIR is None:
+        return None
+    return os.path.join(DATASETS_PATH, STAGE_CACHE_DIR)
+
+
+def code_fingerprint() -> str:
+    '''
+    Хэш всех .py файлов пакета amurlevel_model - при любом изменении кода все записи кэша становятся невалидными
+    '''
+    sha = hashlib.sha1()
+    for root, dirs, files in sorted(os.walk(PACKAGE_DIR)):
+        dirs.sort()
+        for _f in sorted(files):
+            if _f.endswith('.py'):
+                sha.update(_f.encode('utf-8'))
+                with open(os.path.join(root, _f), 'rb') as f:
+                    sha.update(f.read())
+    return sha.hexdigest()
+
+
+def sources_fingerprint(paths: Iterable[str], patterns: Iterable[str]=SOURCE_PATTERNS) -> list:
+    '''
+    Размер и время изменения исходных файлов (для директорий - файлов внутри, включая поддиректории,
+    имена которых подходят под patterns)
+    :param paths: Iterable, пути до файлов или директорий
+    :param patterns: Iterable, шаблоны имен файлов внутри директорий
+    :return: list
+    '''
+    stamps = []
+    for path in paths:
+        if os.path.isdir(path):
+            fnames = []
+            for root, dirs, files in sorted(os.walk(path)):
+                dirs.sort()
+                fnames += [os.path.join(root, _f) for _f in sorted(files)
+                           if any(fnmatch.fnmatch(_f, pattern) for pattern in patterns)]
+        else:
+            fnames = [path]
+        for fname in fnames:
+            if os.path.isfile(fname):
+                stat = os.stat(fname)
+                stamps.append([os.path.abspath(fname), stat.st_size, stat.st_mtime_ns])
+            else:
+                stamps.append([os.path.abspath(fname), None, None])
+    return stamps
+
+
+def frame_fingerprint(df: pd.DataFrame) -> str:
+    '''
+    Хэш содержимого датафрейма (значения, индекс, колонки и типы)
+    '''
+    try:
+        hashes = pd.util.hash_pandas_object(df, index=True).values
+    except (TypeError, ValueError): # колонки с нехэшируемыми объектами (например, геометрия) хэшируем по строковому представлению
+        hashes = pd.util.hash_pandas_object(df.astype(str), index=True).values
+    sha = hashlib.sha1(hashes.tobytes())
+    sha.update(repr([(str(col), str(dtype)) for col, dtype in df.dtypes.items()]).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def _to_jsonable(value: Any) -> Any:
+    '''
+    Представление аргумента этапа для отпечатка: датафреймы заменяются хэшем содержимого, даты - строкой
+    '''
+    if isinstance(value, pd.DataFrame):
+        return {'frame': frame_fingerprint(value)}
+    if isinstance(value, (pd.Timestamp, datetime, date)):
+        return pd.Timestamp(value).isoformat()
+    if isinstance(value, (list, tuple)):
+        return [_to_jsonable(item) for item in value]
+    if isinstance(value, dict):
+        return {str(key): _to_jsonable(item) for key, item in value.items()}
+    if isinstance(value, np.generic):
+        return value.item()
+    return value if isinstance(value, (str, int, float, bool, type(None))) else repr(value)
+
+
+class StageCache():
+    '''
+    Кэш результатов этапов пайплайна (чтение гидро/метео, мерджи, кригинг, make_dataset).
+    Ключ записи - хэш от имени этапа, его аргументов (датафреймы - по содержимому), исходных файлов
+    (размер и время изменения), параметров конфига и кода пакета. При совпадении ключа результат
+    читается с диска вместо вычисления.
+    '''
+
+    def __init__(self, enabled: bool=True, cache_dir: Optional[str]=None):
+        '''
+        :param enabled: bool, если False - все этапы вычисляются заново и ничего не сохраняется
+        :param cache_dir: str, директория кэша, по умолчанию - get_stage_cache_dir()
+        '''
+        self.cache_dir = cache_dir if cache_dir is not None else get_stage_cache_dir()
+        self.enabled = enabled and self.cache_dir is not None
+        self.hits, self.misses = [], []
+        self._code = code_fingerprint() if self.enabled else None
+
+    def key(self, name: str, args: tuple, kwargs: dict, sources: Iterable[str]=()) -> str:
+        '''
+        Ключ записи для этапа
+        :param name: str, название этапа
+        :param args: tuple, позиционные аргументы функции этапа
+        :param kwargs: dict, именованные аргументы функции этапа
+        :param sources: Iterable, исходные файлы или директории, которые читает этап
+        :return: str
+        '''
+        fingerprint = {
+            'name': name,
+            'version': STAGE_CACHE_VERSION,
+            'code': self._code,
+            'config': {param: _to_jsonable(getattr(config, param)) for param in FINGERPRINT_CONFIG},
+            'args': _to_jsonable(list(args)),
+            'kwargs': _to_jsonable(kwargs),
+            'sources': sources_fingerprint(sources),
+        }
+        return hashlib.sha1(json.dumps(fingerprint, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def run(self, name: str, func: Callable[..., Any], *args, sources: Iterable[str]=(), **kwargs) -> Any:
+        '''
+        Выполнение этапа через кэш: func(*args, **kwargs) или результат с диска
+        :param name: str, название этапа (для ключа и логов)
+        :param func: Callable, функция этапа
+        :param sources: Iterable, исходные файлы или директории, которые читает этап
+        :return: результат func
+        '''
+        logger = logging.getLogger()
+        if not self.enabled:
+            return func(*args, **kwargs)
+
+        key = self.key(name, args, kwargs, sources)
+        entry = os.path.join(self.cache_dir, f'{name}-{key}.pkl')
+        if os.path.exists(entry):
+            try:
+                with open(entry, 'rb') as f:
+                    result = pickle.load(f)
+                os.utime(entry) # для вытеснения самых давно использованных записей
+                self.hits.append(name)
+                logger.info(f'Stage cache hit: {name} ({key[:10]})')
+                return result
+            except (OSError, pickle.UnpicklingError, EOFError) as e:
+                logger.warning(f'Could not read stage cache {entry}: {e}')
+
+        self.misses.append(name)
+        logger.info(f'Stage cache miss: {name} ({key[:10]})')
+        result = func(*args, **kwargs)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # уникальный временный файл: этапы могут одновременно выполняться в нескольких потоках (serve.py)
+            fd, tmp_fname = tempfile.mkstemp(dir=self.cache_dir, prefix=f'{name}-', suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_fname, entry)
+            evict_lru_files(self.cache_dir, STAGE_CACHE_MAX_SIZE_MB, '.pkl')
+        except OSError as e:
+            logger.warning(f'Could not write stage cache {entry}: {e}')
+        return result
+
+    def report(self) -> str:
+        '''
+        Сводка по попаданиям в кэш за время работы
+        :return: str
+        '''
+        if not self.enabled:
+            return 'Stage cache disabled'
+        return f"Stage cache: {len(self.hits)} hits ({', '.join(self.hits)}), " \
+               f"{len(self.misses)} misses ({', '.join(self.misses)})"
+
+
+def purge_stage_cache() -> int:
+    '''
+    Полная очистка кэша этапов
+    :return: int, количество удаленных записей
+    '''
+    cache_dir = get_stage_cache_dir()
+    if cache_dir is None or not os.path.isdir(cache_dir):
+        return 0
+    removed = 0
+    for _f in os.listdir(cache_dir):
+        if _f.endswith('.pkl') or _f.endswith('.tmp'):
+            os.remove(os.path.join(cache_dir, _f))
+            removed += 1
+    return removed
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Управление кэшем этапов пайплайна')
+    parser.add_argument('--purge', action='store_true', help='Удалить все записи из кэша')
+    args = parser.parse_args()
+
+    cache_dir = get_stage_cache_dir()
+    if args.purge:
+        print(f'Removed {purge_stage_cache()} entries from {cache_dir}')
+    elif cache_dir is not None and os.path.isdir(cache_dir):
+        sizes = [os.path.getsize(os.path.join(cache_dir, _f)) for _f in os.listdir(cache_dir) if _f.endswith('.pkl')]
+        print(f'{cache_dir}: {len(sizes)} entries, {sum(sizes) / 1024 / 1024:.1f} MB')
+    else:
+        print('Stage cache is empty or disabled')
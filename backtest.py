@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+from argparse import RawTextHelpFormatter, ArgumentParser
+import pandas as pd
+import numpy as np
+import os
+import logging
+from datetime import timedelta
+
+from amurlevel_model.config import DAYS_FORECAST, ALL_STATIONS, NUMBER_OF_INFERENCE_STATIONS, DATASETS_PATH
+from amurlevel_model.config_features import NUMERICAL_FEATURES, CATEGORICAL_FEATURES
+
+from amurlevel_model.dataloaders.asunp import get_asunp_stations, get_asunp_hydro_stations
+from amurlevel_model.dataloaders.meteo import read_history_meteo, meteo_sources
+from amurlevel_model.dataloaders.hydro import read_hydro_all
+
+from amurlevel_model.processing.merge_hydro_meteo import merge_hydro_meteo
+from amurlevel_model.processing.merge_hydro_asunp import merge_hydro_asunp
+from amurlevel_model.processing.merge_meteo_asunp import merge_meteo_asunp
+
+from amurlevel_model.features.amur_features import make_dataset
+from amurlevel_model.model.windows import WindowSet, feature_matrix
+from amurlevel_model.utils.common import set_logger
+from amurlevel_model.utils.normalizer import get_normalizer
+from amurlevel_model.utils.stage_cache import StageCache
+
+from predict import load_model
+
+BACKTEST_BATCH_SIZE = 256 # размер батча model.predict при бэктесте
+
+
+def parse_args():
+    parser = ArgumentParser(description='''
+        Скрипт для бэктеста модели: предсказания на 10 дней вперед от каждой даты из интервала с шагом stride.
+        Данные выгружаются и признаки считаются один раз на весь интервал, все окна предсказываются одним model.predict
+        Результаты (прогноз и факт по станциям) сохраняются в файл backtest_{start}_{end}.csv
+
+        Ограничение: гидро выгружается до последнего дня прогноза, и пропуски в истории заполняются
+        (fill_missing) по уровням, известным уже после даты прогноза. В predict.py данные есть только до f_day - 1,
+        пропуски в конце заполняются последним значением, поэтому MAE бэктеста может быть оптимистичнее реального
+
+        Пример:  python backtest.py -start 2019-01-01 -end 2019-12-31 -w /data/weights-aij2020amurlevel-2017.h5
+        python backtest.py -start 2019-04-01 -end 2019-10-31 -stride 10 -w weights-aij2020amurlevel-2017.h5
+        ''', formatter_class=RawTextHelpFormatter)
+
+    parser.add_argument('-start', type=str, required=True,
+                        help='Первая дата, от которой считаем предсказания')
+    parser.add_argument('-end', type=str, required=True,
+                        help='Последняя дата, от которой считаем предсказания (включительно)')
+    parser.add_argument('-stride', type=int, default=1,
+                        help='Шаг между датами предсказаний в днях')
+    parser.add_argument('-w','--weights', dest='w',type=str, required=True,
+                        help='Путь до файла с весами модели')
+    parser.add_argument('-o', '--output', dest='output', type=str, default=None,
+                        help='Файл для результатов (по умолчанию DATASETS_PATH/backtest_{start}_{end}.csv)')
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true',
+                        help='Не использовать кэш этапов подготовки данных (все этапы считаются заново)')
+    parser.add_argument('--in-graph-normalization', dest='in_graph_normalization', action='store_true',
+                        help='Нормализовать признаки внутри модели (для экспортированных моделей берется из export.json)')
+    args = parser.parse_args()
+    return args
+
+
+def backtest_windows(amur_df: pd.DataFrame, f_days: pd.DatetimeIndex, normalize: bool=True):
+    '''
+    Окна входа модели для всех дат предсказаний из одного датасета.
+    Датасет посчитан на весь интервал, поэтому пропуски гидро перед f_day в нем заполнены с учетом
+    данных после f_day (в predict.py таких данных нет)
+    :param amur_df: pd.DataFrame, датасет (make_dataset) на интервал, покрывающий все окна
+    :param f_days: pd.DatetimeIndex, даты, от которых считаем предсказания
+    :param normalize: bool, нормализовать ли признаки (False - нормализация встроена в модель)
+    :return: tuple:
+                    windows - WindowSet с окнами для дат, по которым есть все DAYS_FORECAST дней
+                    f_days - pd.DatetimeIndex, эти даты
+                    actuals - np.ndarray [n, DAYS_FORECAST, n_stations], фактические уровни
+    '''
+    features = NUMERICAL_FEATURES + CATEGORICAL_FEATURES
+    targets = ['sealevel_max_' + identifier for identifier in ALL_STATIONS]
+    amur_df = amur_df.sort_values('date')
+    dates = pd.DatetimeIndex(amur_df['date'])
+    starts = dates.get_indexer(f_days)
+    # окно берется, только если в датасете есть все DAYS_FORECAST дней подряд
+    ends = dates.get_indexer(f_days + timedelta(DAYS_FORECAST - 1))
+    found = (starts >= 0) & (ends - starts == DAYS_FORECAST - 1)
+    if not found.any():
+        raise ValueError(f"No forecast date from {f_days[0].strftime('%Y-%m-%d')} to {f_days[-1].strftime('%Y-%m-%d')} "
+                         f'has all {DAYS_FORECAST} days in the dataset')
+    if not found.all():
+        logging.getLogger().warning(f'No data for {(~found).sum()} forecast dates, e.g. '
+                                    f"{f_days[~found][0].strftime('%Y-%m-%d')}")
+    x = feature_matrix(amur_df, features, get_normalizer() if normalize else None)
+    y = feature_matrix(amur_df, targets)
+    windows = WindowSet(x, starts[found], targets=y)
+    return windows, f_days[found], windows.labels()
+
+
+def backtest_results(preds: np.ndarray, actuals: np.ndarray, f_days: pd.DatetimeIndex) -> pd.DataFrame:
+    '''
+    Таблица прогнозов и фактических уровней: строка - дата прогноза, день прогноза и станция
+    :param preds: np.ndarray [n, DAYS_FORECAST, n_stations], выход модели
+    :param actuals: np.ndarray [n, DAYS_FORECAST, n_stations], фактические уровни
+    :param f_days: pd.DatetimeIndex, даты, от которых считались предсказания
+    :return: pd.DataFrame с колонками f_day, date, lead, identifier, forecast, actual
+    '''
+    n_stations = NUMBER_OF_INFERENCE_STATIONS
+    shape = (len(f_days), DAYS_FORECAST, n_stations)
+    lead = np.broadcast_to(np.arange(1, DAYS_FORECAST + 1)[None, :, None], shape)
+    f_day = np.broadcast_to(f_days.values[:, None, None], shape)
+    return pd.DataFrame({
+        'f_day': f_day.ravel(),
+        'date': f_day.ravel() + (lead.ravel() - 1).astype('timedelta64[D]'),
+        'lead': lead.ravel(),
+        'identifier': np.broadcast_to(np.array(ALL_STATIONS[:n_stations])[None, None, :], shape).ravel(),
+        'forecast': preds.reshape(-1, DAYS_FORECAST, len(ALL_STATIONS))[:, :, :n_stations].ravel(),
+        'actual': actuals[:, :, :n_stations].ravel(),
+    })
+
+
+if __name__ == "__main__":
+
+    logger = set_logger()
+    args = parse_args()
+    f_days = pd.date_range(args.start, args.end, freq=f'{args.stride}D')
+    if len(f_days) == 0:
+        raise ValueError(f'No forecast dates between {args.start} and {args.end}')
+    l_day = f_days[-1] + timedelta(DAYS_FORECAST - 1)  # последний день, для которого нужны признаки и факт
+    f_day_hydro = f_days[0] - timedelta(DAYS_FORECAST + 4 * 365 + 1)  # объем данных необходимый для данных с гидространций
+    f_day_meteo = f_days[0] - timedelta(DAYS_FORECAST + 60)  # объем данных необходимый для метео
+    logger.info(f"backtest. {len(f_days)} forecasts from {f_days[0].strftime('%Y-%m-%d')} to {f_days[-1].strftime('%Y-%m-%d')}")
+
+    cache = StageCache(enabled=not args.no_cache)
+    asunp = get_asunp_stations()
+    asunp_hydro = get_asunp_hydro_stations()
+    hydro_df = cache.run('read_hydro_all', read_hydro_all, start_date=f_day_hydro, end_date=l_day, seek=True,
+                         sources=[os.path.join(DATASETS_PATH, 'hydro')])  # выгружаем данные с гидропостов
+    logger.info(f'hydro shape {hydro_df.shape}')
+    meteo_df = cache.run('read_history_meteo', read_history_meteo, start_date=f_day_meteo, end_date=l_day,
+                         sources=meteo_sources())  # выгружаем метео
+    logger.info(f'meteo shape {meteo_df.shape}')
+
+    meteo_df = cache.run('merge_meteo_asunp', merge_meteo_asunp, meteo_df, asunp)
+    hydro_df = cache.run('merge_hydro_asunp', merge_hydro_asunp, hydro_df, asunp_hydro)  # мержим гидро и asunp
+    hydro_df = cache.run('merge_hydro_meteo', merge_hydro_meteo, hydro_df, meteo_df, asunp_hydro)  # мержим гидро и метео
+    logger.info(f'hydro shape after merge with historical meteo {hydro_df.shape}')
+
+    # train=True - таргеты не интерполируются, это фактические уровни
+    amur_df = cache.run('make_dataset', make_dataset, hydro_df, train=True)
+    logger.info(cache.report())
+    logger.info(f'amur_df shape {amur_df.shape}')
+
+    model = load_model(args.w, in_graph_normalization=args.in_graph_normalization)
+    windows, f_days, actuals = backtest_windows(amur_df, f_days, normalize=not model.in_graph_normalization)
+    logger.info(f'model inputs: {len(windows)} windows')
+
+    # все окна предсказываются одним вызовом модели
+    preds = model.predict(windows.inputs(), batch_size=BACKTEST_BATCH_SIZE)
+    results_df = backtest_results(preds, actuals, f_days)
+
+    errors = (results_df['forecast'] - results_df['actual']).abs()
+    logger.info(f'MAE {errors.mean():.3f} on {errors.count()} values with known level')
+    logger.info('MAE by lead: ' + ', '.join(f'{lead}: {mae:.2f}' for lead, mae in errors.groupby(results_df['lead']).mean().items()))
+
+    fname = args.output or os.path.join(DATASETS_PATH, f"backtest_{f_days[0].strftime('%Y-%m-%d')}_{f_days[-1].strftime('%Y-%m-%d')}.csv")
+    results_df.to_csv(fname, index=False)
+    logger.info(f'Results saved to {fname}')
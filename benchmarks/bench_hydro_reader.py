@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+from argparse import RawTextHelpFormatter, ArgumentParser
+import pandas as pd
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from amurlevel_model.config import DATASETS_PATH
+from amurlevel_model.utils.common import dateparse
+from amurlevel_model.dataloaders.hydro import parse_hydro_level_file, parse_hydro_disch_file, parse_hydro_snow_ice_file
+
+# параметры pd.read_csv для каждого типа файлов в старом варианте чтения (dateparse на каждую строку)
+LEGACY_READ_PARAMS = {
+    '_daily.csv': dict(sep=';', dtype={'water_code': str}, skiprows=2, index_col=0,
+                       names=['date', 'sealevel_avg', 'sealevel_min', 'sealevel_max', 'water_temp', 'water_code', '_'],
+                       usecols=['date', 'sealevel_avg', 'sealevel_min', 'sealevel_max', 'water_temp', 'water_code'],
+                       skipinitialspace=True),
+    '_disch_d.csv': dict(sep=';', names=['date', 'water_flow', '_'], usecols=['date', 'water_flow'],
+                         skiprows=2, index_col=0),
+    '_ice.csv': dict(sep=';', names=['date', 'ice_thickness', 'snow_height', 'ice_place', '_'],
+                     usecols=['date', 'ice_thickness', 'snow_height', 'ice_place'], skiprows=2, index_col=0),
+}
+
+PARSERS = {
+    '_daily.csv': parse_hydro_level_file,
+    '_disch_d.csv': parse_hydro_disch_file,
+    '_ice.csv': parse_hydro_snow_ice_file,
+}
+
+
+def legacy_parse(fname: str, suffix: str) -> pd.DataFrame:
+    '''
+    Старый вариант парсинга: dateparse на каждую строку, при UnicodeDecodeError - повторное чтение в cp1251
+    '''
+    params = LEGACY_READ_PARAMS[suffix]
+    try:
+        df = pd.read_csv(fname, date_parser=dateparse, **params)
+    except UnicodeDecodeError:
+        df = pd.read_csv(fname, encoding='cp1251', date_parser=dateparse, **params)
+
+    if suffix == '_daily.csv':
+        df['sealevel_max'] = pd.to_numeric(df['sealevel_max'], errors='coerce')
+        df['water_temp'] = pd.to_numeric(df['water_temp'].fillna('').astype(str).str.extract(r'(\d+\.{0,1}\d{0,2})')[0])
+        df['water_code'] = df.water_code.str.strip().str.split(', ').astype(str)
+        return df[['sealevel_min', 'sealevel_max', 'water_temp', 'water_code']]
+    if suffix == '_disch_d.csv':
+        df['water_flow'] = pd.to_numeric(df['water_flow'], errors='coerce')
+        return df
+    df['ice_thickness'] = pd.to_numeric(df['ice_thickness'], errors='coerce')
+    df['snow_height'] = pd.to_numeric(df['snow_height'], errors='coerce')
+    return df[['ice_thickness', 'snow_height']]
+
+
+def parse_args():
+    parser = ArgumentParser(description='''
+        Бенчмарк чтения .csv файлов с гидропостов: старый вариант (dateparse на каждую строку)
+        против векторизованного read_hydro_csv. Проверяет, что результаты совпадают, и выводит строк/сек
+
+        Пример:  python benchmarks/bench_hydro_reader.py -d /data/hydro -n 3
+        ''', formatter_class=RawTextHelpFormatter)
+    parser.add_argument('-d', type=str, default=os.path.join(DATASETS_PATH, 'hydro'),
+                        help='Директория с .csv файлами гидропостов')
+    parser.add_argument('-n', type=int, default=3, help='Количество повторов для каждого файла')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    stats = {suffix: {'rows': 0, 'legacy': 0.0, 'vectorized': 0.0} for suffix in PARSERS}
+    for _f in sorted(os.listdir(args.d)):
+        suffix = next((suffix for suffix in PARSERS if _f.endswith(suffix)), None)
+        if suffix is None:
+            continue
+        fname = os.path.join(args.d, _f)
+        for _ in range(args.n):
+            t = time.perf_counter()
+            legacy_df = legacy_parse(fname, suffix)
+            stats[suffix]['legacy'] += time.perf_counter() - t
+
+            t = time.perf_counter()
+            df = PARSERS[suffix](fname)
+            stats[suffix]['vectorized'] += time.perf_counter() - t
+            stats[suffix]['rows'] += len(df)
+        pd.testing.assert_frame_equal(legacy_df, df)
+
+    print(f"{'file type':<14}{'rows':>10}{'legacy rows/s':>16}{'vectorized rows/s':>20}{'speedup':>10}")
+    for suffix, stat in stats.items():
+        if stat['rows'] == 0:
+            continue
+        legacy_speed = stat['rows'] / stat['legacy']
+        speed = stat['rows'] / stat['vectorized']
+        print(f"{suffix:<14}{stat['rows'] // args.n:>10}{legacy_speed:>16.0f}{speed:>20.0f}{speed / legacy_speed:>10.1f}")
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from argparse import RawTextHelpFormatter, ArgumentParser
+import numpy as np
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from amurlevel_model.config import DATASETS_PATH
+from amurlevel_model.model.export import export_model, load_exported, build_inference_model, TFLITE_FILE
+from amurlevel_model.model.model import build_model
+
+
+def parse_args():
+    parser = ArgumentParser(description='''
+        Бенчмарк инференса на CPU: задержка (p50, p99) и пропускная способность по размерам батча
+        для model.predict исходной модели, модели со свернутыми BatchNormalization и экспортированных SavedModel, TFLite.
+        Входы случайные, max diff - максимальное отклонение предсказаний от model.predict
+
+        Пример:  python benchmarks/bench_inference.py -w weights-aij2020amurlevel-2017.h5 -b 1 8 32 128
+        python benchmarks/bench_inference.py -w weights-aij2020amurlevel-2017.h5 -e /data/export/weights-aij2020amurlevel-2017
+        ''', formatter_class=RawTextHelpFormatter)
+    parser.add_argument('-w', type=str, required=True, help='Путь до файла с весами модели')
+    parser.add_argument('-e', type=str, default=None,
+                        help='Директория экспорта (amurlevel_model.model.export), по умолчанию экспорт во временную директорию')
+    parser.add_argument('-b', type=int, nargs='+', default=[1, 8, 32, 128], help='Размеры батча')
+    parser.add_argument('-n', type=int, default=50, help='Количество замеров на каждый размер батча')
+    return parser.parse_args()
+
+
+def measure(predict_fn, inputs: np.ndarray, n: int, warmup: int=3):
+    '''
+    Задержки вызова predict_fn(inputs) в секундах (первые warmup вызовов не учитываются)
+    '''
+    for _ in range(warmup):
+        predict_fn(inputs)
+    timings = []
+    for _ in range(n):
+        t = time.perf_counter()
+        predict_fn(inputs)
+        timings.append(time.perf_counter() - t)
+    return np.array(timings)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    export_dir = args.e or tempfile.mkdtemp(prefix='amurlevel_export_')
+    if args.e is None:
+        export_model(args.w, export_dir)
+    model = build_model()
+    model.load_weights(args.w if os.path.exists(args.w) else os.path.join(DATASETS_PATH, args.w))
+    predictors = {
+        'keras predict': model.predict,
+        'folded keras': build_inference_model(model).predict,
+        'saved_model': load_exported(export_dir).predict,
+        'tflite': load_exported(os.path.join(export_dir, TFLITE_FILE)).predict,
+    }
+
+    rng = np.random.RandomState(0)
+    print(f"{'model':<16}{'batch':>6}{'p50, ms':>10}{'p99, ms':>10}{'windows/s':>12}{'max diff':>12}")
+    for batch_size in args.b:
+        inputs = rng.normal(size=(batch_size,) + model.input_shape[1:]).astype(np.float32)
+        reference = model.predict(inputs, batch_size=batch_size)
+        for name, predict in predictors.items():
+            predict_fn = lambda x: predict(x, batch_size=batch_size)
+            timings = measure(predict_fn, inputs, args.n)
+            diff = np.abs(predict_fn(inputs) - reference).max()
+            print(f'{name:<16}{batch_size:>6}{np.percentile(timings, 50) * 1000:>10.2f}'
+                  f'{np.percentile(timings, 99) * 1000:>10.2f}{batch_size / timings.mean():>12.1f}{diff:>12.2e}')
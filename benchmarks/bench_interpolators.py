@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from argparse import RawTextHelpFormatter, ArgumentParser
+import numpy as np
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from amurlevel_model.dataloaders.meteo import read_history_meteo
+from amurlevel_model.dataloaders.asunp import get_asunp_hydro_stations
+from amurlevel_model.processing.merge_meteo_asunp import merge_meteo_asunp
+from amurlevel_model.processing.merge_hydro_meteo import interpolate_meteo, INTERPOLATORS, KRIGING_COLS
+
+
+def parse_args():
+    parser = ArgumentParser(description='''
+        Бенчмарк способов интерполяции метео в точки гидростанций на исторических данных:
+        время работы и MAE по каждому признаку относительно эталонного способа
+
+        Пример:  python benchmarks/bench_interpolators.py -s 2015-01-01 -e 2015-12-31 -r kriging_exact
+        ''', formatter_class=RawTextHelpFormatter)
+    parser.add_argument('-s', type=str, default='2015-01-01', help='Начальная дата метео данных')
+    parser.add_argument('-e', type=str, default='2015-12-31', help='Конечная дата метео данных')
+    parser.add_argument('-r', type=str, default='kriging_exact', choices=INTERPOLATORS,
+                        help='Эталонный способ интерполяции')
+    parser.add_argument('-i', type=str, nargs='+', default=list(INTERPOLATORS), choices=INTERPOLATORS,
+                        help='Сравниваемые способы интерполяции')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    asunp_hydro = get_asunp_hydro_stations()
+    meteo_df = merge_meteo_asunp(read_history_meteo(start_date=args.s, end_date=args.e, verbose=False))
+    hydro_lon, hydro_lat = asunp_hydro.lon.values, asunp_hydro.lat.values
+    print(f"{meteo_df['identifier'].nunique()} meteo stations, {len(asunp_hydro)} hydro stations, "
+          f"{meteo_df['datetime'].nunique()} days")
+
+    results, timings = {}, {}
+    for interpolator in dict.fromkeys([args.r] + args.i):
+        t = time.perf_counter()
+        days, results[interpolator] = interpolate_meteo(meteo_df, hydro_lon, hydro_lat, interpolator)
+        timings[interpolator] = time.perf_counter() - t
+
+    reference = results[args.r]
+    print(f"{'interpolator':<16}{'time, s':>10}" + ''.join(f'{col[:12]:>14}' for col in KRIGING_COLS))
+    for interpolator in dict.fromkeys([args.r] + args.i):
+        mae = np.nanmean(np.abs(results[interpolator] - reference), axis=(0, 1))
+        print(f'{interpolator:<16}{timings[interpolator]:>10.2f}' + ''.join(f'{value:>14.3f}' for value in mae))
@@ -1,13 +1,16 @@
 # -*- coding: utf-8 -*-
 from argparse import RawTextHelpFormatter, ArgumentParser
 import pandas as pd
+import numpy as np
 import os
+import logging
 from datetime import timedelta, datetime
+from typing import Optional
 
 from amurlevel_model.config import DAYS_FORECAST, ALL_STATIONS, NUMBER_OF_INFERENCE_STATIONS, DATASETS_PATH
 
-from amurlevel_model.dataloaders.asunp import get_asunp_hydro_stations
-from amurlevel_model.dataloaders.meteo import read_history_meteo
+from amurlevel_model.dataloaders.asunp import get_asunp_stations, get_asunp_hydro_stations
+from amurlevel_model.dataloaders.meteo import read_history_meteo, meteo_sources
 from amurlevel_model.dataloaders.hydro import read_hydro_all
 
 from amurlevel_model.processing.merge_hydro_meteo import merge_hydro_meteo
@@ -16,10 +19,14 @@ from amurlevel_model.processing.merge_hydro_asunp import merge_hydro_asunp
 from amurlevel_model.processing.merge_meteo_asunp import merge_meteo_asunp
 
 from amurlevel_model.features.amur_features import make_dataset
+from amurlevel_model.features.feature_store import FeatureStore
 
 from amurlevel_model.model.prepare_data import prepare_data
 from amurlevel_model.model.model import build_model
+from amurlevel_model.model.export import is_exported, load_exported
+from amurlevel_model.utils.normalizer import get_normalizer
 from amurlevel_model.utils.common import set_logger
+from amurlevel_model.utils.stage_cache import StageCache
 
 class EmptyHistoricalMeteo(Exception):
     pass
@@ -32,25 +39,71 @@ def parse_args():
         Скрипт для проверки качества обученной модели для предсказания уровня воды.
         Предсказывается на 10 дней вперед от f_day
         Результаты сохраняются в файл level_{f_day}.csv
+        С --feature-store признаки берутся из хранилища (features/feature_store.py), которое дополняется
+        только новыми днями вместо пересчета всей истории
 
         Пример:  python predict.py -f_day 2020-11-01 -w /data/weights-aij2020amurlevel-2017.h5 (предсказания будут от 2020-11-01 до 2020-11-11 по модели обученной до 2018 года)
         python predict.py -f_day 2013-02-01 -w /data/weights-aij2020amurlevel-2012.h5 (предсказания будут от 2013-02-01 до 2013-02-11 по модели обученной до 2013 года)
+        python predict.py -f_day 2020-11-01 -w export/weights-aij2020amurlevel-2017/model.tflite (модель, экспортированная amurlevel_model.model.export)
         ''', formatter_class=RawTextHelpFormatter)
 
     parser.add_argument('-f_day', type=str, required=True,
                         help='Дата от которой считаем предсказания')
     parser.add_argument('-w','--weights', dest='w',type=str, required=True,
-                        help='Путь до файла с весами модели')
+                        help='Путь до файла с весами модели (.h5) или до экспортированной модели (SavedModel, .tflite)')
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true',
+                        help='Не использовать кэш этапов подготовки данных (все этапы считаются заново)')
+    parser.add_argument('--in-graph-normalization', dest='in_graph_normalization', action='store_true',
+                        help='Нормализовать признаки внутри модели (на вход модели подаются ненормализованные признаки).\n'
+                             'Для экспортированной модели берется из ее export.json')
+    parser.add_argument('--feature-store', dest='feature_store', action='store_true',
+                        help='Брать признаки из хранилища признаков, дополнив его новыми днями\n'
+                             '(если хранилища нет - оно строится по данным за последние 4 года)')
     args = parser.parse_args()
     return args
 
 
-if __name__ == "__main__":
-
-    logger = set_logger()
-    args = parse_args()
-    model = build_model()
-    f_day = pd.to_datetime(args.f_day)
+def update_feature_store(store: FeatureStore, l_day_history: datetime, l_day_meteo: datetime) -> None:
+    '''
+    Дополнение хранилища признаков гидро и метео данными после последнего дня, где известен уровень воды.
+    Хранилище обновляется, если новые дни есть в гидро или в метео
+    :param store: FeatureStore
+    :param l_day_history: datetime, последний день исторических данных
+    :param l_day_meteo: datetime, последний день исторических метео
+    '''
+    logger = logging.getLogger()
+    f_day_new = store.observed_date + timedelta(1)
+    if f_day_new > pd.Timestamp(l_day_history):
+        if store.last_date >= pd.Timestamp(l_day_meteo) or store.observed_date > pd.Timestamp(l_day_history):
+            logger.info(f"Feature store is up to date (observed up to {store.observed_date.strftime('%Y-%m-%d')}, "
+                        f"meteo up to {store.last_date.strftime('%Y-%m-%d')})")
+            return
+        # новые дни есть только в метео: последний известный день гидро перечитывается,
+        # чтобы метео было куда интерполировать (его строки заменятся теми же значениями)
+        f_day_new = store.observed_date
+    new_hydro = read_hydro_all(start_date=f_day_new, end_date=l_day_history, seek=True)
+    new_meteo = read_history_meteo(start_date=f_day_new, end_date=l_day_meteo)
+    logger.info(f"Feature store update from {f_day_new.strftime('%Y-%m-%d')}: "
+                f"hydro shape {new_hydro.shape}, meteo shape {new_meteo.shape}")
+    if new_meteo.empty:
+        raise EmptyHistoricalMeteo(f"There is no historical meteo data from {f_day_new.strftime('%Y-%m-%d')}!")
+    store.append_days(new_hydro, new_meteo)
+
+
+def prepare_inputs(f_day: datetime, cache: StageCache, asunp: pd.DataFrame, asunp_hydro: pd.DataFrame,
+                   store: Optional[FeatureStore]=None, normalize: bool=True) -> np.ndarray:
+    '''
+    Подготовка входа модели для предсказания на DAYS_FORECAST дней от f_day:
+    выгрузка гидро и метео (или дополнение хранилища признаков), мерджи, признаки
+    :param f_day: datetime, дата от которой считаем предсказания
+    :param cache: StageCache, кэш этапов подготовки данных
+    :param asunp: pd.DataFrame, метеостанции asunp
+    :param asunp_hydro: pd.DataFrame, гидростанции asunp
+    :param store: FeatureStore, если задан - признаки берутся из хранилища
+    :param normalize: bool, нормализовать ли признаки (False - нормализация встроена в модель)
+    :return: np.ndarray, вход модели [1, DAYS_FORECAST, n_features]
+    '''
+    logger = logging.getLogger()
     l_day = f_day + timedelta(DAYS_FORECAST)
     l_day_history = f_day - timedelta(1)
     f_day_hydro = f_day - timedelta(DAYS_FORECAST + 4 * 365 + 1)  # объем данных необходимый для данных с гидространций
@@ -58,54 +111,122 @@ if __name__ == "__main__":
     l_day_meteo = min(datetime.today().date()-timedelta(1),l_day) # выгружаем исторические метео макс. до вчерашнего дня
     logger.info('prediction. Period ' + f_day.strftime('%Y-%m-%d') + ' - ' + (l_day-timedelta(days=1)).strftime('%Y-%m-%d'))
 
-    asunp_hydro = get_asunp_hydro_stations()
-    hydro_df = read_hydro_all(start_date=f_day_hydro, end_date=l_day_history)  # выгружаем данные с гидропостов
-    logger.info(f'hydro shape {hydro_df.shape}')
-    if hydro_df.empty:
-        raise EmptyHistoricalHydro(f"There is no historical hydro data from {f_day_hydro.strftime('%Y-%m-%d')} - {f_day.strftime('%Y-%m-%d')}!")
-    elif hydro_df['date'].max() < l_day_history:
-        logger.warning(f"The last max date in hydro is {hydro_df['date'].max().strftime('%Y-%m-%d')} and prediction period is {f_day.strftime('%Y-%m-%d')} - {(l_day-timedelta(days=1)).strftime('%Y-%m-%d')}. You should update your historical hydro data or results will be worse")
-
-    logger.info(f"unique identifiers {len(hydro_df['identifier'].unique())}")
-    meteo_df = read_history_meteo(start_date=f_day_meteo, end_date=l_day_meteo)  # выгружаем метео
-    logger.info(f'meteo shape {meteo_df.shape}')
-    if meteo_df.empty:
-        raise EmptyHistoricalMeteo(f"There is no historical meteo data from {f_day_meteo.strftime('%Y-%m-%d')} - {l_day.strftime('%Y-%m-%d')}!")
-    elif meteo_df['datetime'].max() < l_day_history:
-        logger.warning(f"The last max date ine meteo is {meteo_df['date'].max().strftime('%Y-%m-%d')} and prediction period is {f_day.strftime('%Y-%m-%d')} - {(l_day-timedelta(days=1)).strftime('%Y-%m-%d')}. You should update your historical meteo data or results will be worse")
-
-    meteo_df = merge_meteo_asunp(meteo_df)
-    logger.info(f'meteo shape after merge with asunp {meteo_df.shape}')
-    hydro_df = merge_hydro_asunp(hydro_df, asunp_hydro)  # мержим гидро и asunp
-    logger.info(f'hydro shape after merge with asunp {hydro_df.shape}')
-    hydro_df = merge_hydro_meteo(hydro_df, meteo_df, asunp_hydro)  # мержим гидро и метео
-    logger.info(f'hydro shape after merge with historical meteo {hydro_df.shape}')
+    if store is not None and store.exists():
+        update_feature_store(store, l_day_history, l_day_meteo)
+    else:
+        hydro_df = cache.run('read_hydro_all', read_hydro_all, start_date=f_day_hydro, end_date=l_day_history, seek=True,
+                             sources=[os.path.join(DATASETS_PATH, 'hydro')])  # выгружаем данные с гидропостов
+        logger.info(f'hydro shape {hydro_df.shape}')
+        if hydro_df.empty:
+            raise EmptyHistoricalHydro(f"There is no historical hydro data from {f_day_hydro.strftime('%Y-%m-%d')} - {f_day.strftime('%Y-%m-%d')}!")
+        elif hydro_df['date'].max() < l_day_history:
+            logger.warning(f"The last max date in hydro is {hydro_df['date'].max().strftime('%Y-%m-%d')} and prediction period is {f_day.strftime('%Y-%m-%d')} - {(l_day-timedelta(days=1)).strftime('%Y-%m-%d')}. You should update your historical hydro data or results will be worse")
+
+        logger.info(f"unique identifiers {len(hydro_df['identifier'].unique())}")
+        meteo_df = cache.run('read_history_meteo', read_history_meteo, start_date=f_day_meteo, end_date=l_day_meteo,
+                             sources=meteo_sources())  # выгружаем метео
+        logger.info(f'meteo shape {meteo_df.shape}')
+        if meteo_df.empty:
+            raise EmptyHistoricalMeteo(f"There is no historical meteo data from {f_day_meteo.strftime('%Y-%m-%d')} - {l_day.strftime('%Y-%m-%d')}!")
+        elif meteo_df['datetime'].max() < l_day_history:
+            logger.warning(f"The last max date ine meteo is {meteo_df['date'].max().strftime('%Y-%m-%d')} and prediction period is {f_day.strftime('%Y-%m-%d')} - {(l_day-timedelta(days=1)).strftime('%Y-%m-%d')}. You should update your historical meteo data or results will be worse")
+
+        meteo_df = cache.run('merge_meteo_asunp', merge_meteo_asunp, meteo_df, asunp)
+        logger.info(f'meteo shape after merge with asunp {meteo_df.shape}')
+        hydro_df = cache.run('merge_hydro_asunp', merge_hydro_asunp, hydro_df, asunp_hydro)  # мержим гидро и asunp
+        logger.info(f'hydro shape after merge with asunp {hydro_df.shape}')
+        hydro_df = cache.run('merge_hydro_meteo', merge_hydro_meteo, hydro_df, meteo_df, asunp_hydro)  # мержим гидро и метео
+        logger.info(f'hydro shape after merge with historical meteo {hydro_df.shape}')
+        if store is not None:
+            store.build(hydro_df)
 
     if l_day >= datetime.today().date():  # если прогнозируем будущее - добавляем прогноз погоды
         logger.info('Use weather forecast')
-        hydro_df = merge_hydro_weatherforecast(hydro_df, asunp_hydro)
-        logger.info(f'hydro shape after merge with forecast weather {hydro_df.shape}')
-
-    amur_df = make_dataset(hydro_df)
-
-    logger.info(f'amur_df shape {amur_df.shape}')
-    inputs = prepare_data(amur_df, start_date=f_day, end_date=l_day)  # подготовка данных в формате модели
-    logger.info(f'model inputs shape {inputs.shape}')
-
-    # предсказание модели
-    model = build_model()
+        if store is not None:
+            store.append_merged(merge_hydro_weatherforecast(pd.DataFrame(columns=['identifier', 'date']), asunp_hydro))
+        else:
+            hydro_df = merge_hydro_weatherforecast(hydro_df, asunp_hydro)
+            logger.info(f'hydro shape after merge with forecast weather {hydro_df.shape}')
+
+    if store is not None:
+        # строки датасета уже нормализованы в хранилище (если нормализация не встроена в модель)
+        amur_df = store.read(start_date=f_day, end_date=l_day, normalized=normalize)
+        logger.info(f'amur_df shape {amur_df.shape}')
+        if len(amur_df) < DAYS_FORECAST:
+            raise ValueError(f"Feature store has no rows for {f_day.strftime('%Y-%m-%d')} - {(l_day-timedelta(days=1)).strftime('%Y-%m-%d')}, "
+                             f"run without --feature-store")
+        inputs = prepare_data(amur_df, start_date=f_day, end_date=l_day, normalize=False)
+    else:
+        amur_df = cache.run('make_dataset', make_dataset, hydro_df)
+        logger.info(cache.report())
+
+        logger.info(f'amur_df shape {amur_df.shape}')
+        inputs = prepare_data(amur_df, start_date=f_day, end_date=l_day,
+                              normalize=normalize)  # подготовка данных в формате модели
+    return inputs
+
+
+def load_model(weights: str, in_graph_normalization: bool=False, clear_session: bool=True):
+    '''
+    Модель с загруженными весами
+    :param weights: str, путь до файла с весами (или имя файла в DATASETS_PATH).
+                    Директория SavedModel или .tflite - модель, экспортированная amurlevel_model.model.export
+                    (встроена ли в нее нормализация, берется из export.json экспорта)
+    :param in_graph_normalization: bool, встроить нормализацию признаков в модель (для экспортированной модели -
+                                   только если у экспорта нет export.json)
+    :param clear_session: bool, сбросить состояние keras перед построением (False - если в процессе уже есть модели)
+    :return: model, атрибут in_graph_normalization - нужны ли модели ненормализованные признаки
+    '''
+    logger = logging.getLogger()
+    if not weights.endswith('.h5'):
+        path = weights if os.path.exists(weights) else os.path.join(DATASETS_PATH, weights)
+        if is_exported(path):
+            logger.info(f'Load exported model {path}')
+            return load_exported(path, in_graph_normalization=in_graph_normalization)
+    model = build_model(normalizer=get_normalizer() if in_graph_normalization else None, clear_session=clear_session)
     try:
-        model.load_weights(args.w)
+        model.load_weights(weights)
     except:
-        model_fn = os.path.join(DATASETS_PATH, args.w)
-        logger.info(f'There is no file {args.w}. Try to load from {model_fn}')
+        model_fn = os.path.join(DATASETS_PATH, weights)
+        logger.info(f'There is no file {weights}. Try to load from {model_fn}')
         model.load_weights(model_fn)
+    model.in_graph_normalization = in_graph_normalization
+    return model
+
 
-    preds = model.predict(inputs).reshape(-1,len(ALL_STATIONS))
+def make_results(preds: np.ndarray, f_day: datetime) -> pd.DataFrame:
+    '''
+    Таблица предсказаний: дата и уровни для первых NUMBER_OF_INFERENCE_STATIONS станций
+    :param preds: np.ndarray, выход модели для одного окна
+    :param f_day: datetime, дата от которой считаем предсказания
+    :return: pd.DataFrame
+    '''
+    l_day = f_day + timedelta(DAYS_FORECAST)
+    preds = preds.reshape(-1,len(ALL_STATIONS))
     results_df = pd.DataFrame({'date': pd.date_range(f_day, l_day - timedelta(days=1), freq='1D')})
 
     for i in range(NUMBER_OF_INFERENCE_STATIONS):
         results_df[ALL_STATIONS[i]] = preds[:, i]
+    return results_df
+
+
+if __name__ == "__main__":
+
+    logger = set_logger()
+    args = parse_args()
+    f_day = pd.to_datetime(args.f_day)
+    l_day = f_day + timedelta(DAYS_FORECAST)
+
+    cache = StageCache(enabled=not args.no_cache)
+    asunp = get_asunp_stations()
+    asunp_hydro = get_asunp_hydro_stations()
+    store = FeatureStore(asunp=asunp, asunp_hydro=asunp_hydro) if args.feature_store else None
+    model = load_model(args.w, in_graph_normalization=args.in_graph_normalization)
+    inputs = prepare_inputs(f_day, cache, asunp, asunp_hydro, store=store, normalize=not model.in_graph_normalization)
+    logger.info(f'model inputs shape {inputs.shape}')
+
+    # предсказание модели
+    results_df = make_results(model.predict(inputs), f_day)
     fname = os.path.join(DATASETS_PATH, f"level_{f_day.strftime('%Y-%m-%d')}_{(l_day-timedelta(days=1)).strftime('%Y-%m-%d')}.csv")
     results_df.to_csv(fname, index=False)
-    logger.info(f'Results saved to {fname}')
\ No newline at end of file
+    logger.info(f'Results saved to {fname}')
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+from argparse import RawTextHelpFormatter, ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from contextlib import nullcontext
+import pandas as pd
+import numpy as np
+import os
+import json
+import logging
+import threading
+
+from amurlevel_model.config import DATASETS_PATH, SERVE_HOST, SERVE_PORT
+from amurlevel_model.dataloaders.asunp import get_asunp_stations, get_asunp_hydro_stations
+from amurlevel_model.features.feature_store import FeatureStore
+from amurlevel_model.model.export import is_exported, exported_normalization
+from amurlevel_model.utils.batching import MicroBatcher
+from amurlevel_model.utils.common import set_logger
+from amurlevel_model.utils.normalizer import get_normalizer
+from amurlevel_model.utils.stage_cache import StageCache
+
+from predict import prepare_inputs, load_model, make_results, EmptyHistoricalHydro, EmptyHistoricalMeteo
+
+
+def parse_args():
+    parser = ArgumentParser(description='''
+        Сервис предсказания уровня воды по HTTP. Модель, статистика нормализации и станции asunp
+        загружаются один раз, одновременные запросы объединяются в один вызов model.predict
+
+        Пример:  python serve.py -w weights-aij2020amurlevel-2017.h5 --feature-store
+        curl 'http://127.0.0.1:8080/predict?f_day=2020-11-01' (таблица как в level_{f_day}.csv из predict.py)
+        curl 'http://127.0.0.1:8080/predict?f_day=2020-11-01&weights=weights-aij2020amurlevel-2012.h5&format=json'
+        curl 'http://127.0.0.1:8080/predict?f_day=2020-11-01&weights=export/weights-aij2020amurlevel-2017/saved_model'
+        ''', formatter_class=RawTextHelpFormatter)
+
+    parser.add_argument('-w', '--weights', dest='w', type=str, required=True,
+                        help='Модель по умолчанию (путь относительно DATASETS_PATH: веса .h5, SavedModel или .tflite),\n'
+                             'загружается при старте')
+    parser.add_argument('--host', type=str, default=SERVE_HOST, help='Адрес сервиса')
+    parser.add_argument('--port', type=int, default=SERVE_PORT, help='Порт сервиса')
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true',
+                        help='Не использовать кэш этапов подготовки данных')
+    parser.add_argument('--in-graph-normalization', dest='in_graph_normalization', action='store_true',
+                        help='Нормализовать признаки внутри модели (для экспортированных моделей берется из export.json)')
+    parser.add_argument('--feature-store', dest='feature_store', action='store_true',
+                        help='Брать признаки из хранилища признаков, дополняя его новыми днями')
+    args = parser.parse_args()
+    return args
+
+
+class ForecastService():
+    '''
+    Прогрев и обработка запросов: станции asunp, статистика нормализации и модели загружаются один раз,
+    модели по разным весам кэшируются. Предсказания идут через MicroBatcher
+    '''
+
+    def __init__(self, default_weights: str, feature_store: bool=False, in_graph_normalization: bool=False,
+                 use_cache: bool=True):
+        '''
+        :param default_weights: str, модель по умолчанию (путь относительно DATASETS_PATH, см. resolve_weights)
+        :param feature_store: bool, брать признаки из FeatureStore
+        :param in_graph_normalization: bool, нормализация внутри модели (для весов .h5 и экспорта без export.json)
+        :param use_cache: bool, использовать StageCache
+        '''
+        self.in_graph_normalization = in_graph_normalization
+        self.cache = StageCache(enabled=use_cache)
+        self.asunp = get_asunp_stations()
+        self.asunp_hydro = get_asunp_hydro_stations()
+        self.store = FeatureStore(asunp=self.asunp, asunp_hydro=self.asunp_hydro) if feature_store else None
+        # хранилище дописывается при подготовке данных - запросы к нему идут по одному
+        self.store_lock = threading.Lock()
+        get_normalizer()
+        self.models = {}
+        # модели загружаются под блокировкой: построение keras моделей не потокобезопасно
+        self.models_lock = threading.Lock()
+        self.normalization = {} # путь до модели -> встроена ли в нее нормализация
+        self.default_weights = self.resolve_weights(default_weights)
+        self._model(self.default_weights)
+        self.batcher = MicroBatcher(self._predict_batch)
+
+    @staticmethod
+    def resolve_weights(name: str) -> str:
+        '''
+        Путь до модели относительно DATASETS_PATH (за ее пределы выйти нельзя): веса .h5
+        или модель, экспортированная amurlevel_model.model.export (директория SavedModel, .tflite)
+        '''
+        root = os.path.realpath(DATASETS_PATH)
+        fname = os.path.realpath(os.path.join(root, name))
+        inside = os.path.commonpath([root, fname]) == root
+        if not inside or not os.path.exists(fname) or not (fname.endswith('.h5') or is_exported(fname)):
+            raise FileNotFoundError(f'There is no model {name} in {DATASETS_PATH}')
+        return fname
+
+    def _model(self, weights: str):
+        model = self.models.get(weights)
+        if model is None:
+            with self.models_lock:
+                if weights not in self.models:
+                    logging.getLogger().info(f'Loading model {weights}')
+                    self.models[weights] = load_model(weights, in_graph_normalization=self.in_graph_normalization,
+                                                      clear_session=False)
+                model = self.models[weights]
+        return model
+
+    def _in_graph_normalization(self, weights: str) -> bool:
+        '''
+        Встроена ли нормализация в модель weights: для экспортированной - из ее export.json, без загрузки модели
+        '''
+        if weights not in self.normalization:
+            self.normalization[weights] = exported_normalization(weights, self.in_graph_normalization) \
+                if is_exported(weights) else self.in_graph_normalization
+        return self.normalization[weights]
+
+    def _predict_batch(self, weights: str, inputs: np.ndarray) -> np.ndarray:
+        return self._model(weights).predict(inputs, batch_size=len(inputs))
+
+    def forecast(self, f_day: str, weights: str=None) -> pd.DataFrame:
+        '''
+        Предсказание на DAYS_FORECAST дней от f_day
+        :param f_day: str, дата от которой считаем предсказания
+        :param weights: str, путь до модели относительно DATASETS_PATH (None - модель по умолчанию)
+        :return: pd.DataFrame, таблица как в predict.py
+        '''
+        f_day = pd.to_datetime(f_day)
+        weights = self.default_weights if weights is None else self.resolve_weights(weights)
+        normalize = not self._in_graph_normalization(weights)
+        with self.store_lock if self.store is not None else nullcontext():
+            inputs = prepare_inputs(f_day, self.cache, self.asunp, self.asunp_hydro, store=self.store,
+                                    normalize=normalize)
+        return make_results(self.batcher.submit(weights, inputs), f_day)
+
+
+class ForecastHandler(BaseHTTPRequestHandler):
+    '''
+    GET /predict?f_day=YYYY-MM-DD[&weights=...][&format=csv|json]
+    POST /predict с json {"f_day": ..., "weights": ..., "format": ...}
+    GET /health
+    '''
+    service = None # ForecastService, задается в main
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/health':
+            self._send(200, 'ok', 'text/plain')
+        elif url.path == '/predict':
+            params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            self._forecast(params)
+        else:
+            self._send(404, 'Not found', 'text/plain')
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/predict':
+            self._send(404, 'Not found', 'text/plain')
+            return
+        try:
+            params = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        except ValueError as e:
+            self._send(400, f'Bad json: {e}', 'text/plain')
+            return
+        self._forecast(params)
+
+    def _forecast(self, params: dict):
+        if 'f_day' not in params:
+            self._send(400, 'f_day is required', 'text/plain')
+            return
+        try:
+            results_df = self.service.forecast(params['f_day'], params.get('weights'))
+        except FileNotFoundError as e:
+            self._send(404, str(e), 'text/plain')
+            return
+        except (ValueError, EmptyHistoricalHydro, EmptyHistoricalMeteo) as e:
+            self._send(400, str(e), 'text/plain')
+            return
+        except Exception as e:
+            logging.getLogger().exception(f'Forecast failed for {params}')
+            self._send(500, f'Internal error: {e}', 'text/plain')
+            return
+        if params.get('format', 'csv') == 'json':
+            self._send(200, results_df.to_json(orient='records', date_format='iso'), 'application/json')
+        else:
+            self._send(200, results_df.to_csv(index=False), 'text/csv')
+
+    def _send(self, code: int, body: str, content_type: str):
+        data = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', f'{content_type}; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.getLogger().info(f'{self.address_string()} {format % args}')
+
+
+if __name__ == "__main__":
+
+    logger = set_logger()
+    args = parse_args()
+    ForecastHandler.service = ForecastService(args.w, feature_store=args.feature_store,
+                                              in_graph_normalization=args.in_graph_normalization,
+                                              use_cache=not args.no_cache)
+    server = ThreadingHTTPServer((args.host, args.port), ForecastHandler)
+    logger.info(f'Serving forecasts on http://{args.host}:{args.port}/predict')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        ForecastHandler.service.batcher.close()
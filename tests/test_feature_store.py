@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+
+from amurlevel_model.config import ALL_STATIONS
+from amurlevel_model.features import feature_store
+from amurlevel_model.features.amur_features import make_dataset
+
+METEO_COLS = ['windDirection', 'windSpeed', 'maximumWindGustSpeed', 'soilTemperature', 'airTemperature_min',
+              'airTemperature_max', 'relativeHumidity', 'pressureReducedToMeanSeaLevel', 'pressure']
+
+
+def hydro_meteo(stations, start='2005-01-01', days=1700, seed=0):
+    '''
+    Синтетический длинный гидро-метео датафрейм (формат merge_hydro_meteo)
+    '''
+    rng = np.random.default_rng(seed)
+    parts = []
+    for k, identifier in enumerate(stations):
+        t = np.arange(days)
+        df = pd.DataFrame({'date': pd.date_range(start, periods=days), 'identifier': identifier})
+        df['sealevel_max'] = 300 + 100 * np.sin(2 * np.pi * t / 365) + np.cumsum(rng.normal(size=days))
+        df.loc[rng.random(days) < 0.05, 'sealevel_max'] = np.nan
+        df['sealevel_min'] = df['sealevel_max'] - 3
+        df['water_temp'] = np.where(rng.random(days) < 0.5, np.nan, rng.random(days) * 20)
+        df['water_code'] = rng.integers(0, 5, days).astype(float)
+        df['ice_thickness'] = np.where(rng.random(days) < 0.7, np.nan, rng.random(days) * 100)
+        df['snow_height'] = np.where(rng.random(days) < 0.7, np.nan, rng.random(days) * 30)
+        df['water_flow'] = rng.random(days) * 1000
+        df['lat'], df['lon'] = 50 + k * 0.1, 120 + k * 0.3
+        for col in ['pastWeather', 'presentWeather', 'cloudCoverTotal']:
+            df[col] = rng.integers(0, 10, days).astype(float)
+        for col in METEO_COLS:
+            df[col] = rng.normal(size=days) * 10 + 5
+        df['totalAccumulatedPrecipitation'] = np.where(rng.random(days) < 0.6, 0, rng.random(days) * 10)
+        parts.append(df)
+    return pd.concat(parts, ignore_index=True).sort_values('date').reset_index(drop=True)
+
+
+DEMODUL_TOLERANCE = 0.1 # допустимое отклонение demodule_* от make_dataset (доля максимума колонки): среднее зафиксировано при build
+
+
+def test_append_matches_make_dataset(tmp_path, monkeypatch):
+    monkeypatch.setattr(feature_store.FeatureStore, '_normalizer', lambda self: None)
+    hydro_df = hydro_meteo(ALL_STATIONS[:3])
+    build_date = pd.Timestamp('2009-06-30')
+    n_days = 30
+    # для первого нового дня у станции нет уровня 10 дней назад - вход демодуляции пустой
+    gap = (hydro_df['identifier'] == ALL_STATIONS[1]) & (hydro_df['date'] == build_date - pd.Timedelta(days=9))
+    hydro_df.loc[gap, 'sealevel_max'] = np.nan
+
+    store = feature_store.FeatureStore(store_dir=str(tmp_path))
+    store.build(hydro_df[hydro_df['date'] <= build_date])
+    for k in range(1, n_days + 1):
+        store.append_merged(hydro_df[hydro_df['date'] == build_date + pd.Timedelta(days=k)].copy())
+
+    stored = store.read(start_date=build_date + pd.Timedelta(days=1))
+    expected = make_dataset(hydro_df[hydro_df['date'] <= build_date + pd.Timedelta(days=n_days)])
+    expected = expected[expected['date'] > build_date].reset_index(drop=True)
+    assert len(stored) == len(expected) == n_days
+    assert (stored['date'].values == expected['date'].values).all()
+
+    demodul_cols = [col for col in expected.columns if col.startswith('demodule')]
+    other_cols = [col for col in expected.columns if col != 'date' and col not in demodul_cols]
+    assert len(demodul_cols) > 0 and len(other_cols) > 0
+    # признаки, кроме демодуляции, совпадают с точностью float32
+    np.testing.assert_allclose(stored[other_cols].values.astype(np.float64),
+                               expected[other_cols].values.astype(np.float64), rtol=1e-6, atol=1e-4)
+    stored_demodul = stored[demodul_cols].values.astype(np.float64)
+    expected_demodul = expected[demodul_cols].values.astype(np.float64)
+    assert np.isfinite(expected_demodul).all()
+    assert np.isfinite(stored_demodul).all()
+    deviation = np.abs(stored_demodul - expected_demodul).max(axis=0) / np.abs(expected_demodul).max(axis=0)
+    assert deviation.max() < DEMODUL_TOLERANCE, demodul_cols[deviation.argmax()]
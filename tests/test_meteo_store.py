@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from amurlevel_model.dataloaders import meteo
+
+
+def write_meteo_csv(meteo_dir, identifier, start='2012-01-01', days=800, seed=0):
+    '''
+    Синтетический файл метеостанции в формате meteo_new: сроки через 3 часа с пропусками,
+    пропущенные значения и недостоверные коды качества
+    '''
+    rng = np.random.default_rng(seed)
+    ts = pd.date_range(start, periods=days * 8, freq='3H')
+    ts = ts[rng.random(len(ts)) > 0.05]
+    df = pd.DataFrame({'localYear': ts.year, 'localMonth': ts.month, 'localDay': ts.day, 'localTimePeriod': ts.hour})
+    for col in meteo.METEO_COLS:
+        if col in meteo.CATEGORICAL_METEO_COLS:
+            values = rng.integers(0, 10, len(ts)).astype(float)
+        else:
+            values = np.round(rng.normal(size=len(ts)) * 10 + 20, 1)
+        values[rng.random(len(ts)) < 0.03] = np.nan
+        df[col] = values
+        df[col + 'Quality'] = rng.choice([0, 0, 0, 0, 1, 2, 3, 4, 6, 7, 9], len(ts))
+    df.to_csv(os.path.join(meteo_dir, identifier + '.csv'), index=False)
+
+
+def test_store_read_matches_csv(tmp_path, monkeypatch):
+    os.makedirs(tmp_path / 'meteo_new')
+    for k, identifier in enumerate(['4923811', '4443141', '4483311']):
+        write_meteo_csv(str(tmp_path / 'meteo_new'), identifier, seed=k)
+    store_dir = str(tmp_path / 'store')
+    monkeypatch.setattr(meteo, 'DATASETS_PATH', str(tmp_path))
+    monkeypatch.setattr(meteo, 'get_store_dir', lambda: store_dir)
+    assert len(meteo.ingest_meteo_store(n_jobs=1)) == 3
+
+    # окна с краями внутри суток и на стыке лет: последний день берется только по сроку 00:00
+    for start_date, end_date in [('2013-03-01', '2013-05-15'), ('2013-12-20', '2014-01-10')]:
+        from_store = meteo.read_history_meteo(start_date, end_date, n_jobs=1, verbose=False)
+        monkeypatch.setattr(meteo, 'get_store_dir', lambda: None)
+        from_csv = meteo.read_history_meteo(start_date, end_date, n_jobs=1, verbose=False)
+        monkeypatch.setattr(meteo, 'get_store_dir', lambda: store_dir)
+        pd.testing.assert_frame_equal(from_store.reset_index(drop=True), from_csv.reset_index(drop=True))
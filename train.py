@@ -1,9 +1,10 @@
 from argparse import RawTextHelpFormatter, ArgumentParser
 import pandas as pd
+import os
 import tensorflow as tf
 
-from amurlevel_model.dataloaders.asunp import get_asunp_hydro_stations
-from amurlevel_model.dataloaders.meteo import read_history_meteo
+from amurlevel_model.dataloaders.asunp import get_asunp_stations, get_asunp_hydro_stations
+from amurlevel_model.dataloaders.meteo import read_history_meteo, meteo_sources
 from amurlevel_model.dataloaders.hydro import read_hydro_all
 
 from amurlevel_model.processing.merge_hydro_meteo import merge_hydro_meteo
@@ -11,12 +12,16 @@ from amurlevel_model.processing.merge_hydro_asunp import merge_hydro_asunp
 from amurlevel_model.processing.merge_meteo_asunp import merge_meteo_asunp
 
 from amurlevel_model.features.amur_features import make_dataset
+from amurlevel_model.features.normalizer_stats import build_normalizer_stats
 
-from amurlevel_model.model.train_test_split import train_test_split
+from amurlevel_model.model.train_test_split import train_test_split, train_test_windows
+from amurlevel_model.model.windows import WindowSet, get_windows_dir
+from amurlevel_model.model.dataset import make_tf_dataset
 from amurlevel_model.model.model import build_model
 
-from amurlevel_model.config import BATCH_SIZE,EPOCHS
+from amurlevel_model.config import BATCH_SIZE,EPOCHS,DATASETS_PATH
 from amurlevel_model.utils.common import set_logger
+from amurlevel_model.utils.stage_cache import StageCache
 
 LAST_DAY = '2021-01-01' # дата до которой у нас есть данные в выборке, больше не выгружаем
 
@@ -26,6 +31,8 @@ def parse_args():
         Скрипт для обучения модели
 
         Пример:  python train.py -t_day 2015-01-01 -w /data/weights_2015.h5 (предсказания будут от 2020-11-01 до 2020-11-11)
+        python train.py -t_day 2015-01-01 -w /data/weights_2015.h5 --build-stats --stats /data/mean_std_stats_2015.json
+        (статистика для нормализации пересчитывается по данным до 2015-01-01 в отдельный файл, на ней и обучаемся)
         ''', formatter_class=RawTextHelpFormatter)
 
     parser.add_argument('-t_day', type=str, required=True,
@@ -34,7 +41,23 @@ def parse_args():
     parser.add_argument('-w', type=str, required=True,
                         help='Название файла куда сохраним веса модели (в формате .h5)')
 
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true',
+                        help='Не использовать кэш этапов подготовки данных (все этапы считаются заново)')
+
+    parser.add_argument('--build-stats', dest='build_stats', action='store_true',
+                        help='Посчитать статистику mean,std для нормализации по данным до t_day и записать в --stats\n'
+                             '(обязателен: DATASETS_PATH/mean_std_stats.json соответствует поставляемым весам)')
+
+    parser.add_argument('--stats', type=str, default=None,
+                        help='Путь до json со статистикой mean,std (по умолчанию DATASETS_PATH/mean_std_stats.json)')
+
+    parser.add_argument('--stream', action='store_true',
+                        help='Выгрузить окна в .npy (WINDOWS_DIR) и обучаться на них через tf.data с чтением через memmap\n'
+                             '(память не зависит от длины обучающей выборки)')
+
     args = parser.parse_args()
+    if args.build_stats and args.stats is None:
+        parser.error('--build-stats requires --stats: the default mean_std_stats.json matches the shipped weights')
     return args
 
 
@@ -45,27 +68,54 @@ if __name__ == "__main__":
     f_day = pd.to_datetime(args.t_day)
     l_day = pd.to_datetime(LAST_DAY)
 
+    # этапы подготовки данных не зависят от t_day и берутся из кэша, если исходные данные не менялись
+    cache = StageCache(enabled=not args.no_cache)
+    asunp = get_asunp_stations()
     asunp_hydro = get_asunp_hydro_stations()
     logger.info('training')
-    hydro_df = read_hydro_all(end_date=l_day)  # выгружаем данные с гидропостов
+    hydro_df = cache.run('read_hydro_all', read_hydro_all, end_date=l_day,
+                         sources=[os.path.join(DATASETS_PATH, 'hydro')])  # выгружаем данные с гидропостов
     logger.info(f'hydro shape {hydro_df.shape}')
     logger.info(f"unique identifiers {len(hydro_df['identifier'].unique())}")
-    meteo_df = read_history_meteo(end_date=l_day)  # выгружаем метео
+    meteo_df = cache.run('read_history_meteo', read_history_meteo, end_date=l_day,
+                         sources=meteo_sources())  # выгружаем метео
     logger.info(f'meteo shape {meteo_df.shape}')
 
-    meteo_df = merge_meteo_asunp(meteo_df)
+    meteo_df = cache.run('merge_meteo_asunp', merge_meteo_asunp, meteo_df, asunp)
     logger.info(f'meteo shape after merge with asunp {meteo_df.shape}')
-    hydro_df = merge_hydro_asunp(hydro_df, asunp_hydro)  # мержим гидро и asunp
+    hydro_df = cache.run('merge_hydro_asunp', merge_hydro_asunp, hydro_df, asunp_hydro)  # мержим гидро и asunp
     logger.info(f'hydro shape after merge with asunp {hydro_df.shape}')
-    hydro_df = merge_hydro_meteo(hydro_df, meteo_df, asunp_hydro)  # мержим гидро и метео
+    hydro_df = cache.run('merge_hydro_meteo', merge_hydro_meteo, hydro_df, meteo_df, asunp_hydro)  # мержим гидро и метео
     logger.info(f'hydro shape after merge with historical meteo {hydro_df.shape}')
 
-    amur_df = make_dataset(hydro_df,train=True)
+    if args.build_stats:
+        # статистика только по обучающей выборке (до t_day)
+        build_normalizer_stats(hydro_df, end_date=f_day, fname=args.stats)
+
+    amur_df = cache.run('make_dataset', make_dataset, hydro_df, train=True)
+    logger.info(cache.report())
 
     logger.info(f'amur_df shape {amur_df.shape}')
-    X_train, y_train, X_test, y_test = train_test_split(amur_df, start_test_date=f_day, end_test_date=l_day)  # подготовка данных в формате модели
-    logger.info(f'train shape {X_train.shape}')
-    logger.info(f'test shape {X_test.shape}')
+    if args.stream:
+        # окна выгружаем на диск и читаем батчами через memmap
+        train_windows, test_windows = train_test_windows(amur_df, start_test_date=f_day, end_test_date=l_day,
+                                                         fname=args.stats)
+        windows_dir = get_windows_dir()
+        train_windows.save(os.path.join(windows_dir, 'train'))
+        test_windows.save(os.path.join(windows_dir, 'test'))
+        del amur_df, train_windows, test_windows
+        train_windows = WindowSet.load(os.path.join(windows_dir, 'train'))
+        test_windows = WindowSet.load(os.path.join(windows_dir, 'test'))
+        logger.info(f'train windows {len(train_windows)}, test windows {len(test_windows)} in {windows_dir}')
+        train_data = make_tf_dataset(train_windows, shuffle=True)
+        fit_kwargs = {'validation_data': make_tf_dataset(test_windows, shuffle=False)}
+    else:
+        X_train, y_train, X_test, y_test = train_test_split(amur_df, start_test_date=f_day, end_test_date=l_day,
+                                                            fname=args.stats)  # подготовка данных в формате модели
+        logger.info(f'train shape {X_train.shape}')
+        logger.info(f'test shape {X_test.shape}')
+        train_data = X_train
+        fit_kwargs = {'y': y_train, 'validation_data': (X_test, y_test), 'batch_size': BATCH_SIZE}
 
     # обучение модели
     model_fn = args.w
@@ -75,12 +125,11 @@ if __name__ == "__main__":
     lr_callback = tf.keras.callbacks.ReduceLROnPlateau(factor=0.3)
 
     history_model = model.fit(
-        X_train, y_train,
-        validation_data=(X_test, y_test),
-        batch_size=BATCH_SIZE,
+        train_data,
         epochs=EPOCHS,
         callbacks=[lr_callback, sv_model],
-        verbose=2
+        verbose=2,
+        **fit_kwargs
     )
 
     logger.info(